@@ -0,0 +1,95 @@
+"""
+rows/sec of the old per-loader row materialization vs sql_pyodbc_params.frame_to_params,
+on a synthetic stock_a_daily-shaped frame (default 1M rows).
+
+    python bench_frame_to_params.py --rows 1000000
+"""
+import argparse
+import time
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+
+from sql_pyodbc_params import frame_to_params
+
+DAILY_COLS = [
+    'symbol', 'trade_date', 'open', 'high', 'low', 'close',
+    'volume', 'amount', 'turnover', 'update_time'
+]
+DAILY_SCALES = {
+    'open': 4, 'high': 4, 'low': 4, 'close': 4,
+    'volume': 2, 'amount': 2, 'turnover': 6
+}
+
+
+def make_frame(n_rows: int, seed: int = 0) -> pd.DataFrame:
+    rng = np.random.default_rng(seed)
+    close = rng.uniform(2, 200, n_rows)
+    df = pd.DataFrame({
+        'symbol':     np.array([f"sh{600000 + i % 5000}" for i in range(n_rows)]),
+        'trade_date': pd.Timestamp("2010-01-01") + pd.to_timedelta(rng.integers(0, 5500, n_rows), unit='D'),
+        'open':       close * rng.uniform(0.97, 1.03, n_rows),
+        'high':       close * 1.05,
+        'low':        close * 0.95,
+        'close':      close,
+        'volume':     rng.uniform(1e4, 1e8, n_rows),
+        'amount':     rng.uniform(1e6, 1e10, n_rows),
+        'turnover':   rng.uniform(0, 0.2, n_rows),
+    })
+    # 约 1% 缺失值
+    for col in ('open', 'volume', 'turnover'):
+        df.loc[rng.random(n_rows) < 0.01, col] = np.nan
+    df['trade_date'] = df['trade_date'].dt.date
+    df['update_time'] = datetime.now()
+    return df
+
+
+def old_values(df: pd.DataFrame) -> list:
+    # stock_daily / stock_cap: df.values 整体上转 object
+    out = df[DAILY_COLS].where(pd.notnull(df[DAILY_COLS]), None)
+    return [tuple(row) for row in out.values]
+
+
+def old_itertuples(df: pd.DataFrame) -> list:
+    # stock_value: 每 1000 行一批 itertuples
+    records = []
+    for i in range(0, len(df), 1000):
+        batch = df.iloc[i:i + 1000]
+        records.extend(tuple(row) for row in batch[DAILY_COLS].itertuples(index=False))
+    return records
+
+
+def old_iterrows(df: pd.DataFrame) -> list:
+    # index / split: iterrows + 逐字段 pd.notna
+    return [
+        tuple(row[c] if pd.notna(row[c]) else None for c in DAILY_COLS)
+        for _, row in df.iterrows()
+    ]
+
+
+def new_frame_to_params(df: pd.DataFrame) -> list:
+    return frame_to_params(df, DAILY_COLS, scales=DAILY_SCALES, date_cols=['trade_date'])
+
+
+def bench(name: str, fn, df: pd.DataFrame) -> float:
+    t0 = time.perf_counter()
+    rows = fn(df)
+    elapsed = time.perf_counter() - t0
+    rate = len(rows) / elapsed
+    print(f"{name:<28}{len(rows):>10,} 行  {elapsed:>8.2f} s  {rate:>12,.0f} 行/秒")
+    return rate
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rows", type=int, default=1_000_000)
+    parser.add_argument("--iterrows-rows", type=int, default=50_000,
+                        help="iterrows 太慢，只在前 N 行上测")
+    args = parser.parse_args()
+
+    df = make_frame(args.rows)
+    bench("iterrows + pd.notna", old_iterrows, df.iloc[:args.iterrows_rows])
+    bench("itertuples (1000/批)", old_itertuples, df)
+    bench("df.values", old_values, df)
+    bench("frame_to_params", new_frame_to_params, df)
@@ -0,0 +1,73 @@
+"""
+Time of sql_portfolio_analytics.compute_metrics on a synthetic panel
+(default 10 years x 5,000 tickers), and of the sql_drawdown&vol_analysis.sql
+queries vs load_panel + compute_metrics on a smaller SQLite portfolio.
+
+    python bench_portfolio_analytics.py --days 2520 --tickers 5000 --sql-tickers 200
+"""
+import argparse
+import time
+
+import numpy as np
+import pandas as pd
+
+from sql_portfolio_analytics import SQL_CHECKS, PortfolioPanel, _synthetic_db, compute_metrics, load_panel
+
+
+def make_panel(n_days: int, n_tickers: int, n_trades: int = 50_000, seed: int = 0) -> PortfolioPanel:
+    rng = np.random.default_rng(seed)
+    dates = np.busday_offset(np.datetime64('2015-01-01'), np.arange(n_days), roll='forward')
+    prices = 50 * np.exp(np.cumsum(rng.normal(0, 0.02, (n_days, n_tickers)), axis=0))
+    # 约 2% 缺失价格（停牌）
+    prices[rng.random(prices.shape) < 0.02] = np.nan
+    quantity = np.round(rng.normal(0, 1000, (n_days, n_tickers)), -1)
+    quantity[rng.random(quantity.shape) < 0.5] = np.nan
+
+    nav = 1e8 + np.cumsum(rng.normal(0, 1e6, n_days))
+    tickers = pd.Index([f"T{i:04d}" for i in range(n_tickers)])
+    trades = pd.DataFrame({
+        'orderid': np.arange(n_trades),
+        'tradedate': dates[rng.integers(0, n_days, n_trades)],
+        'ticker': tickers[rng.integers(0, n_tickers, n_trades)],
+        'action': np.where(rng.random(n_trades) < 0.5, 'Buy', 'Sell'),
+        'shares': rng.integers(1, 100, n_trades) * 10.0,
+        'tradeprice': rng.uniform(10, 100, n_trades),
+    })
+    return PortfolioPanel(
+        dates=dates,
+        tickers=tickers,
+        prices=prices,
+        prev_idx=np.arange(n_days) - 1,
+        quantity=quantity,
+        nav=pd.Series(nav, index=pd.DatetimeIndex(dates)),
+        pl=pd.Series(np.diff(nav, prepend=nav[0]), index=pd.DatetimeIndex(dates)),
+        trades=trades,
+        last_prices=pd.Series(prices[-1], index=tickers).dropna(),
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--days", type=int, default=2520)
+    parser.add_argument("--tickers", type=int, default=5000)
+    parser.add_argument("--sql-tickers", type=int, default=200,
+                        help="SQL 对照用的 SQLite 组合股票数（0 跳过）")
+    args = parser.parse_args()
+
+    panel = make_panel(args.days, args.tickers)
+    print(f"panel {args.days} x {args.tickers}: {panel.prices.nbytes / 2**20:,.0f} MB of prices")
+    t0 = time.perf_counter()
+    metrics = compute_metrics(panel)
+    print(f"compute_metrics            {time.perf_counter() - t0:>8.2f} s  max |z| {metrics['max_zscore'][3]:.2f}")
+
+    if args.sql_tickers:
+        conn = _synthetic_db(n_days=args.days, n_tickers=args.sql_tickers, n_trades=args.sql_tickers * 30)
+        t0 = time.perf_counter()
+        for sql in SQL_CHECKS.values():
+            conn.execute(sql).fetchall()
+        t_sql = time.perf_counter() - t0
+        t0 = time.perf_counter()
+        compute_metrics(load_panel(conn))
+        t_np = time.perf_counter() - t0
+        print(f"SQLite {args.days} x {args.sql_tickers}: SQL queries {t_sql:.2f} s, "
+              f"load_panel + compute_metrics {t_np:.2f} s ({t_sql / t_np:.1f}x)")
@@ -0,0 +1,119 @@
+"""
+Query times of the loader tables under each storage layout of TableSchema:
+copies of a source table as rowstore (PK only), + date-leading covering index,
+clustered columnstore, and columnstore partitioned by year, each hit with the
+same cross-sectional and per-symbol queries.
+
+    python bench_storage_layout.py --table stock_valuation --column pb
+    python bench_storage_layout.py --table stock_a_daily --layouts rowstore date-index --keep
+"""
+import argparse
+import time
+from typing import Callable, Dict, List
+
+from sql_pyodbc_pool import get_pool
+from sql_pyodbc_schema import TableSchema
+
+conn_str = 'DSN,UID,PWD'
+
+
+def source_schemas() -> Dict[str, TableSchema]:
+    # 只在需要时导入 loader 模块（它们依赖 akshare）
+    from sql_pyodbc_akshare_stock_cap import cap_schema
+    from sql_pyodbc_akshare_stock_daily import daily_schema
+    from sql_pyodbc_akshare_stock_value import valuation_schema
+    return {s.name: s for s in (daily_schema, cap_schema, valuation_schema)}
+
+
+layouts: Dict[str, Callable[[TableSchema, List[int]], TableSchema]] = {
+    "rowstore":    lambda s, years: s.set_storage(),
+    "date-index":  lambda s, years: s.set_storage(date_index=True),
+    "columnstore": lambda s, years: s.set_storage(columnstore=True),
+    "columnstore-partitioned": lambda s, years: s.set_storage(columnstore=True, partition_years=years),
+}
+
+
+def build_copy(pool, source: TableSchema, layout: str, years: List[int]) -> TableSchema:
+    target = layouts[layout](source.copy(f"{source.name}_bench_{layout.replace('-', '_')}"), years)
+    cols = ", ".join(f"[{c}]" for c in source.column_names)
+    t0 = time.perf_counter()
+    pool.run(lambda conn: conn.cursor().execute(target.drop_sql() + target.ddl()))
+    # 先建好索引再整表导入；列存储按日期排序写入，行组可按日期消除
+    pool.run(lambda conn: conn.cursor().execute(
+        f"INSERT INTO {target.qualified_name} WITH (TABLOCK) ({cols}) "
+        f"SELECT {cols} FROM {source.qualified_name} ORDER BY [{source.date_column}]"))
+    print(f"✔️ {target.name}: 建表 + 导入 {time.perf_counter() - t0:.1f} s")
+    return target
+
+
+def queries(schema: TableSchema, column: str, day, year_start, year_end, symbol) -> Dict[str, tuple]:
+    t, d = schema.qualified_name, schema.date_column
+    return {
+        "cross-section (1 day)":  (f"SELECT * FROM {t} WHERE [{d}] = ?", (day,)),
+        f"{column} all symbols 1y": (f"SELECT symbol, [{d}], [{column}] FROM {t} WHERE [{d}] >= ? AND [{d}] < ?",
+                                     (year_start, year_end)),
+        "per-symbol history":      (f"SELECT * FROM {t} WHERE symbol = ? ORDER BY [{d}]", (symbol,)),
+        f"avg {column} by date 1y": (f"SELECT [{d}], AVG([{column}]) FROM {t} WHERE [{d}] >= ? AND [{d}] < ? "
+                                     f"GROUP BY [{d}]", (year_start, year_end)),
+    }
+
+
+def time_query(pool, sql: str, params: tuple, repeat: int) -> tuple:
+    def run(conn):
+        cur = conn.cursor()
+        cur.execute(sql, params)
+        n = 0
+        while True:
+            rows = cur.fetchmany(10000)
+            if not rows:
+                return n
+            n += len(rows)
+
+    best, n_rows = float("inf"), 0
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        n_rows = pool.run(run)
+        best = min(best, time.perf_counter() - t0)
+    return best, n_rows
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="不同存储布局下的横截面 / 单股票查询耗时")
+    parser.add_argument("--table", default="stock_valuation")
+    parser.add_argument("--column", help="横截面查询的数值列（默认第一个非主键列）")
+    parser.add_argument("--layouts", nargs="+", default=list(layouts), choices=list(layouts))
+    parser.add_argument("--partition-years", type=int, nargs=2, default=[2005, 2030])
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--keep", action="store_true", help="保留测试副本表")
+    args = parser.parse_args()
+
+    source = source_schemas()[args.table]
+    column = args.column or next(c for c in source.column_names if c not in source.primary_key)
+    pool = get_pool(conn_str)
+    try:
+        # 取一个有代表性的日期 / 股票：最近一个完整年度和数据最多的股票
+        last_day, symbol = pool.run(lambda conn: conn.cursor().execute(
+            f"SELECT (SELECT MAX([{source.date_column}]) FROM {source.qualified_name}), "
+            f"(SELECT TOP 1 symbol FROM {source.qualified_name} GROUP BY symbol ORDER BY COUNT(*) DESC)"
+        ).fetchone())
+        last_day = str(last_day)[:10]
+        year = int(last_day[:4]) - 1
+        params = dict(day=last_day, year_start=f"{year}-01-01", year_end=f"{year + 1}-01-01", symbol=symbol)
+        print(f"ℹ️ {args.table}: 日期 {last_day}，年度 {year}，股票 {symbol}")
+
+        results = {}
+        for layout in args.layouts:
+            target = build_copy(pool, source, layout, args.partition_years)
+            for name, (sql, p) in queries(target, column, **params).items():
+                results[(layout, name)] = time_query(pool, sql, p, args.repeat)
+            if not args.keep:
+                pool.run(lambda conn: conn.cursor().execute(target.drop_sql()))
+
+        names = list(queries(source, column, **params))
+        print(f"\n{'query':<28}" + "".join(f"{layout:>28}" for layout in args.layouts))
+        for name in names:
+            cells = "".join(f"{results[(layout, name)][0] * 1000:>15.1f} ms {results[(layout, name)][1]:>8} 行"
+                            for layout in args.layouts)
+            print(f"{name:<28}{cells}")
+    finally:
+        pool.close()
@@ -0,0 +1,369 @@
+"""
+Vectorized version of sql_drawdown&vol_analysis.sql.
+
+closeprices / positions / nav / pl / trades are read once into aligned
+(calendar date x ticker) arrays, and every metric of the SQL file is computed
+from them in one pass: daily returns, rolling z-scores and vol risk, ticker PL,
+net / gross / short exposure, monthly and rolling returns, max drawdown and
+best / worst trades.
+
+    python sql_portfolio_analytics.py --db portfolio.sqlite3   # metrics + check against the SQL
+    python sql_portfolio_analytics.py --check                  # same, on a synthetic portfolio
+"""
+import argparse
+import sqlite3
+from typing import Dict, Optional, Tuple
+
+import numpy as np
+import pandas as pd
+
+from sql_portfolio_rolling import rolling_moments
+
+
+class PortfolioPanel:
+    """
+    Aligned arrays: prices / quantity are (n_dates, n_tickers) float arrays with
+    NaN where the table has no row; prev_idx[i] is the row of dates[i]'s
+    previous business date (-1 if unknown). nav / pl are the table series.
+    """
+
+    def __init__(
+        self,
+        dates: np.ndarray,
+        tickers: pd.Index,
+        prices: np.ndarray,
+        prev_idx: np.ndarray,
+        quantity: np.ndarray,
+        nav: pd.Series,
+        pl: pd.Series,
+        trades: pd.DataFrame,
+        last_prices: pd.Series
+    ):
+        self.dates = dates
+        self.tickers = tickers
+        self.prices = prices
+        self.prev_idx = prev_idx
+        self.quantity = quantity
+        self.nav = nav
+        self.pl = pl
+        self.trades = trades
+        self.last_prices = last_prices
+
+    @property
+    def prev_prices(self) -> np.ndarray:
+        prev = np.full_like(self.prices, np.nan)
+        ok = self.prev_idx >= 0
+        prev[ok] = self.prices[self.prev_idx[ok]]
+        return prev
+
+
+def _dense(df: pd.DataFrame, value: str, dates: pd.Index, tickers: pd.Index) -> np.ndarray:
+    out = np.full((len(dates), len(tickers)), np.nan)
+    di = dates.get_indexer(pd.to_datetime(df['closedate']))
+    ti = tickers.get_indexer(df['ticker'])
+    ok = (di >= 0) & (ti >= 0)
+    out[di[ok], ti[ok]] = df[value].to_numpy(dtype=float)[ok]
+    return out
+
+
+def load_panel(conn) -> PortfolioPanel:
+    """one read of each table (DB-API connection, SQLite dialect of the portfolio tables)"""
+    cal = pd.read_sql("select closedate, previous_business_date from calendar order by closedate", conn)
+    cp = pd.read_sql("select closedate, ticker, closeprice from closeprices", conn)
+    pos = pd.read_sql("select closedate, ticker, quantity from positions", conn)
+    nav = pd.read_sql("select closedate, nav from nav order by closedate", conn)
+    pl = pd.read_sql("select closedate, pl from pl order by closedate", conn)
+    trades = pd.read_sql(
+        'select orderid, tradedate, ticker, "Action" as action, shares, tradeprice from trades', conn)
+
+    dates = pd.Index(pd.to_datetime(cal['closedate']))
+    tickers = pd.Index(np.sort(cp['ticker'].unique()))
+    prev_idx = dates.get_indexer(pd.to_datetime(cal['previous_business_date']))
+
+    # 最后一个价格日不一定在 calendar 里，单独取
+    cp_dates = pd.to_datetime(cp['closedate'])
+    last = cp.loc[cp_dates == cp_dates.max()]
+    last_prices = pd.Series(last['closeprice'].to_numpy(dtype=float), index=last['ticker'])
+
+    return PortfolioPanel(
+        dates=dates.to_numpy(dtype='datetime64[D]'),
+        tickers=tickers,
+        prices=_dense(cp, 'closeprice', dates, tickers),
+        prev_idx=prev_idx,
+        quantity=_dense(pos, 'quantity', dates, tickers),
+        nav=pd.Series(nav['nav'].to_numpy(dtype=float), index=pd.to_datetime(nav['closedate'])),
+        pl=pd.Series(pl['pl'].to_numpy(dtype=float), index=pd.to_datetime(pl['closedate'])),
+        trades=trades,
+        last_prices=last_prices,
+    )
+
+
+def _argmax_cell(score: np.ndarray) -> Optional[Tuple[int, int]]:
+    if np.all(np.isnan(score)):
+        return None
+    return np.unravel_index(np.nanargmax(score), score.shape)
+
+
+def compute_metrics(panel: PortfolioPanel, z_window: int = 90, vol_window: int = 30) -> Dict[str, object]:
+    """every metric of sql_drawdown&vol_analysis.sql from one set of aligned arrays"""
+    P, Q = panel.prices, panel.quantity
+    P_prev = panel.prev_prices
+    dates = panel.dates
+    out: Dict[str, object] = {}
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        returns = (P - P_prev) / P_prev
+        out['daily_returns'] = returns
+
+        # 组合日收益：pl / 前一自然日 nav
+        nav_dates = panel.nav.index.to_numpy(dtype='datetime64[D]')
+        pl_dates = panel.pl.index.to_numpy(dtype='datetime64[D]')
+        j = np.searchsorted(nav_dates, pl_dates - np.timedelta64(1, 'D')).clip(0, max(len(nav_dates) - 1, 0))
+        has_prev = (len(nav_dates) > 0) & (nav_dates[j] == pl_dates - np.timedelta64(1, 'D'))
+        port_ret = np.where(has_prev, panel.pl.to_numpy() / panel.nav.to_numpy()[j], np.nan)
+        if np.any(has_prev):
+            i = np.nanargmax(np.abs(port_ret))
+            out['largest_daily_move'] = (pd.Timestamp(pl_dates[i]), port_ret[i])
+
+        # 个股 PL 贡献
+        contrib = (P - P_prev) * Q
+        has_contrib = ~np.isnan(contrib)
+        ticker_pl = pd.Series(np.nansum(contrib, axis=0), index=panel.tickers)[has_contrib.any(axis=0)]
+        out['ticker_pl'] = ticker_pl.sort_values(ascending=False)
+
+        # 90 日 z-score
+        _, mean, var = rolling_moments(returns, z_window)
+        z = (returns - mean) / np.sqrt(var)
+        z[~(var > 0)] = np.nan
+        cell = _argmax_cell(np.abs(z))
+        if cell is not None:
+            d, t = cell
+            out['max_zscore'] = (pd.Timestamp(dates[d]), panel.tickers[t], returns[d, t], z[d, t])
+        out['zscore'] = z
+
+        # 30 日波动风险
+        _, _, var = rolling_moments(returns, vol_window)
+        std = np.sqrt(var)
+        risk = np.abs(Q * P * std)
+        cell = _argmax_cell(risk)
+        if cell is not None:
+            d, t = cell
+            out['max_risk'] = (pd.Timestamp(dates[d]), panel.tickers[t], Q[d, t], P[d, t], std[d, t], risk[d, t])
+
+        # 净 / 总 / 空头敞口
+        notional = Q * P
+        has_row = ~np.isnan(notional)
+        day_ok = has_row.any(axis=1)
+        exposure = pd.DataFrame({
+            'net_notional': np.nansum(notional, axis=1),
+            'gross_notional': np.nansum(np.abs(notional), axis=1),
+            'short_notional': np.nansum(np.where(Q < 0, np.abs(notional), 0.0), axis=1),
+        }, index=pd.DatetimeIndex(dates, name='closedate'))[day_ok]
+        out['exposure'] = exposure
+        if not exposure.empty:
+            out['avg_net_notional'] = exposure['net_notional'].mean()
+            out['avg_gross_notional'] = exposure['gross_notional'].mean()
+            out['max_short'] = (exposure['short_notional'].idxmax(), exposure['short_notional'].max())
+
+        # 组合月收益、滚动收益、最大回撤
+        nav = panel.nav.to_numpy()
+        if len(nav):
+            months = nav_dates.astype('datetime64[M]')
+            starts = np.flatnonzero(np.r_[True, months[1:] != months[:-1]])
+            ends = np.r_[starts[1:] - 1, len(nav) - 1]
+            out['monthly_returns'] = pd.Series(nav[ends] / nav[starts] - 1.0,
+                                               index=pd.PeriodIndex(months[starts], freq='M'))
+
+            def lagged(n):
+                lag = np.full(len(nav), np.nan)
+                lag[n:] = nav[:max(len(nav) - n, 0)]
+                return lag
+
+            out['rolling_returns'] = pd.DataFrame({
+                'ret_30d': nav / lagged(29) - 1.0,
+                'ret_90d': nav / lagged(89) - 1.0,
+            }, index=panel.nav.index)
+
+            peak = np.maximum.accumulate(nav)
+            dd = nav / peak - 1.0
+            i = int(np.argmin(dd))
+            out['max_drawdown'] = (panel.nav.index[i], nav[i], peak[i], dd[i])
+
+    # 按最后价格日估值的最好 / 最差交易
+    trades = panel.trades
+    last = panel.last_prices.reindex(trades['ticker']).to_numpy()
+    sign = np.where(trades['action'].str.lower() == 'sell', -1.0, 1.0)
+    pnl = (last - trades['tradeprice'].to_numpy(dtype=float)) * sign * trades['shares'].to_numpy(dtype=float)
+    valued = trades.assign(last_closeprice=last, trade_pnl=pnl).loc[~np.isnan(last)]
+    if not valued.empty:
+        out['best_trade'] = valued.loc[valued['trade_pnl'].idxmax()]
+        out['worst_trade'] = valued.loc[valued['trade_pnl'].idxmin()]
+    return out
+
+
+# sql_drawdown&vol_analysis.sql 中各问题的查询（SQLite），用于逐项对照
+_DAILY_RET = """
+    select cp.closedate, cp.ticker,
+        (cp.closeprice - cp_prev.closeprice) * 1.0 / cp_prev.closeprice as daily_return
+    from calendar c
+    join closeprices cp on cp.closedate = c.closedate
+    join closeprices cp_prev on cp_prev.ticker = cp.ticker and cp_prev.closedate = c.previous_business_date
+"""
+
+SQL_CHECKS = {
+    'largest_daily_move': """
+        select p.closedate, p.pl / n_prev.nav as daily_return
+        from pl p
+            inner join nav n_prev on n_prev.closedate = date(p.closedate, '-1 day')
+        order by abs(daily_return) desc
+        limit 1""",
+    'ticker_pl': """
+        select p.ticker, sum((cp.closeprice - cp_prev.closeprice) * p.quantity) as ticker_pl
+        from positions p
+            inner join calendar c on c.closedate = p.closedate
+            inner join closeprices cp_prev on cp_prev.closedate = c.previous_business_date and p.ticker = cp_prev.ticker
+            inner join closeprices cp on cp.closedate = c.closedate and cp.ticker = p.ticker
+        group by p.ticker""",
+    'max_zscore': f"""
+        with daily_ret as ({_DAILY_RET}),
+        w as (
+            select closedate, ticker, daily_return,
+                count(*) over win as cnt_90,
+                avg(daily_return) over win as mean_90,
+                avg(daily_return * daily_return) over win as mean_sq_90
+            from daily_ret
+            window win as (partition by ticker order by closedate rows between 89 preceding and current row)
+        )
+        select closedate, ticker, daily_return,
+            (daily_return - mean_90) / nullif(sqrt(mean_sq_90 - mean_90 * mean_90), 0) as z_score
+        from w
+        where cnt_90 >= 90
+        order by abs(z_score) desc
+        limit 1""",
+    'max_risk': f"""
+        with daily_ret as ({_DAILY_RET}),
+        w as (
+            select closedate, ticker,
+                count(*) over win as cnt_30,
+                avg(daily_return) over win as mean_30,
+                avg(daily_return * daily_return) over win as mean_sq_30
+            from daily_ret
+            window win as (partition by ticker order by closedate rows between 29 preceding and current row)
+        )
+        select p.closedate, p.ticker, p.quantity, cp.closeprice,
+            sqrt(w.mean_sq_30 - w.mean_30 * w.mean_30) as std_30,
+            abs(p.quantity * cp.closeprice * sqrt(w.mean_sq_30 - w.mean_30 * w.mean_30)) as risk_amount
+        from positions p
+            join closeprices cp on cp.closedate = p.closedate and cp.ticker = p.ticker
+            join w on w.closedate = p.closedate and w.ticker = p.ticker
+        where w.cnt_30 >= 30
+        order by risk_amount desc
+        limit 1""",
+    'exposure': """
+        select p.closedate,
+            sum(p.quantity * cp.closeprice) as net_notional,
+            sum(abs(p.quantity * cp.closeprice)) as gross_notional,
+            sum(case when p.quantity < 0 then abs(p.quantity * cp.closeprice) else 0 end) as short_notional
+        from positions p
+            join closeprices cp on cp.closedate = p.closedate and cp.ticker = p.ticker
+        group by p.closedate
+        order by p.closedate""",
+    'monthly_returns': """
+        with m as (
+            select strftime('%Y-%m', closedate) as ym, min(closedate) as s, max(closedate) as e
+            from nav group by strftime('%Y-%m', closedate)
+        )
+        select m.ym, ne.nav * 1.0 / ns.nav - 1.0 as monthly_return
+        from m join nav ns on ns.closedate = m.s join nav ne on ne.closedate = m.e
+        order by m.ym""",
+    'rolling_returns': """
+        select closedate,
+            (nav * 1.0 / lag(nav, 29) over (order by closedate) - 1.0) as ret_30d,
+            (nav * 1.0 / lag(nav, 89) over (order by closedate) - 1.0) as ret_90d
+        from nav order by closedate""",
+    'max_drawdown': """
+        with pk as (
+            select closedate, nav, max(nav) over (order by closedate rows between unbounded preceding and current row) as peak_nav
+            from nav
+        )
+        select closedate, nav, peak_nav, nav * 1.0 / peak_nav - 1.0 as drawdown
+        from pk order by drawdown limit 1""",
+    'trade_pnl': """
+        select t.orderid,
+            (cp.closeprice - t.tradeprice) * case when lower(t.action) = 'sell' then -t.shares else t.shares end as trade_pnl
+        from trades t
+            join closeprices cp on cp.ticker = t.ticker and cp.closedate = (select max(closedate) from closeprices)""",
+}
+
+
+def _close(a, b, rtol: float = 1e-6) -> bool:
+    a = np.asarray(a, dtype=float)
+    b = np.asarray(b, dtype=float)
+    return a.shape == b.shape and np.allclose(a, b, rtol=rtol, atol=1e-9, equal_nan=True)
+
+
+def validate_against_sql(conn, metrics: Dict[str, object]) -> Dict[str, bool]:
+    """run each SQL question and compare with the vectorized result; {metric: matches}"""
+    q = {name: pd.read_sql(sql, conn) for name, sql in SQL_CHECKS.items()}
+    ok = {}
+
+    ok['largest_daily_move'] = (q['largest_daily_move'].empty and 'largest_daily_move' not in metrics) or \
+        _close(abs(q['largest_daily_move']['daily_return'].iloc[0]), abs(metrics['largest_daily_move'][1]))
+
+    ref = q['ticker_pl'].set_index('ticker')['ticker_pl']
+    got = metrics['ticker_pl']
+    ok['ticker_pl'] = set(ref.index) == set(got.index) and _close(got.reindex(ref.index), ref)
+
+    # 并列时 limit 1 取哪一行不确定，比较目标值
+    ok['max_zscore'] = _close(abs(q['max_zscore']['z_score'].iloc[0]), abs(metrics['max_zscore'][3]))
+    ok['max_risk'] = _close(q['max_risk']['risk_amount'].iloc[0], metrics['max_risk'][5])
+
+    ref = q['exposure']
+    got = metrics['exposure']
+    ok['exposure'] = len(ref) == len(got) and all(
+        _close(got[c].to_numpy(), ref[c].to_numpy()) for c in ('net_notional', 'gross_notional', 'short_notional'))
+
+    ok['monthly_returns'] = _close(metrics['monthly_returns'].to_numpy(), q['monthly_returns']['monthly_return'])
+    ok['rolling_returns'] = all(
+        _close(metrics['rolling_returns'][c].to_numpy(), q['rolling_returns'][c].to_numpy())
+        for c in ('ret_30d', 'ret_90d'))
+    ok['max_drawdown'] = _close(q['max_drawdown']['drawdown'].iloc[0], metrics['max_drawdown'][3])
+
+    pnl = q['trade_pnl']['trade_pnl']
+    ok['best_worst_trade'] = _close([pnl.max(), pnl.min()],
+                                    [metrics['best_trade']['trade_pnl'], metrics['worst_trade']['trade_pnl']])
+    return ok
+
+
+def _synthetic_db(n_days: int = 400, n_tickers: int = 20, n_trades: int = 600) -> sqlite3.Connection:
+    from sql_portfolio_engine import PortfolioEngine, create_source_tables, synthetic_portfolio
+
+    conn = sqlite3.connect(":memory:")
+    create_source_tables(conn)
+    calendar, prices, trades = synthetic_portfolio(n_days, n_tickers, n_trades)
+    conn.executemany("insert into calendar values (?, ?)", calendar)
+    conn.executemany("insert into closeprices values (?, ?, ?)", prices)
+    conn.executemany("insert into trades values (?, ?, ?, ?, ?, ?)", trades)
+    conn.commit()
+    PortfolioEngine(conn).update()
+    return conn
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="向量化组合分析（对应 sql_drawdown&vol_analysis.sql）")
+    parser.add_argument("--db", help="SQLite 数据库文件；不指定则使用合成数据")
+    parser.add_argument("--check", action="store_true", help="与 SQL 查询结果逐项对照")
+    args = parser.parse_args()
+
+    conn = sqlite3.connect(args.db) if args.db else _synthetic_db()
+    metrics = compute_metrics(load_panel(conn))
+    for name in ('largest_daily_move', 'max_zscore', 'max_risk', 'max_short', 'max_drawdown'):
+        print(f"{name}: {metrics.get(name)}")
+    print(f"avg net / gross notional: {metrics.get('avg_net_notional')} / {metrics.get('avg_gross_notional')}")
+    print(metrics['ticker_pl'].head())
+
+    if args.check or not args.db:
+        result = validate_against_sql(conn, metrics)
+        for name, matches in result.items():
+            print(f"{'✅' if matches else '❌'} {name}")
+        assert all(result.values())
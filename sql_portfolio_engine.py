@@ -0,0 +1,271 @@
+"""
+Incremental positions / PL / NAV for the portfolio tables of sql_portfolio_management.sql
+(SQLite: calendar, trades, closeprices -> positions, pl, nav).
+
+The SQL version rebuilds everything with `trades t on t.tradedate <= c.closedate`
+(O(days x trades)) and a `pl pl1 join pl pl2 on pl1.closedate >= pl2.closedate`
+self-join (O(days^2)). This engine carries positions and the NAV as running sums,
+processes only calendar dates after the last materialized NAV (or from the
+earliest newly inserted back-dated trade) and writes just those rows.
+
+    python sql_portfolio_engine.py --db portfolio.sqlite3
+    python sql_portfolio_engine.py --check      # compare against the SQL on synthetic data
+"""
+import argparse
+import sqlite3
+from typing import Dict, List, Optional, Tuple
+
+starting_nav = 100000.0
+
+_STATE_DDL = """
+CREATE TABLE IF NOT EXISTS positions (closedate TEXT, ticker TEXT, quantity REAL);
+CREATE TABLE IF NOT EXISTS pl (closedate TEXT, pl REAL);
+CREATE TABLE IF NOT EXISTS nav (closedate TEXT, nav REAL);
+CREATE TABLE IF NOT EXISTS portfolio_processed_trades (orderid PRIMARY KEY);
+CREATE INDEX IF NOT EXISTS ix_positions_closedate ON positions (closedate);
+CREATE INDEX IF NOT EXISTS ix_pl_closedate ON pl (closedate);
+CREATE INDEX IF NOT EXISTS ix_nav_closedate ON nav (closedate);
+"""
+
+
+def _signed(action: str, shares: float) -> float:
+    return -shares if action == 'Sell' else shares
+
+
+class PortfolioEngine:
+    """
+    Maintains positions, pl and nav incrementally on a DB-API connection
+    (qmark parameters). Trades already folded in are recorded in
+    portfolio_processed_trades, so new or back-dated trades are detected
+    with one anti-join instead of re-reading the whole trades table.
+    """
+
+    def __init__(self, conn: sqlite3.Connection, starting_nav: float = starting_nav):
+        self.conn = conn
+        self.starting_nav = starting_nav
+        self.conn.executescript(_STATE_DDL)
+
+    def _scalar(self, sql: str, params: tuple = ()) -> Optional[str]:
+        row = self.conn.execute(sql, params).fetchone()
+        return row[0] if row else None
+
+    def _start_date(self) -> Optional[str]:
+        """first calendar date that has to be (re)materialized, or None if up to date"""
+        last_date = self._scalar("select max(closedate) from nav")
+        first_new_trade = self._scalar("""
+            select min(t.tradedate)
+            from trades t
+            where not exists (select 1 from portfolio_processed_trades p where p.orderid = t.orderid)
+        """)
+        if last_date is None:
+            return self._scalar("select min(closedate) from calendar")
+        if first_new_trade is not None and first_new_trade <= last_date:
+            # 补录了历史交易：从该交易日起回滚重算
+            return self._scalar("select min(closedate) from calendar where closedate >= ?", (first_new_trade,))
+        return self._scalar("select min(closedate) from calendar where closedate > ?", (last_date,))
+
+    def _seed(self, start: str) -> Tuple[Optional[str], Dict[str, float], float]:
+        """(previous calendar date, positions, cumulative PL) as of the day before start"""
+        prev_date = self._scalar("select max(closedate) from calendar where closedate < ?", (start,))
+        if prev_date is None:
+            return None, {}, 0.0
+        positions = dict(self.conn.execute(
+            "select ticker, quantity from positions where closedate = ?", (prev_date,)).fetchall())
+        prev_nav = self._scalar("select nav from nav where closedate = ?", (prev_date,))
+        cum_pl = (prev_nav - self.starting_nav) if prev_nav is not None else 0.0
+        return prev_date, positions, cum_pl
+
+    def update(self) -> int:
+        """materialize every missing calendar date; returns the number of dates written"""
+        start = self._start_date()
+        if start is None:
+            return 0
+
+        prev_date, positions, cum_pl = self._seed(start)
+        dates: List[Tuple[str, str]] = self.conn.execute("""
+            select closedate, previous_business_date
+            from calendar
+            where closedate >= ?
+            order by closedate
+        """, (start,)).fetchall()
+        last = dates[-1][0]
+
+        # 只读取本次窗口内的价格和交易
+        price_from = min([d for d, _ in dates] + [p for _, p in dates if p is not None])
+        prices = {(d, t): px for d, t, px in self.conn.execute(
+            "select closedate, ticker, closeprice from closeprices where closedate >= ? and closedate <= ?",
+            (price_from, last))}
+        trades = self.conn.execute("""
+            select orderid, tradedate, ticker, "Action", shares, tradeprice
+            from trades
+            where (? is null or tradedate > ?) and tradedate <= ?
+            order by tradedate
+        """, (prev_date, prev_date, last)).fetchall()
+
+        pos_rows, pl_rows, nav_rows = [], [], []
+        i = 0
+        for closedate, prev_bd in dates:
+            trade_pl = 0.0
+            while i < len(trades) and trades[i][1] <= closedate:
+                _, tradedate, ticker, action, shares, tradeprice = trades[i]
+                qty = _signed(action, shares)
+                positions[ticker] = positions.get(ticker, 0) + qty
+                px = prices.get((tradedate, ticker))
+                if tradedate == closedate and px is not None:
+                    trade_pl += (px - tradeprice) * qty
+                i += 1
+
+            position_pl = 0.0
+            for ticker, qty in positions.items():
+                pos_rows.append((closedate, ticker, qty))
+                px, px_prev = prices.get((closedate, ticker)), prices.get((prev_bd, ticker))
+                if px is not None and px_prev is not None:
+                    position_pl += (px - px_prev) * qty
+
+            pl = position_pl + trade_pl
+            cum_pl += pl
+            pl_rows.append((closedate, pl))
+            nav_rows.append((closedate, cum_pl + self.starting_nav))
+
+        with self.conn:
+            for table in ('positions', 'pl', 'nav'):
+                self.conn.execute(f"delete from {table} where closedate >= ?", (start,))
+            self.conn.executemany("insert into positions (closedate, ticker, quantity) values (?, ?, ?)", pos_rows)
+            self.conn.executemany("insert into pl (closedate, pl) values (?, ?)", pl_rows)
+            self.conn.executemany("insert into nav (closedate, nav) values (?, ?)", nav_rows)
+            self.conn.executemany("insert or ignore into portfolio_processed_trades (orderid) values (?)",
+                                  [(t[0],) for t in trades])
+        return len(dates)
+
+
+# sql_portfolio_management.sql 中的全量重建语句，仅用于 --check 对照
+_FULL_REBUILD_SQL = """
+insert into ref_positions (closedate, ticker, quantity)
+select c.closedate, t.ticker,
+    sum(case when t."Action" = 'Sell' then -t.shares else t.shares end)
+from calendar c
+    inner join trades t on t.tradedate <= c.closedate
+group by c.closedate, t.ticker;
+
+insert into ref_pl (closedate, pl)
+with position_pl as (
+    select p.closedate, sum((cp.closeprice - cp_prev.closeprice) * p.quantity) as position_pl
+    from ref_positions p
+        inner join calendar c on c.closedate = p.closedate
+        inner join closeprices cp_prev on cp_prev.closedate = c.previous_business_date and p.ticker = cp_prev.ticker
+        inner join closeprices cp on cp.closedate = p.closedate and cp.ticker = p.ticker
+    group by p.closedate
+),
+trade_pl as (
+    select t.tradedate, sum((cp.closeprice - t.tradeprice)
+        * case when t."Action" = 'Sell' then -t.shares else t.shares end) as trade_pl
+    from trades t
+        inner join closeprices cp on cp.closedate = t.tradedate and cp.ticker = t.ticker
+    group by t.tradedate
+)
+select c.closedate, ifnull(p.position_pl, 0) + ifnull(t.trade_pl, 0)
+from calendar c
+    left join position_pl p on p.closedate = c.closedate
+    left join trade_pl t on t.tradedate = c.closedate;
+
+insert into ref_nav (closedate, nav)
+select pl1.closedate, sum(pl2.pl) + 100000
+from ref_pl pl1
+    left join ref_pl pl2 on pl1.closedate >= pl2.closedate
+group by pl1.closedate;
+"""
+
+
+def synthetic_portfolio(n_days: int, n_tickers: int, n_trades: int, seed: int = 0) -> Tuple[list, list, list]:
+    """(calendar, closeprices, trades) rows of a random business-day portfolio, ~2% prices missing"""
+    import random
+    from datetime import date, timedelta
+
+    rng = random.Random(seed)
+    days, d = [], date(2022, 1, 3)
+    while len(days) < n_days:
+        if d.weekday() < 5:
+            days.append(d.isoformat())
+        d += timedelta(days=1)
+    tickers = [f"T{k:02d}" for k in range(n_tickers)]
+    price = {t: rng.uniform(20, 200) for t in tickers}
+    calendar, prices = [], []
+    for k, day in enumerate(days):
+        calendar.append((day, days[k - 1] if k else None))
+        for t in tickers:
+            price[t] *= 1 + rng.gauss(0, 0.02)
+            if rng.random() > 0.02:          # 偶尔缺价，检验 inner join 语义
+                prices.append((day, t, round(price[t], 4)))
+    trades = [(k, rng.choice(days), rng.choice(tickers), rng.choice(['Buy', 'Sell']),
+               float(rng.randint(1, 50) * 10), round(rng.uniform(20, 200), 4)) for k in range(n_trades)]
+    trades.sort(key=lambda t: t[1])
+    return calendar, prices, trades
+
+
+def create_source_tables(conn: sqlite3.Connection) -> None:
+    conn.executescript("""
+        create table calendar (closedate TEXT, previous_business_date TEXT);
+        create table closeprices (closedate TEXT, ticker TEXT, closeprice REAL);
+        create table trades (orderid INTEGER, tradedate TEXT, ticker TEXT, "Action" TEXT, shares REAL, tradeprice REAL);
+    """)
+
+
+def _self_check(n_days: int = 400, n_tickers: int = 20, n_trades: int = 600, seed: int = 0) -> None:
+    """
+    Synthetic calendar / prices / trades fed to the engine in three increments
+    (including a back-dated trade), compared row by row with the SQL rebuild.
+    """
+    conn = sqlite3.connect(":memory:")
+    create_source_tables(conn)
+    conn.executescript("""
+        create table ref_positions (closedate TEXT, ticker TEXT, quantity REAL);
+        create table ref_pl (closedate TEXT, pl REAL);
+        create table ref_nav (closedate TEXT, nav REAL);
+    """)
+    calendar, prices, trades = synthetic_portfolio(n_days, n_tickers, n_trades, seed)
+    days = [d for d, _ in calendar]
+    tickers = sorted({p[1] for p in prices})
+
+    engine = PortfolioEngine(conn)
+    cuts = [n_days // 3, 2 * n_days // 3, n_days]
+    loaded_days = 0
+    for cut in cuts:
+        conn.executemany("insert into calendar values (?, ?)", calendar[loaded_days:cut])
+        conn.executemany("insert into closeprices values (?, ?, ?)",
+                         [p for p in prices if days[loaded_days] <= p[0] <= days[cut - 1]])
+        conn.executemany("insert into trades values (?, ?, ?, ?, ?, ?)",
+                         [t for t in trades if days[loaded_days] <= t[1] <= days[cut - 1]])
+        if cut == cuts[1]:
+            # 补录一笔历史交易，触发回滚重算
+            conn.execute("insert into trades values (?, ?, ?, ?, ?, ?)",
+                         (n_trades, days[10], tickers[0], 'Buy', 100.0, 50.0))
+        conn.commit()
+        written = engine.update()
+        print(f"increment up to {days[cut - 1]}: {written} dates written")
+        loaded_days = cut
+    assert engine.update() == 0
+
+    conn.executescript(_FULL_REBUILD_SQL)
+    for table, cols in (('nav', 'closedate, nav'), ('pl', 'closedate, pl'),
+                        ('positions', 'closedate, ticker, quantity')):
+        got = conn.execute(f"select {cols} from {table} order by {cols}").fetchall()
+        ref = conn.execute(f"select {cols} from ref_{table} order by {cols}").fetchall()
+        assert len(got) == len(ref), (table, len(got), len(ref))
+        for a, b in zip(got, ref):
+            assert a[:-1] == b[:-1] and abs(a[-1] - b[-1]) < 1e-6 * max(1.0, abs(b[-1])), (table, a, b)
+        print(f"{table}: {len(got)} rows match the SQL rebuild")
+    print("✅ portfolio engine self-check passed")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="增量维护 positions / pl / nav")
+    parser.add_argument("--db", help="SQLite 数据库文件（含 calendar / trades / closeprices）")
+    parser.add_argument("--check", action="store_true", help="在合成数据上与 SQL 全量重建结果对照")
+    args = parser.parse_args()
+
+    if args.check or not args.db:
+        _self_check()
+    else:
+        with sqlite3.connect(args.db) as conn:
+            n = PortfolioEngine(conn).update()
+        print(f"✅ 写入 {n} 个交易日的 positions / pl / nav")
@@ -72,6 +72,7 @@ order by AVG(cp.ClosePrice / cp_prev.ClosePrice - 1) desc
 
 ------------------------------------------------------------------------------------------------
 --Table Creation
+-- (full rebuild; for daily updates sql_portfolio_engine.py maintains positions / PL / NAV incrementally)
 
 
 
@@ -0,0 +1,166 @@
+import argparse
+
+from sql_pyodbc_akshare_universe import sse_prefixes, szse_prefixes
+from sql_pyodbc_pool import ConnectionPool, get_pool
+from sql_pyodbc_schema import Column, TableSchema
+
+conn_str = 'DSN,UID,PWD'
+
+# 每个除权除息事件一行；cum_factor 为截至该事件的累计后复权因子
+adj_factor_schema = TableSchema('adj_factor', [
+    Column('symbol',             'VARCHAR(10)',  nullable=False),   # 带交易所前缀，与 stock_a_daily 一致
+    Column('ex_date',            'DATE',         nullable=False),
+    Column('cash_dividend',      'DECIMAL(9,4)'),                   # 每股派现
+    Column('bonus_ratio',        'DECIMAL(9,4)'),                   # 每股送转股数
+    Column('prev_close',         'DECIMAL(9,4)'),                   # 除权日前一交易日收盘；NULL 表示尚未定价
+    Column('event_factor',       'FLOAT',        nullable=False),
+    Column('cum_factor',         'FLOAT',        nullable=False),
+    Column('source_update_time', 'DATETIME',     nullable=False),   # 对应 stock_dividend_new.update_time
+    Column('update_time',        'DATETIME',     nullable=False, default='GETDATE()'),
+], primary_key=['symbol', 'ex_date'])
+
+
+def _exchange_case(code: str) -> str:
+    """T-SQL: bare code -> exchange-prefixed symbol, same rule as sql_pyodbc_akshare_universe.add_prefix"""
+    sh = ", ".join(f"'{p}'" for p in sorted(sse_prefixes))
+    sz = ", ".join(f"'{p}'" for p in sorted(szse_prefixes))
+    return (f"CASE WHEN LEFT({code}, 3) IN ({sh}) THEN 'sh' + {code} "
+            f"WHEN LEFT({code}, 3) IN ({sz}) THEN 'sz' + {code} END")
+
+
+# 事件因子 = 前收盘 × (1 + 送转) / (前收盘 − 派现)，即 前收盘 / 除权参考价；
+# 事件在除权日当天或之后已有成交时才定价，否则记 1.0，待行情到达后重算
+REFRESH_SQL = f"""
+SET NOCOUNT ON;
+DECLARE @full BIT = ?;
+DECLARE @since DATETIME = (SELECT MAX(source_update_time) FROM dbo.adj_factor);
+
+IF OBJECT_ID('tempdb..#affected') IS NOT NULL DROP TABLE #affected;
+CREATE TABLE #affected (symbol VARCHAR(10) PRIMARY KEY, code VARCHAR(10) NOT NULL);
+
+-- 新增 / 修改过的分红事件所在股票，以及行情补齐后可以定价的事件所在股票
+INSERT INTO #affected (symbol, code)
+SELECT symbol, code FROM (
+    SELECT DISTINCT {_exchange_case('dv.symbol')} AS symbol, dv.symbol AS code
+    FROM dbo.stock_dividend_new dv
+    WHERE @full = 1 OR @since IS NULL OR dv.update_time > @since
+    UNION
+    SELECT a.symbol, SUBSTRING(a.symbol, 3, 8)
+    FROM dbo.adj_factor a
+    WHERE a.prev_close IS NULL
+      AND EXISTS (SELECT 1 FROM dbo.stock_a_daily d WHERE d.symbol = a.symbol AND d.trade_date >= a.ex_date)
+      AND EXISTS (SELECT 1 FROM dbo.stock_a_daily d WHERE d.symbol = a.symbol AND d.trade_date < a.ex_date)
+) s
+WHERE symbol IS NOT NULL;
+
+DELETE a FROM dbo.adj_factor a JOIN #affected x ON x.symbol = a.symbol;
+
+WITH ev AS (
+    SELECT x.symbol, dv.ex_dividend_date AS ex_date,
+        ISNULL(dv.cash_dividend, 0) AS cash_dividend,
+        COALESCE(dv.total_bonus_split, ISNULL(dv.bonus_share, 0) + ISNULL(dv.split_share, 0)) AS bonus_ratio,
+        dv.update_time AS source_update_time
+    FROM dbo.stock_dividend_new dv
+    JOIN #affected x ON x.code = dv.symbol
+),
+priced AS (
+    SELECT ev.*,
+        CASE WHEN EXISTS (SELECT 1 FROM dbo.stock_a_daily d WHERE d.symbol = ev.symbol AND d.trade_date >= ev.ex_date)
+             THEN pc.prev_close END AS prev_close
+    FROM ev
+    OUTER APPLY (
+        SELECT TOP 1 d.[close] AS prev_close
+        FROM dbo.stock_a_daily d
+        WHERE d.symbol = ev.symbol AND d.trade_date < ev.ex_date
+        ORDER BY d.trade_date DESC
+    ) pc
+    WHERE ev.cash_dividend > 0 OR ev.bonus_ratio > 0
+),
+factored AS (
+    SELECT priced.*,
+        CASE WHEN prev_close IS NULL THEN 1.0
+             WHEN prev_close > cash_dividend
+                THEN CAST(prev_close AS FLOAT) * (1 + bonus_ratio) / (prev_close - cash_dividend)
+             ELSE 1.0 + bonus_ratio END AS event_factor
+    FROM priced
+)
+INSERT INTO dbo.adj_factor
+    (symbol, ex_date, cash_dividend, bonus_ratio, prev_close, event_factor, cum_factor, source_update_time, update_time)
+SELECT symbol, ex_date, cash_dividend, bonus_ratio, prev_close, event_factor,
+    EXP(SUM(LOG(event_factor)) OVER (PARTITION BY symbol ORDER BY ex_date ROWS UNBOUNDED PRECEDING)),
+    source_update_time, GETDATE()
+FROM factored;
+
+SELECT (SELECT COUNT(*) FROM #affected), (SELECT COUNT(*) FROM dbo.adj_factor a JOIN #affected x ON x.symbol = a.symbol);
+"""
+
+# 按 (symbol, trade_date) 取行情，再各按主键 seek 一次当日和最新的累计因子
+# adj_factor：后复权因子（历史不变）；fwd_factor：前复权因子（最新一天为 1）
+ADJUSTED_VIEW_SQL = """
+CREATE VIEW dbo.adjusted_daily AS
+SELECT
+    d.symbol, d.trade_date,
+    d.[open], d.high, d.low, d.[close], d.volume, d.amount, d.turnover,
+    ISNULL(f.cum_factor, 1.0) AS adj_factor,
+    ISNULL(f.cum_factor, 1.0) / ISNULL(l.cum_factor, 1.0) AS fwd_factor,
+    d.[open]  * ISNULL(f.cum_factor, 1.0) AS open_hfq,
+    d.high    * ISNULL(f.cum_factor, 1.0) AS high_hfq,
+    d.low     * ISNULL(f.cum_factor, 1.0) AS low_hfq,
+    d.[close] * ISNULL(f.cum_factor, 1.0) AS close_hfq,
+    d.[close] * ISNULL(f.cum_factor, 1.0) / ISNULL(l.cum_factor, 1.0) AS close_qfq
+FROM dbo.stock_a_daily d
+OUTER APPLY (
+    SELECT TOP 1 a.cum_factor FROM dbo.adj_factor a
+    WHERE a.symbol = d.symbol AND a.ex_date <= d.trade_date
+    ORDER BY a.ex_date DESC
+) f
+OUTER APPLY (
+    SELECT TOP 1 a.cum_factor FROM dbo.adj_factor a
+    WHERE a.symbol = d.symbol
+    ORDER BY a.ex_date DESC
+) l;
+"""
+
+
+def create_adjusted_view(pool: ConnectionPool) -> None:
+    pool.run(lambda conn: conn.cursor().execute(adj_factor_schema.ddl()))
+    # CREATE VIEW 必须单独成批
+    pool.run(lambda conn: conn.cursor().execute(
+        "IF OBJECT_ID(N'dbo.adjusted_daily', 'V') IS NOT NULL DROP VIEW dbo.adjusted_daily;"))
+    pool.run(lambda conn: conn.cursor().execute(ADJUSTED_VIEW_SQL))
+
+
+def refresh_adj_factor(pool: ConnectionPool, full: bool = False) -> int:
+    """
+    Recompute adj_factor for symbols whose dividend events changed since the
+    last refresh (stock_dividend_new.update_time past the stored watermark),
+    plus symbols with events that could not be priced before; full=True
+    recomputes every symbol. Returns the number of symbols recomputed.
+    """
+    def exists(conn, table):
+        return conn.cursor().execute(f"SELECT OBJECT_ID(N'dbo.{table}', 'U')").fetchone()[0] is not None
+
+    if not pool.run(lambda conn: exists(conn, 'stock_dividend_new') and exists(conn, 'stock_a_daily')):
+        print("⚠️ stock_dividend_new 或 stock_a_daily 不存在，跳过复权因子计算")
+        return 0
+
+    pool.run(lambda conn: conn.cursor().execute(adj_factor_schema.ddl()))
+    n_symbols, n_events = pool.run(lambda conn: conn.cursor().execute(REFRESH_SQL, (1 if full else 0,)).fetchone())
+    print(f"✔️ 复权因子：重算 {n_symbols} 只股票，{n_events} 个除权除息事件")
+    return n_symbols
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="由 stock_dividend_new 计算复权因子 adj_factor 和视图 adjusted_daily")
+    parser.add_argument("--full", action="store_true", help="全部股票重算（默认只重算有新事件的股票）")
+    parser.add_argument("--create-view", action="store_true", help="创建 / 重建 adjusted_daily 视图")
+    args = parser.parse_args()
+
+    pool = get_pool(conn_str)
+    try:
+        refresh_adj_factor(pool, full=args.full)
+        if args.create_view:
+            create_adjusted_view(pool)
+            print("✔️ 视图 [adjusted_daily] 创建成功")
+    finally:
+        pool.close()
@@ -0,0 +1,163 @@
+import hashlib
+import json
+import os
+import time
+from datetime import datetime
+from typing import Any, Callable, Dict, Optional, Union
+
+import pandas as pd
+
+try:
+    import pyarrow  # noqa: F401  (to_parquet / read_parquet 的引擎)
+    _HAS_PARQUET = True
+except ImportError:
+    _HAS_PARQUET = False
+
+raw_cache_dir = "akshare_raw_cache"
+
+
+def _report_date_ttl(date: str) -> Optional[float]:
+    # 一年以前的报告期已定稿，永不过期；近期报告期方案进度仍在变化
+    age_days = (datetime.today() - datetime.strptime(date, "%Y%m%d")).days
+    return None if age_days > 365 else 24
+
+
+# 每个接口的过期时间（小时）；None 表示永不过期；可为按参数计算的函数
+# （按日期的历史序列走 fetch_series，今天以前的行不过期）
+endpoint_ttl_hours: Dict[str, Union[float, None, Callable[..., Optional[float]]]] = {
+    "stock_value_em":       12,
+    "stock_a_indicator_lg": 12,
+    "stock_market_pb_lg":   12,
+    "stock_fhps_em":        _report_date_ttl,
+}
+
+
+class RawCache:
+    """
+    Content-addressed on-disk cache of raw AkShare responses, stored as
+    {root}/{dataset}/{partition}/{sha1(dataset, args)}.parquet, where the
+    partition is the symbol or report date. Fresh entries (per-endpoint TTL)
+    are served from disk, so rebuilding a table after a DDL change is local I/O.
+    Date-indexed histories use fetch_series: one growing file per partition.
+    """
+
+    def __init__(self, root: str = raw_cache_dir, enabled: bool = True, refresh: bool = False):
+        self.root = root
+        self.enabled = enabled and _HAS_PARQUET
+        self.refresh = refresh
+        self.hits = 0
+        self.misses = 0
+        if enabled and not _HAS_PARQUET:
+            print("⚠️ 未安装 pyarrow，原始数据缓存已关闭")
+
+    def path_for(self, dataset: str, partition: Optional[str], *args, **kwargs) -> str:
+        key = json.dumps([dataset, args, sorted(kwargs.items())], default=str, ensure_ascii=False)
+        digest = hashlib.sha1(key.encode("utf-8")).hexdigest()
+        return os.path.join(self.root, dataset, str(partition or "_all"), f"{digest}.parquet")
+
+    def _ttl_hours(self, dataset: str, *args, **kwargs) -> Optional[float]:
+        ttl = endpoint_ttl_hours.get(dataset, 12)
+        return ttl(*args, **kwargs) if callable(ttl) else ttl
+
+    def fetch(
+        self,
+        dataset: str,
+        fn: Callable[..., pd.DataFrame],
+        *args: Any,
+        partition: Optional[str] = None,
+        **kwargs: Any
+    ) -> pd.DataFrame:
+        """fn(*args, **kwargs), served from the cache while the entry is fresh"""
+        if not self.enabled:
+            return fn(*args, **kwargs)
+
+        path = self.path_for(dataset, partition, *args, **kwargs)
+        if not self.refresh and os.path.exists(path):
+            ttl = self._ttl_hours(dataset, *args, **kwargs)
+            age_hours = (time.time() - os.path.getmtime(path)) / 3600
+            if ttl is None or age_hours < ttl:
+                self.hits += 1
+                return pd.read_parquet(path)
+
+        self.misses += 1
+        df = fn(*args, **kwargs)
+        if isinstance(df, pd.DataFrame):
+            self._write(path, df)
+        return df
+
+    def fetch_series(
+        self,
+        dataset: str,
+        fn: Callable[[str], pd.DataFrame],
+        partition: str,
+        since: str,
+        first: str,
+        date_column: str = "date"
+    ) -> pd.DataFrame:
+        """
+        Rows of the history fn(start) dated on / after `since`. One file per
+        partition holds the history from `first`; its rows dated before the
+        day the file was written are final and served without TTL, and each
+        call only requests the tail from the last final day and appends it. Without a cached history an
+        incremental call (since > first) goes straight to fn and is not cached.
+        """
+        if not self.enabled:
+            return fn(since)
+
+        path = self.path_for(dataset, partition, partition, first)
+        cached = None
+        if not self.refresh and os.path.exists(path):
+            # 写入当天及以后的行可能是盘中数据，只有更早的行算定稿
+            written = pd.Timestamp(datetime.fromtimestamp(os.path.getmtime(path)).date())
+            cached = pd.read_parquet(path)
+            cached = cached[pd.to_datetime(cached[date_column]) < written]
+        if cached is None and since > first:
+            self.misses += 1
+            return fn(since)
+
+        if cached is not None and not cached.empty:
+            self.hits += 1
+            tail_start = (pd.to_datetime(cached[date_column]).max() + pd.Timedelta(days=1)).strftime("%Y-%m-%d")
+        else:
+            self.misses += 1
+            tail_start = first
+        tail = fn(tail_start)
+        frames = [f for f in (cached, tail) if isinstance(f, pd.DataFrame) and not f.empty]
+        if not frames:
+            return tail
+        df = pd.concat(frames, ignore_index=True) if len(frames) > 1 else frames[0].reset_index(drop=True)
+        df = df.drop_duplicates(date_column, keep="last")
+        self._write(path, df)
+        # 旧版按 since 分键写下的增量文件不会再被读取，顺手清理
+        for name in os.listdir(os.path.dirname(path)):
+            if name.endswith(".parquet") and name != os.path.basename(path):
+                os.remove(os.path.join(os.path.dirname(path), name))
+        return df[pd.to_datetime(df[date_column]) >= pd.Timestamp(since)]
+
+    def _write(self, path: str, df: pd.DataFrame) -> None:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        try:
+            df.to_parquet(tmp_path)
+            os.replace(tmp_path, path)
+        except Exception as e:
+            # 混合类型列等无法写 Parquet 时只跳过缓存，不影响本次入库
+            print(f"⚠️ 缓存写入失败 {path}: {e}")
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+
+raw_cache = RawCache()
+
+
+def add_cache_args(parser) -> None:
+    """shared --no-cache / --refresh-cache flags for loader CLIs"""
+    parser.add_argument("--no-cache", action="store_true",
+                        help="不读写本地原始数据缓存，直接请求 AkShare")
+    parser.add_argument("--refresh-cache", action="store_true",
+                        help="忽略已缓存数据重新请求，并覆盖缓存")
+
+
+def configure_cache(no_cache: bool = False, refresh_cache: bool = False) -> None:
+    raw_cache.enabled = raw_cache.enabled and not no_cache
+    raw_cache.refresh = refresh_cache
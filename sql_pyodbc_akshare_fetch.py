@@ -0,0 +1,292 @@
+import functools
+import json
+import random
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from typing import Any, Callable, Dict, Iterable, Iterator, Optional, Tuple
+
+try:
+    import requests  # akshare 的 HTTP 客户端
+    _REQUESTS_ERRORS: Tuple[type, ...] = (requests.ConnectionError, requests.Timeout,
+                                          requests.exceptions.ChunkedEncodingError)
+except ImportError:
+    requests = None
+    _REQUESTS_ERRORS = ()
+
+_DONE = object()
+
+
+def is_throttled(exc: BaseException) -> bool:
+    """
+    True for failures worth retrying more slowly: network errors, HTTP 429 /
+    5xx, and a truncated or HTML (rate-limit page) body that fails JSON
+    decoding. A KeyError / ValueError from an unknown or delisted symbol or an
+    unexpected frame is deterministic and is not.
+    """
+    if isinstance(exc, (json.JSONDecodeError, ConnectionError, TimeoutError) + _REQUESTS_ERRORS):
+        return True
+    if requests is not None and isinstance(exc, requests.HTTPError) and exc.response is not None:
+        return exc.response.status_code == 429 or exc.response.status_code >= 500
+    return False
+
+
+class TokenBucket:
+    """thread-safe token bucket: `rate` tokens per second, bursts up to `capacity`"""
+
+    def __init__(self, rate: float, capacity: Optional[float] = None):
+        if rate <= 0:
+            raise ValueError("rate must be positive")
+        self.rate = float(rate)
+        self.capacity = float(capacity) if capacity is not None else max(1.0, self.rate)
+        self._tokens = self.capacity
+        self._last = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self, tokens: float = 1.0) -> None:
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.capacity, self._tokens + (now - self._last) * self.rate)
+                self._last = now
+                if self._tokens >= tokens:
+                    self._tokens -= tokens
+                    return
+                wait_s = (tokens - self._tokens) / self.rate
+            time.sleep(wait_s)
+
+    def set_rate(self, rate: float) -> None:
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.capacity, self._tokens + (now - self._last) * self.rate)
+            self._last = now
+            self.rate = float(rate)
+
+
+def fetch_concurrently(
+    keys: Iterable[Any],
+    fetch_fn: Callable[[Any], Any],
+    max_workers: int = 8,
+    rate: float = 10.0,
+    capacity: Optional[float] = None,
+) -> Iterator[Tuple[Any, Any, Optional[BaseException]]]:
+    """
+    Run fetch_fn(key) on a bounded thread pool, throttled by a shared token bucket.
+    Yields (key, result, error) in completion order; at most 2 * max_workers
+    results are in flight, so a slow consumer (the DB writer) applies backpressure.
+    """
+    bucket = TokenBucket(rate, capacity)
+
+    def _task(key):
+        bucket.acquire()
+        return fetch_fn(key)
+
+    keys = iter(keys)
+    max_in_flight = max(1, 2 * max_workers)
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        pending = {}
+        for key in keys:
+            pending[pool.submit(_task, key)] = key
+            if len(pending) >= max_in_flight:
+                break
+
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for fut in done:
+                key = pending.pop(fut)
+                err = fut.exception()
+                yield key, (None if err else fut.result()), err
+                nxt = next(keys, _DONE)
+                if nxt is not _DONE:
+                    pending[pool.submit(_task, nxt)] = nxt
+
+
+class EndpointStats:
+    """per-endpoint counters and recent latencies (seconds) of a FetchClient"""
+
+    def __init__(self, window: int = 1000):
+        self.attempts = 0
+        self.successes = 0
+        self.failures = 0       # 重试用尽后放弃的调用
+        self.retries = 0
+        self.latencies = deque(maxlen=window)
+        self.total_latency = 0.0
+
+    def snapshot(self, rate: float) -> dict:
+        lat = sorted(self.latencies)
+
+        def pct(q):
+            return lat[min(len(lat) - 1, int(q * len(lat)))] if lat else None
+
+        return {
+            "attempts": self.attempts,
+            "successes": self.successes,
+            "failures": self.failures,
+            "retries": self.retries,
+            "mean_latency": self.total_latency / self.attempts if self.attempts else None,
+            "p50_latency": pct(0.50),
+            "p95_latency": pct(0.95),
+            "rate": rate,
+        }
+
+
+class CircuitBreaker:
+    """
+    Opens after `threshold` consecutive failures (any endpoint) and blocks every
+    caller until the cooldown has passed. The first failure after reopening
+    trips it again with a doubled cooldown (up to max_cooldown).
+    """
+
+    def __init__(self, threshold: int = 10, cooldown: float = 30.0, max_cooldown: float = 600.0):
+        self.threshold = threshold
+        self.base_cooldown = cooldown
+        self.max_cooldown = max_cooldown
+        self._cooldown = cooldown
+        self._failures = 0
+        self._open_until = 0.0
+        self._half_open = False
+        self._lock = threading.Lock()
+        self.trips = 0
+
+    def wait(self) -> None:
+        while True:
+            with self._lock:
+                remaining = self._open_until - time.monotonic()
+            if remaining <= 0:
+                return
+            time.sleep(min(remaining, 1.0))
+
+    def record_success(self) -> None:
+        with self._lock:
+            self._failures = 0
+            self._half_open = False
+            self._cooldown = self.base_cooldown
+
+    def record_failure(self) -> None:
+        with self._lock:
+            self._failures += 1
+            if self._failures < self.threshold and not self._half_open:
+                return
+            if time.monotonic() < self._open_until:
+                return
+            self._open_until = time.monotonic() + self._cooldown
+            self.trips += 1
+            print(f"⛔ 连续 {self._failures} 次请求失败，暂停全部抓取 {self._cooldown:.0f} 秒")
+            self._cooldown = min(self.max_cooldown, self._cooldown * 2)
+            self._failures = 0
+            self._half_open = True
+
+
+class FetchClient:
+    """
+    Shared AkShare call wrapper used by every loader:
+    - exponential backoff with jitter between attempts,
+    - a token bucket per endpoint whose rate halves on each error and
+      creeps back up on successes (AIMD), so throttled endpoints slow down,
+    - one circuit breaker that pauses the whole fetch pool on a failure streak,
+    - per-endpoint attempts / retries / latency metrics (metrics(), report()).
+    Only errors accepted by transient_fn (default is_throttled) are retried
+    and feed the rate and the breaker; anything else is raised at once.
+    """
+
+    def __init__(
+        self,
+        max_attempts: int = 5,
+        base_delay: float = 1.0,
+        max_delay: float = 60.0,
+        rate: float = 10.0,
+        min_rate: float = 0.2,
+        breaker_threshold: int = 10,
+        breaker_cooldown: float = 30.0,
+        transient_fn: Callable[[BaseException], bool] = is_throttled,
+    ):
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.rate = rate
+        self.min_rate = min_rate
+        self.breaker = CircuitBreaker(breaker_threshold, breaker_cooldown)
+        self.transient_fn = transient_fn
+        self._buckets: Dict[str, TokenBucket] = {}
+        self._stats: Dict[str, EndpointStats] = {}
+        self._lock = threading.Lock()
+
+    def _endpoint(self, endpoint: str) -> Tuple[TokenBucket, EndpointStats]:
+        with self._lock:
+            if endpoint not in self._buckets:
+                self._buckets[endpoint] = TokenBucket(self.rate)
+                self._stats[endpoint] = EndpointStats()
+            return self._buckets[endpoint], self._stats[endpoint]
+
+    def backoff(self, attempt: int) -> float:
+        """delay before retry number `attempt` (1-based): half fixed, half random"""
+        cap = min(self.max_delay, self.base_delay * 2 ** (attempt - 1))
+        return cap / 2 + random.uniform(0, cap / 2)
+
+    def call(self, endpoint: str, fn: Callable[..., Any], *args: Any, **kwargs: Any) -> Any:
+        bucket, stats = self._endpoint(endpoint)
+        for attempt in range(1, self.max_attempts + 1):
+            self.breaker.wait()
+            bucket.acquire()
+            t0 = time.monotonic()
+            try:
+                result = fn(*args, **kwargs)
+            except Exception as e:
+                elapsed = time.monotonic() - t0
+                # 确定性错误（代码不存在、已退市、返回格式不符）重试也没用，不降速、不计入熔断
+                transient = self.transient_fn(e)
+                with self._lock:
+                    stats.attempts += 1
+                    stats.latencies.append(elapsed)
+                    stats.total_latency += elapsed
+                    if transient:
+                        bucket.set_rate(max(self.min_rate, bucket.rate / 2))
+                    if not transient or attempt == self.max_attempts:
+                        stats.failures += 1
+                    else:
+                        stats.retries += 1
+                if not transient:
+                    raise
+                self.breaker.record_failure()
+                if attempt == self.max_attempts:
+                    raise
+                time.sleep(self.backoff(attempt))
+            else:
+                elapsed = time.monotonic() - t0
+                with self._lock:
+                    stats.attempts += 1
+                    stats.successes += 1
+                    stats.latencies.append(elapsed)
+                    stats.total_latency += elapsed
+                    if bucket.rate < self.rate:
+                        bucket.set_rate(min(self.rate, bucket.rate + self.rate / 50))
+                self.breaker.record_success()
+                return result
+
+    def wrap(self, endpoint: str, fn: Callable[..., Any]) -> Callable[..., Any]:
+        """fn routed through call(), e.g. as the fetch function handed to RawCache"""
+        @functools.wraps(fn)
+        def _wrapped(*args, **kwargs):
+            return self.call(endpoint, fn, *args, **kwargs)
+        return _wrapped
+
+    def metrics(self) -> Dict[str, dict]:
+        with self._lock:
+            return {name: stats.snapshot(self._buckets[name].rate) for name, stats in self._stats.items()}
+
+    def export_metrics(self, path: str) -> None:
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump({"breaker_trips": self.breaker.trips, "endpoints": self.metrics()}, f, indent=2)
+
+    def report(self) -> None:
+        for name, m in self.metrics().items():
+            mean = f"{m['mean_latency']:.2f}s" if m['mean_latency'] is not None else "-"
+            p95 = f"{m['p95_latency']:.2f}s" if m['p95_latency'] is not None else "-"
+            print(f"📊 {name}: 请求 {m['attempts']} 次，成功 {m['successes']}，重试 {m['retries']}，"
+                  f"放弃 {m['failures']}，平均耗时 {mean}，p95 {p95}，当前限速 {m['rate']:.1f}/s")
+        if self.breaker.trips:
+            print(f"📊 熔断触发 {self.breaker.trips} 次")
+
+
+fetch_client = FetchClient()
@@ -1,7 +1,27 @@
 import akshare as ak
-import pyodbc
 import pandas as pd
+import argparse
 from datetime import datetime
+from sql_pyodbc_schema import TableSchema, Column, add_storage_args, configure_storage
+from sql_pyodbc_akshare_cache import raw_cache
+from sql_pyodbc_akshare_fetch import fetch_client
+from sql_pyodbc_pool import get_pool
+
+market_index_schema = TableSchema('market_index', [
+    Column('trade_date',  'DATE',           nullable=False),
+    Column('market',      'VARCHAR(10)',    nullable=False),
+    Column('index_value', 'DECIMAL(10,2)'),
+    Column('pb',          'DECIMAL(10,4)'),
+    Column('pb_weighted', 'DECIMAL(10,4)'),
+    Column('pb_median',   'DECIMAL(10,4)'),
+    Column('update_time', 'DATETIME',       nullable=False, default='GETDATE()'),
+], primary_key=['trade_date', 'market'])
+
+parser = argparse.ArgumentParser(description="AkShare 市场市净率 (stock_market_pb_lg) → SQL Server market_index")
+add_storage_args(parser)
+args = parser.parse_args()
+# 表每次重建，存储选项在新建时生效
+configure_storage(market_index_schema, args)
 
 # Step 1: Fetch PB data for all 4 indices
 index_map = {
@@ -14,7 +34,8 @@ index_map = {
 df_list = []
 
 for cn_name, en_code in index_map.items():
-    df = ak.stock_market_pb_lg(symbol=cn_name)
+    df = raw_cache.fetch('stock_market_pb_lg', fetch_client.wrap('stock_market_pb_lg', ak.stock_market_pb_lg),
+                         symbol=cn_name, partition=en_code)
     df.columns = [
         'trade_date',         
         'index_value',        
@@ -29,55 +50,27 @@ for cn_name, en_code in index_map.items():
 df_all = pd.concat(df_list, ignore_index=True)
 df_all['trade_date'] = pd.to_datetime(df_all['trade_date'])
 
-# Step 3: Connect to SQL Server
-conn = pyodbc.connect('DSN,UID,PWD')
-cursor = conn.cursor()
+# Step 3: Connect to SQL Server (pooled, reconnects and replays on dropped connections)
+pool = get_pool('DSN,UID,PWD')
 
 # Step 4: Create the market_index table
-create_table_sql = """
-IF OBJECT_ID('market_index', 'U') IS NOT NULL
-    DROP TABLE market_index;
-
-CREATE TABLE market_index (
-    trade_date     DATE           NOT NULL,
-    market         VARCHAR(10)    NOT NULL,
-    index_value    DECIMAL(10, 2) NULL,
-    pb             DECIMAL(10, 4) NULL,
-    pb_weighted    DECIMAL(10, 4) NULL,
-    pb_median      DECIMAL(10, 4) NULL,
-    update_time    DATETIME       NOT NULL DEFAULT GETDATE(),
-    PRIMARY KEY (trade_date, market)
-)
-"""
-cursor.execute(create_table_sql)
-conn.commit()
+create_table_sql = market_index_schema.drop_sql() + market_index_schema.ddl()
+pool.run(lambda conn: conn.cursor().execute(create_table_sql))
 
 # Step 5: Prepare and insert data
-insert_sql = """
-INSERT INTO market_index (trade_date, market, index_value, pb, pb_weighted, pb_median, update_time)
-VALUES (?, ?, ?, ?, ?, ?, ?)
-"""
+insert_sql = market_index_schema.insert_sql()
 
-now = datetime.now()
-data = [
-    (
-        row.trade_date.date(),
-        row.market,
-        row.index_value,
-        row.pb,
-        row.pb_weighted,
-        row.pb_median,
-        now
-    )
-    for _, row in df_all.iterrows()
-]
+df_all['update_time'] = datetime.now()
+df_all, rejected = market_index_schema.coerce(df_all)
+if not rejected.empty:
+    print(f"⚠️ Rejected {len(rejected)} out-of-range rows, first: {rejected['reject_reason'].iloc[0]}")
+data = market_index_schema.to_params(df_all)
 
-cursor.executemany(insert_sql, data)
-conn.commit()
+if data:
+    pool.run(lambda conn: conn.cursor().executemany(insert_sql, data))
 
 print(f"✅ Inserted {len(data)} rows into [market_index].")
 
 # Step 6: Cleanup
-cursor.close()
-conn.close()
+pool.close()
 
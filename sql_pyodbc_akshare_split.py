@@ -1,186 +1,192 @@
 import akshare as ak
-import pyodbc
 import pandas as pd
+import argparse
 from datetime import datetime
+from sql_pyodbc_upsert import BadRowsError, BulkUpserter
+from sql_pyodbc_pipeline import BatchingWriter, run_pipeline
+from sql_pyodbc_schema import TableSchema, Column
+from sql_pyodbc_akshare_cache import raw_cache
+from sql_pyodbc_akshare_fetch import fetch_client
+from sql_pyodbc_pool import get_pool
+from sql_pyodbc_adj_factor import refresh_adj_factor
 
 
 DSN = 'DSN,UID,PWD'
+fetch_workers       = 8       # 并发拉取的报告期数
+requests_per_second = 5.0     # 令牌桶限速
+transform_workers   = 4       # 清洗进程数，0 表示在线程内清洗
+commit_rows         = 50000   # 攒够多少行合并写库一次
+commit_seconds      = 10.0    # 或距上次写库超过多少秒
+
+DIVIDEND_SCHEMA = TableSchema('stock_dividend_new', [
+    Column('symbol',               'VARCHAR(10)',  nullable=False),
+    Column('ex_dividend_date',     'DATE',         nullable=False),
+    Column('name',                 'VARCHAR(100)'),
+    Column('total_bonus_split',    'DECIMAL(9,4)'),
+    Column('bonus_share',          'DECIMAL(9,4)'),
+    Column('split_share',          'DECIMAL(9,4)'),
+    Column('cash_dividend',        'DECIMAL(9,4)'),
+    Column('dividend_yield',       'DECIMAL(9,4)'),
+    Column('eps',                  'DECIMAL(9,4)'),
+    Column('bps',                  'DECIMAL(9,4)'),
+    Column('capital_reserve',      'DECIMAL(9,4)'),
+    Column('undistributed_profit', 'DECIMAL(9,4)'),
+    Column('net_profit_growth',    'DECIMAL(9,4)'),
+    Column('total_shares',         'BIGINT'),
+    Column('proposal_date',        'DATE'),
+    Column('record_date',          'DATE'),
+    Column('progress',             'VARCHAR(50)'),
+    Column('latest_announcement',  'DATE'),
+    Column('update_time',          'DATETIME',     nullable=False),
+], primary_key=['symbol', 'ex_dividend_date'], pk_name='PK_stock_dividend')
+KEY_COLUMNS = DIVIDEND_SCHEMA.primary_key
+DATE_COLUMNS = DIVIDEND_SCHEMA.date_columns
 
 def create_table_if_not_exists():
     """create new table"""
-    conn = pyodbc.connect(DSN)
-    cursor = conn.cursor()
-    create_sql = """
-    IF NOT EXISTS (SELECT * FROM sys.tables WHERE name = 'stock_dividend_new')
-    CREATE TABLE stock_dividend_new (
-        symbol                  VARCHAR(10)      NOT NULL,
-        ex_dividend_date        DATE             NOT NULL,
-        name                    VARCHAR(100)     NULL,
-        total_bonus_split       DECIMAL(9,4)     NULL,
-        bonus_share             DECIMAL(9,4)     NULL,
-        split_share             DECIMAL(9,4)     NULL,
-        cash_dividend           DECIMAL(9,4)     NULL,
-        dividend_yield          DECIMAL(9,4)     NULL,
-        eps                     DECIMAL(9,4)     NULL,
-        bps                     DECIMAL(9,4)     NULL,
-        capital_reserve         DECIMAL(9,4)     NULL,
-        undistributed_profit    DECIMAL(9,4)     NULL,
-        net_profit_growth       DECIMAL(9,4)     NULL,
-        total_shares            BIGINT           NULL,
-        proposal_date           DATE             NULL,
-        record_date             DATE             NULL,
-        progress                VARCHAR(50)      NULL,
-        latest_announcement     DATE             NULL,
-        update_time             DATETIME         NOT NULL,
-        CONSTRAINT PK_stock_dividend PRIMARY KEY (symbol, ex_dividend_date)
-    )
+    create_sql = DIVIDEND_SCHEMA.ddl()
+    get_pool(DSN).run(lambda conn: conn.cursor().execute(create_sql))
+
+def upsert_rows(conn, records, label=""):
+    """MERGE via the connection's own #temp stage (rebuilt after a reconnect)"""
+    upserter = conn.session(DIVIDEND_SCHEMA.name, lambda: BulkUpserter(
+        conn, DIVIDEND_SCHEMA.name, DIVIDEND_SCHEMA.column_names, KEY_COLUMNS))
+    return upserter.upsert(records, label=label)
+
+def fetch_report_date(date_str: str) -> pd.DataFrame:
+    # 已定稿的历史报告期直接读本地 Parquet 缓存
+    return raw_cache.fetch('stock_fhps_em', fetch_client.wrap('stock_fhps_em', ak.stock_fhps_em),
+                           date=date_str, partition=date_str)
+
+def transform_dividend(date_str: str, df: pd.DataFrame) -> list:
+    """清洗一个报告期的分红送转截面（在进程池中执行），返回 upsert 参数"""
+    if df is None or df.empty:
+        print(f"  {date_str} 无有效数据，跳过")
+        return []
+
+    # 数据清洗（关键步骤：转换为每股数据）
+    df_clean = df.rename(columns={
+        '代码': 'symbol',
+        '名称': 'name',
+        '送转股份-送转总比例': 'total_bonus_split',
+        '送转股份-送转比例': 'bonus_share',
+        '送转股份-转股比例': 'split_share',
+        '现金分红-现金分红比例': 'cash_dividend',
+        '现金分红-股息率': 'dividend_yield',
+        '每股收益': 'eps',
+        '每股净资产': 'bps',
+        '每股公积金': 'capital_reserve',
+        '每股未分配利润': 'undistributed_profit',
+        '净利润同比增长': 'net_profit_growth',
+        '总股本': 'total_shares',
+        '预案公告日': 'proposal_date',
+        '股权登记日': 'record_date',
+        '除权除息日': 'ex_dividend_date',
+        '方案进度': 'progress',
+        '最新公告日期': 'latest_announcement'
+    })
+
+    # 关键处理：将每10股数据转换为每股（除以10）
+    ratio_cols = ['total_bonus_split', 'bonus_share', 'split_share', 'cash_dividend']
+    df_clean[ratio_cols] = df_clean[ratio_cols].apply(pd.to_numeric, errors='coerce') / 10
+
+    # 日期字段转换（字符串转DATE）
+    for col in DATE_COLUMNS:
+        df_clean[col] = pd.to_datetime(df_clean[col], errors='coerce')
+
+    # 添加更新时间
+    df_clean['update_time'] = datetime.now()
+
+    # 主键缺失的行无法入库；同一主键保留最后一条，避免 MERGE 重复匹配
+    df_clean = df_clean.dropna(subset=KEY_COLUMNS)
+    df_clean = df_clean.drop_duplicates(subset=KEY_COLUMNS, keep='last')
+
+    # 整列向量化：按表定义小数位取整，越界行（如 DECIMAL(9,4) 放不下的增长率）整批剔除
+    df_clean, rejected = DIVIDEND_SCHEMA.coerce(df_clean)
+    if not rejected.empty:
+        print(f"  {date_str} 剔除 {len(rejected)} 行越界数据，首条：{rejected['reject_reason'].iloc[0]}")
+    return DIVIDEND_SCHEMA.to_params(df_clean)
+
+def dedupe_latest(records: list) -> list:
+    """
+    Several report dates flushed together can carry the same (symbol,
+    ex_dividend_date); keep the row with the latest announcement so one MERGE
+    never matches a target row twice, whatever order the dates finished in.
     """
-    cursor.execute(create_sql)
-    conn.commit()
-    cursor.close()
-    conn.close()
+    key_idx = [DIVIDEND_SCHEMA.column_names.index(c) for c in KEY_COLUMNS]
+    ann_idx = DIVIDEND_SCHEMA.column_names.index('latest_announcement')
+    latest = {}
+    for row in sorted(records, key=lambda r: (r[ann_idx] is not None, r[ann_idx] or datetime.min.date())):
+        latest[tuple(row[i] for i in key_idx)] = row
+    return list(latest.values())
 
-def process_and_insert_data():
+def process_and_insert_data(
+    workers: int = fetch_workers,
+    transform_workers: int = transform_workers
+):
     """insert 2009-2025 data"""
     # 生成所有需要查询的日期（每年0630和1231）
     query_dates = [f"{year}{month}" for year in range(2009, 2026) for month in ['0630', '1231']]
-    
-    # 连接数据库
-    conn = pyodbc.connect(DSN)
-    cursor = conn.cursor()
-    
-    total_dates = len(query_dates)
-    success_count = 0
-    fail_count = 0
-
-    for idx, date_str in enumerate(query_dates):
-        try:
-            print(f"[{datetime.now()}] 处理第 {idx+1}/{total_dates} 个日期：{date_str}")
-            
-            # 获取AkShare数据
-            df = ak.stock_fhps_em(date=date_str)
-            if df is None or df.empty:
-                print(f"  无有效数据，跳过")
-                continue
-            
-            # 数据清洗（关键步骤：转换为每股数据）
-            df_clean = df.rename(columns={
-                '代码': 'symbol',
-                '名称': 'name',
-                '送转股份-送转总比例': 'total_bonus_split',
-                '送转股份-送转比例': 'bonus_share',
-                '送转股份-转股比例': 'split_share',
-                '现金分红-现金分红比例': 'cash_dividend',
-                '现金分红-股息率': 'dividend_yield',
-                '每股收益': 'eps',
-                '每股净资产': 'bps',
-                '每股公积金': 'capital_reserve',
-                '每股未分配利润': 'undistributed_profit',
-                '净利润同比增长': 'net_profit_growth',
-                '总股本': 'total_shares',
-                '预案公告日': 'proposal_date',
-                '股权登记日': 'record_date',
-                '除权除息日': 'ex_dividend_date',
-                '方案进度': 'progress',
-                '最新公告日期': 'latest_announcement'
-            })
-
-            # 关键处理：将每10股数据转换为每股（除以10）
-            ratio_cols = ['total_bonus_split', 'bonus_share', 'split_share', 'cash_dividend']
-            df_clean[ratio_cols] = df_clean[ratio_cols].apply(pd.to_numeric, errors='coerce') / 10
-
-            # 日期字段转换（字符串转DATE）
-            date_cols = ['proposal_date', 'record_date', 'ex_dividend_date', 'latest_announcement']
-            for col in date_cols:
-                df_clean[col] = pd.to_datetime(df_clean[col], errors='coerce').dt.date
-
-            # 添加更新时间
-            df_clean['update_time'] = datetime.now()
-
-            # 插入数据库（使用MERGE避免重复）
-            merge_sql = """
-            MERGE INTO stock_dividend_new AS t
-            USING (VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?))  
-                AS s (symbol, ex_dividend_date, name, total_bonus_split, bonus_share, split_share, 
-                      cash_dividend, dividend_yield, eps, bps, capital_reserve, undistributed_profit, 
-                      net_profit_growth, total_shares, proposal_date, record_date, progress, latest_announcement, update_time)
-            ON t.symbol = s.symbol AND t.ex_dividend_date = s.ex_dividend_date
-            WHEN MATCHED THEN
-                UPDATE SET 
-                    name = s.name,
-                    total_bonus_split = s.total_bonus_split,
-                    bonus_share = s.bonus_share,
-                    split_share = s.split_share,
-                    cash_dividend = s.cash_dividend,
-                    dividend_yield = s.dividend_yield,
-                    eps = s.eps,
-                    bps = s.bps,
-                    capital_reserve = s.capital_reserve,
-                    undistributed_profit = s.undistributed_profit,
-                    net_profit_growth = s.net_profit_growth,
-                    total_shares = s.total_shares,
-                    proposal_date = s.proposal_date,
-                    record_date = s.record_date,
-                    progress = s.progress,
-                    latest_announcement = s.latest_announcement,
-                    update_time = s.update_time
-            WHEN NOT MATCHED THEN
-                INSERT (
-                    symbol, ex_dividend_date, name, total_bonus_split, bonus_share, split_share, 
-                    cash_dividend, dividend_yield, eps, bps, capital_reserve, undistributed_profit, 
-                    net_profit_growth, total_shares, proposal_date, record_date, progress, latest_announcement, update_time
-                )
-                VALUES (
-                    s.symbol, s.ex_dividend_date, s.name, s.total_bonus_split, s.bonus_share, s.split_share, 
-                    s.cash_dividend, s.dividend_yield, s.eps, s.bps, s.capital_reserve, s.undistributed_profit, 
-                    s.net_profit_growth, s.total_shares, s.proposal_date, s.record_date, s.progress, s.latest_announcement, s.update_time
-                );
-            """
-
-            # 逐行插入（处理大数据量建议用批量插入，这里为清晰用逐行）
-            row_count = 0
-            for _, row in df_clean.iterrows():
-                try:
-                    values = (
-                        row['symbol'],
-                        row['ex_dividend_date'],
-                        row['name'] if pd.notna(row['name']) else None,
-                        row['total_bonus_split'] if pd.notna(row['total_bonus_split']) else None,
-                        row['bonus_share'] if pd.notna(row['bonus_share']) else None,
-                        row['split_share'] if pd.notna(row['split_share']) else None,
-                        row['cash_dividend'] if pd.notna(row['cash_dividend']) else None,
-                        row['dividend_yield'] if pd.notna(row['dividend_yield']) else None,
-                        row['eps'] if pd.notna(row['eps']) else None,
-                        row['bps'] if pd.notna(row['bps']) else None,
-                        row['capital_reserve'] if pd.notna(row['capital_reserve']) else None,
-                        row['undistributed_profit'] if pd.notna(row['undistributed_profit']) else None,
-                        row['net_profit_growth'] if pd.notna(row['net_profit_growth']) else None,
-                        row['total_shares'] if pd.notna(row['total_shares']) else None,
-                        row['proposal_date'] if pd.notna(row['proposal_date']) else None,
-                        row['record_date'] if pd.notna(row['record_date']) else None,
-                        row['progress'] if pd.notna(row['progress']) else None,
-                        row['latest_announcement'] if pd.notna(row['latest_announcement']) else None,
-                        row['update_time']
-                    )
-                    cursor.execute(merge_sql, values)
-                    row_count += 1
-                except Exception as e:
-                    print(f"  行插入失败：{e}")
-                    fail_count += 1
-
-            conn.commit()
-            success_count += row_count
-            print(f"  成功插入 {row_count} 行，累计成功 {success_count} 行，失败 {fail_count} 行")
-
-        except Exception as e:
-            print(f"  日期 {date_str} 处理失败：{e}")
-            fail_count += 1
-            continue
-
-    cursor.close()
-    conn.close()
-    print(f"[{datetime.now()}] 全部处理完成！总成功：{success_count}，总失败：{fail_count}")
+    print(f"[{datetime.now()}] 并发拉取 {len(query_dates)} 个报告期（{workers} 线程，{transform_workers} 个清洗进程）")
+
+    # 共享连接池：连接断开时自动重连并重放当前批次
+    pool = get_pool(DSN)
+    totals = {'inserted': 0, 'updated': 0, 'failed': 0, 'dates': 0}
+
+    def write_rows(rows):
+        # 批量暂存到临时表后一次性 MERGE，坏行通过二分定位
+        result = pool.run(upsert_rows, dedupe_latest(rows), label="")
+        totals['inserted'] += result.inserted
+        totals['updated'] += result.updated
+        print(f"  写库 {len(rows)} 行：新增 {result.inserted} 行，更新 {result.updated} 行，坏行 {len(result.bad_rows)} 行，"
+              f"累计新增 {totals['inserted']} 行，累计更新 {totals['updated']} 行")
+        # 含坏行的报告期不能算完成：抛出后按报告期逐个重放，只有它进入 on_failed
+        if result.bad_rows:
+            raise BadRowsError(result.bad_rows)
+
+    def on_committed(date_str, n_rows):
+        totals['dates'] += 1
+        print(f"[{datetime.now()}] {date_str} 完成（{totals['dates']}/{len(query_dates)}），{n_rows} 行")
+
+    def on_failed(date_str, err):
+        print(f"  日期 {date_str} 处理失败：{err}")
+        totals['failed'] += 1
+
+    # 报告期之间互相独立：抓取（线程池）→ 清洗（进程池）→ 单一写库线程攒批 upsert，
+    # 总耗时取决于最慢的一个报告期，而不是所有报告期之和
+    writer = BatchingWriter(
+        write_fn=write_rows,
+        # upsert 每 batch_size 行各自提交，这里无从回滚；失败后的重放（连接池重连、按 key 逐个重放）
+        # 依赖 MERGE 幂等：已提交的批次再 MERGE 一次不会重复插入
+        commit_fn=lambda: None,
+        rollback_fn=lambda: None,
+        flush_rows=commit_rows,
+        flush_seconds=commit_seconds,
+        on_committed=on_committed,
+        on_failed=on_failed,
+    )
+    run_pipeline(
+        query_dates,
+        fetch_fn=fetch_report_date,
+        transform_fn=transform_dividend,
+        writer=writer,
+        fetch_workers=workers,
+        rate=requests_per_second,
+        transform_workers=transform_workers,
+    )
+
+    # 新到的除权除息事件：只重算受影响股票的复权因子
+    refresh_adj_factor(pool)
+    pool.close()
+    fetch_client.report()
+    print(f"[{datetime.now()}] 全部处理完成！总新增：{totals['inserted']}，总更新：{totals['updated']}，失败报告期：{totals['failed']} 个")
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="AkShare 分红送转 → SQL Server")
+    parser.add_argument("--workers", type=int, default=fetch_workers,
+                        help="并发拉取的报告期数")
+    parser.add_argument("--transform-workers", type=int, default=transform_workers,
+                        help="清洗进程数，0 表示不启用进程池")
+    args = parser.parse_args()
     create_table_if_not_exists()
-    process_and_insert_data()
+    process_and_insert_data(workers=args.workers, transform_workers=args.transform_workers)
@@ -2,177 +2,191 @@ import akshare as ak
 import pyodbc
 import pandas as pd
 from datetime import datetime
-import time
-from tenacity import retry, stop_after_attempt, wait_fixed
-from json import JSONDecodeError
+import argparse
+from sql_pyodbc_upsert import BadRowsError, BulkUpserter
+from sql_pyodbc_pipeline import BatchingWriter, run_pipeline
+from sql_pyodbc_akshare_fetch import fetch_client
+from sql_pyodbc_akshare_cache import raw_cache, add_cache_args, configure_cache
+from sql_pyodbc_akshare_universe import load_symbols
+from sql_pyodbc_schema import TableSchema, Column, add_storage_args, configure_storage
+from sql_pyodbc_checkpoint import CheckpointStore, add_checkpoint_args, default_checkpoint_path
+from sql_pyodbc_pool import get_pool
+from sql_pyodbc_bulkload import InitialLoad, add_initial_load_args
 
 
 conn_str   = 'DSN,UID,PWD'
 table_name = "stock_a_share_cap"           
+fetch_workers       = 8       # 并发抓取线程数
+requests_per_second = 10.0    # 令牌桶限速
+transform_workers   = 4       # pandas 清洗进程数
+commit_rows         = 50000   # 攒够多少行合并写库一次
+commit_seconds      = 10.0    # 或距上次写库超过多少秒
+
+# 表结构只声明一次：DDL、取整到 DECIMAL 小数位、越界检查都由它生成
+cap_schema = TableSchema(table_name, [
+    Column('symbol',         'VARCHAR(10)',   nullable=False),
+    Column('data_date',      'DATE',          nullable=False),
+    Column('close',          'DECIMAL(15,4)'),
+    Column('change_pct',     'DECIMAL(15,6)'),
+    Column('total_mv',       'DECIMAL(20,2)'),
+    Column('circulating_mv', 'DECIMAL(20,2)'),
+    Column('total_share',    'DECIMAL(38,0)'),
+    Column('float_share',    'DECIMAL(38,0)'),
+    Column('pe_ttm',         'DECIMAL(15,4)'),
+    Column('pe_static',      'DECIMAL(15,4)'),
+    Column('pb',             'DECIMAL(15,4)'),
+    Column('peg',            'DECIMAL(15,4)'),
+    Column('pcf',            'DECIMAL(15,4)'),
+    Column('ps',             'DECIMAL(15,4)'),
+    Column('update_time',    'DATETIME',      nullable=False),
+], primary_key=['symbol', 'data_date'])
+
+
+def fetch_share_cap_remote(code: str) -> pd.DataFrame:
+    return fetch_client.call('stock_value_em', ak.stock_value_em, symbol=code)
 
-
-@retry(stop=stop_after_attempt(3), wait=wait_fixed(1))
 def fetch_share_cap(code: str) -> pd.DataFrame:
-    return ak.stock_value_em(symbol=code)
-
-def main():
+    return raw_cache.fetch('stock_value_em', fetch_share_cap_remote, code, partition=code)
+
+def transform_share_cap(symbol: str, df: pd.DataFrame) -> list:
+    """清洗一只股票的股本市值数据（在进程池中执行），返回 upsert 参数"""
+    if df is None or df.empty:
+        return []
+
+    # —— 重命名列 —— 
+    df = df.rename(columns={
+        '数据日期':   'data_date',
+        '当日收盘价': 'close',
+        '当日涨跌幅': 'change_pct',
+        '总市值':     'total_mv',
+        '流通市值':   'circulating_mv',
+        '总股本':     'total_share',
+        '流通股本':   'float_share',
+        'PE(TTM)':   'pe_ttm',
+        'PE(静)':    'pe_static',
+        '市净率':     'pb',
+        'PEG值':     'peg',
+        '市现率':     'pcf',
+        '市销率':     'ps',
+    })
+
+    df['data_date']      = pd.to_datetime(df['data_date']).dt.date
+    df['symbol']         = symbol
+    df['update_time']    = datetime.now()
+    df = df.drop_duplicates(subset=['data_date'], keep='last')
+
+    # —— 整列向量化：非法字符 → NaN、按表定义小数位取整、越界行整批剔除 —— 
+    df, rejected = cap_schema.coerce(df)
+    if not rejected.empty:
+        print(f"⚠️ {symbol} 剔除 {len(rejected)} 条越界数据，"
+              f"首条: {rejected['reject_reason'].iloc[0]}")
+    return cap_schema.to_params(df)
+
+def main(
+    refresh_universe: bool = False,
+    run_id: str = None,
+    retry_failed: bool = False,
+    checkpoint_path: str = default_checkpoint_path,
+    initial_load: bool = False
+):
+    checkpoint = CheckpointStore(table_name, run_id=run_id, path=checkpoint_path)
+    # 1. 共享连接池：连接断开时自动重连并重放当前事务
+    pool = get_pool(conn_str)
     try:
-        # 1. 连接数据库
-        with pyodbc.connect(conn_str) as conn:
-            cursor = conn.cursor()
-            cursor.fast_executemany = True
-            print("✔️ 数据库连接成功")
-
-            # 2. 建表（若不存在），并确保列精度足够大
-            ddl = f"""
-IF OBJECT_ID(N'dbo.{table_name}', 'U') IS NULL
-BEGIN
-    CREATE TABLE dbo.{table_name} (
-        symbol          VARCHAR(10)    NOT NULL,
-        data_date       DATE           NOT NULL,
-        [close]         DECIMAL(15,4)  NULL,
-        change_pct      DECIMAL(15,6)  NULL,
-        total_mv        DECIMAL(20,2)  NULL,
-        circulating_mv  DECIMAL(20,2)  NULL,
-        total_share     DECIMAL(38,0)  NULL,
-        float_share     DECIMAL(38,0)  NULL,
-        pe_ttm          DECIMAL(15,4)  NULL,
-        pe_static       DECIMAL(15,4)  NULL,
-        pb              DECIMAL(15,4)  NULL,
-        peg             DECIMAL(15,4)  NULL,
-        pcf             DECIMAL(15,4)  NULL,
-        ps              DECIMAL(15,4)  NULL,
-        update_time     DATETIME       NOT NULL,
-        CONSTRAINT PK_{table_name} PRIMARY KEY(symbol, data_date)
-    );
-END
-"""
-            cursor.execute(ddl)
-            conn.commit()
-            print(f"✔️ 表 [{table_name}] 创建/检查成功")
-
-            # 3. 若已存在，再确保股本列最大精度
-            for col in ('total_share', 'float_share'):
-                try:
-                    cursor.execute(f"""
-ALTER TABLE dbo.{table_name}
-ALTER COLUMN {col} DECIMAL(38,0) NULL;
-""")
-                    conn.commit()
-                except:
-                    pass
-
-            # 4. 获取所有 A 股代码
-            try:
-                stock_df = ak.stock_info_a_code_name()
-            except JSONDecodeError:
-                time.sleep(0.5)
-                stock_df = ak.stock_info_a_code_name()
-            codes = stock_df['code'].astype(str).tolist()
-
-            sse_prefixes  = {"600","601","603","605","688","689"}
-            szse_prefixes = {"000","001","002","003","300","301"}
-
-            symbols = []
-            for c in codes:
-                if any(c.startswith(p) for p in sse_prefixes):
-                    symbols.append(f"sh{c}")
-                elif any(c.startswith(p) for p in szse_prefixes):
-                    symbols.append(f"sz{c}")
-            print(f"✔️ 共获取 {len(symbols)} 只沪深 A 股")
-
-            # 5. 抓取并入库
-            failed = []
-            for symbol in symbols:
-                code = symbol[2:]
-                try:
-                    df = fetch_share_cap(code)
-                    if df is None or df.empty:
-                        print(f"⚠️ {symbol} 无数据，跳过")
-                        continue
-
-                    # —— 重命名列 —— 
-                    df = df.rename(columns={
-                        '数据日期':   'data_date',
-                        '当日收盘价': 'close',
-                        '当日涨跌幅': 'change_pct',
-                        '总市值':     'total_mv',
-                        '流通市值':   'circulating_mv',
-                        '总股本':     'total_share',
-                        '流通股本':   'float_share',
-                        'PE(TTM)':   'pe_ttm',
-                        'PE(静)':    'pe_static',
-                        '市净率':     'pb',
-                        'PEG值':     'peg',
-                        '市现率':     'pcf',
-                        '市销率':     'ps',
-                    })
-
-                    # —— 强制数值 & round —— 
-                    numeric_cols = [
-                        'close','change_pct','total_mv','circulating_mv',
-                        'total_share','float_share','pe_ttm','pe_static',
-                        'pb','peg','pcf','ps'
-                    ]
-                    # 非法字符变 NaN
-                    for col in numeric_cols:
-                        df[col] = pd.to_numeric(df[col], errors='coerce')
-
-                    # 四舍五入到表定义小数位
-                    df['close']          = df['close'].round(4)
-                    df['change_pct']     = df['change_pct'].round(6)
-                    df['total_mv']       = df['total_mv'].round(2)
-                    df['circulating_mv'] = df['circulating_mv'].round(2)
-                    df['pe_ttm']         = df['pe_ttm'].round(4)
-                    df['pe_static']      = df['pe_static'].round(4)
-                    df['pb']             = df['pb'].round(4)
-                    df['peg']            = df['peg'].round(4)
-                    df['pcf']            = df['pcf'].round(4)
-                    df['ps']             = df['ps'].round(4)
-
-                    # 股本列转整数
-                    df['total_share']    = df['total_share'].round().astype('Int64')
-                    df['float_share']    = df['float_share'].round().astype('Int64')
-
-                    # NaN → None
-                    df = df.where(pd.notnull(df), None)
-
-                    df['data_date']      = pd.to_datetime(df['data_date']).dt.date
-                    df['symbol']         = symbol
-                    df['update_time']    = datetime.now()
-
-                    cols = [
-                        'symbol','data_date','close','change_pct',
-                        'total_mv','circulating_mv','total_share','float_share',
-                        'pe_ttm','pe_static','pb','peg','pcf','ps','update_time'
-                    ]
-                    df = df[cols]
-
-                    # —— 插入数据库 —— 
-                    col_list = ', '.join('[close]' if c=='close' else c for c in cols)
-                    placeholders = ', '.join('?' for _ in cols)
-                    insert_sql = f"INSERT dbo.{table_name} ({col_list}) VALUES ({placeholders})"
-
-                    records = [tuple(row) for row in df.values]
-                    cursor.executemany(insert_sql, records)
-                    conn.commit()
-                    print(f"✅ {symbol} 插入 {len(df)} 条")
-                    time.sleep(0.1)
-
-                except Exception as e:
-                    print(f"❌ {symbol} 失败: {e}")
-                    conn.rollback()
-                    failed.append(symbol)
-
-            if failed:
-                print("以下股票重试后仍失败：", failed)
+        # 2. 建表（若不存在）；股本列按 cap_schema 声明为 DECIMAL(38,0)
+        pool.run(lambda conn: conn.cursor().execute(cap_schema.ddl()))
+        print("✔️ 数据库连接成功")
+        print(f"✔️ 表 [{table_name}] 创建/检查成功")
+
+        # 3. 获取所有 A 股代码（共享股票池缓存）
+        symbols = load_symbols(refresh=refresh_universe)
+        print(f"✔️ 共获取 {len(symbols)} 只沪深 A 股")
+
+        # 临时表暂存 + MERGE，重跑只更新有变化的行；#temp 表随连接存在，每条连接各建一个
+        def upsert_rows(conn, rows):
+            upserter = conn.session(table_name, lambda: BulkUpserter(
+                conn, table_name, cap_schema.column_names, cap_schema.primary_key))
+            return upserter.upsert(rows, verbose=False)
+
+        # 4. 断点续跑：跳过本批次已完成的；--retry-failed 只跑失败的
+        #    初始加载续跑时，已写入暂存表的也跳过（暂存表保留）
+        todo = checkpoint.pending(symbols, retry_failed=retry_failed, staged_done=initial_load)
+        print(f"✔️ 批次 {checkpoint.run_id}：本次处理 {len(todo)} 只")
+
+        # 5. 抓取（线程池）→ 清洗（进程池）→ 单一写库线程攒批 upsert
+        failed = []
+
+        def write_rows(rows):
+            result = pool.run(upsert_rows, rows)
+            print(f"✅ 写库 {len(rows)} 条：新增 {result.inserted} 条，更新 {result.updated} 条")
+            for row, err in result.bad_rows[:5]:
+                print(f"⚠️ 坏行 {row[:2]} 被跳过: {err}")
+            # 含坏行的股票不能记为完成：抛出后逐只重放，只有它记为失败，可用 --retry-failed 补跑
+            if result.bad_rows:
+                raise BadRowsError(result.bad_rows)
+
+        def on_failed(symbol, err):
+            print(f"❌ {symbol} 失败: {err}")
+            if symbol:
+                checkpoint.mark_failed(symbol, err)
+                failed.append(symbol)
+
+        # 全量回填：写无索引暂存堆表，结束后按主键排序入表、一次性建索引
+        initial = InitialLoad(pool, cap_schema) if initial_load else None
+        if initial:
+            initial.start(keep_existing=bool(checkpoint.staged_items()))
+
+        writer = BatchingWriter(
+            write_fn=initial.write if initial else write_rows,
+            # 初始加载每次 write 是 pool.run 内的一个事务；upsert 每 batch_size 行各自提交，这里无从回滚，
+            # 失败后的重放（连接池重连、按 key 逐个重放）依赖 MERGE 幂等：已提交的批次再 MERGE 一次不会重复插入
+            commit_fn=lambda: None,
+            rollback_fn=lambda: None,
+            flush_rows=commit_rows,
+            flush_seconds=commit_seconds,
+            # 初始加载时行先进暂存表，finish() 入表后才算完成
+            on_committed=checkpoint.mark_staged if initial else checkpoint.mark_done,
+            on_failed=on_failed,
+        )
+        run_pipeline(
+            todo,
+            fetch_fn=lambda symbol: fetch_share_cap(symbol[2:]),
+            transform_fn=transform_share_cap,
+            writer=writer,
+            fetch_workers=fetch_workers,
+            rate=requests_per_second,
+            transform_workers=transform_workers,
+        )
+        if initial:
+            initial.finish()
+            checkpoint.promote_staged()
+            initial.report()
+
+        fetch_client.report()
+        if failed:
+            print("以下股票重试后仍失败（可用 --retry-failed 补跑）：", failed)
+        checkpoint.finish_run()
 
     except pyodbc.Error as err:
         print(f"❌ 数据库操作出错: {err}")
+    finally:
+        checkpoint.close()
+        pool.close()
 
     print("▶️ 脚本执行完毕")
 
 if __name__ == "__main__":
-    main()
+    parser = argparse.ArgumentParser(description="AkShare A 股股本市值 → SQL Server")
+    parser.add_argument("--refresh-universe", action="store_true",
+                        help="忽略本地股票池缓存，重新拉取")
+    add_checkpoint_args(parser)
+    add_cache_args(parser)
+    add_storage_args(parser)
+    add_initial_load_args(parser)
+    args = parser.parse_args()
+    configure_cache(no_cache=args.no_cache, refresh_cache=args.refresh_cache)
+    configure_storage(cap_schema, args)
+    main(refresh_universe=args.refresh_universe, run_id=args.run_id, retry_failed=args.retry_failed, checkpoint_path=args.checkpoint,
+         initial_load=args.initial_load)
 
 
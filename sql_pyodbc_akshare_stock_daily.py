@@ -1,114 +1,221 @@
 import akshare as ak
 import pyodbc
 import pandas as pd
-from datetime import datetime
-import time
-from tenacity import retry, stop_after_attempt, wait_fixed
-from json import JSONDecodeError
+from datetime import datetime, timedelta
+import argparse
+from sql_pyodbc_upsert import BadRowsError, BulkUpserter
+from sql_pyodbc_pipeline import BatchingWriter, run_pipeline
+from sql_pyodbc_akshare_fetch import fetch_client
+from sql_pyodbc_akshare_cache import raw_cache, add_cache_args, configure_cache
+from sql_pyodbc_akshare_universe import load_symbols
+from sql_pyodbc_schema import TableSchema, Column, add_storage_args, configure_storage
+from sql_pyodbc_checkpoint import CheckpointStore, add_checkpoint_args, default_checkpoint_path
+from sql_pyodbc_pool import get_pool
+from sql_pyodbc_bulkload import InitialLoad, add_initial_load_args
+from sql_pyodbc_adj_factor import refresh_adj_factor
 
 
 conn_str   = 'DSN,UID,PWD'  
 table_name = "stock_a_daily"                  
 start_date = "2010-01-01"                     
-
-@retry(stop=stop_after_attempt(3), wait=wait_fixed(1))
-def fetch_daily(symbol: str) -> pd.DataFrame:
-    return ak.stock_zh_a_daily(symbol=symbol, start_date=start_date)
-
-def main():
+max_workers         = 8       # 并发抓取线程数
+requests_per_second = 10.0    # 令牌桶限速：每秒最多发起的请求数
+transform_workers   = 4       # 清洗进程数
+commit_rows         = 50000   # 写库攒够多少行提交一次
+commit_seconds      = 10.0    # 或距上次提交超过多少秒
+
+# 表结构只声明一次：DDL、类型转换/取整、越界检查都由它生成
+daily_schema = TableSchema(table_name, [
+    Column('symbol',      'VARCHAR(10)',   nullable=False),
+    Column('trade_date',  'DATE',          nullable=False),
+    Column('open',        'DECIMAL(9,4)'),
+    Column('high',        'DECIMAL(9,4)'),
+    Column('low',         'DECIMAL(9,4)'),
+    Column('close',       'DECIMAL(9,4)'),
+    Column('volume',      'DECIMAL(15,2)'),
+    Column('amount',      'DECIMAL(20,2)'),
+    Column('turnover',    'DECIMAL(9,6)'),
+    Column('update_time', 'DATETIME',      nullable=False),
+], primary_key=['symbol', 'trade_date'])
+
+def fetch_daily_remote(symbol: str, since: str) -> pd.DataFrame:
+    # 指数退避 + 按接口自适应限速 + 熔断，见 sql_pyodbc_akshare_fetch.FetchClient
+    return fetch_client.call('stock_zh_a_daily', ak.stock_zh_a_daily, symbol=symbol, start_date=since)
+
+def fetch_daily(symbol: str, since: str = start_date) -> pd.DataFrame:
+    """
+    每只股票在本地缓存一份自 start_date 起的完整日线（Parquet）：今天以前的
+    行不过期，每次只向 AkShare 请求缓存末尾之后的尾部并追加，再按 since 截取
+    """
+    return raw_cache.fetch_series('stock_zh_a_daily', lambda start: fetch_daily_remote(symbol, start),
+                                  partition=symbol, since=since, first=start_date)
+
+def load_high_water_marks(cursor) -> dict:
+    """一次性批量读取每只股票已入库的最大 trade_date"""
+    cursor.execute(f"""
+SELECT symbol, MAX(trade_date)
+FROM dbo.{table_name}
+GROUP BY symbol
+""")
+    # 旧版 SQL Server ODBC 驱动会把 DATE 返回成字符串，统一转成 date
+    return {symbol: pd.to_datetime(last_date).date() for symbol, last_date in cursor.fetchall()}
+
+def transform_daily(key: tuple, df: pd.DataFrame) -> list:
+    """清洗一只股票的日线（在进程池中执行），返回 executemany 参数"""
+    symbol, _, last_date = key
+    if df is None or df.empty:
+        return []
+
+    df = df.reset_index().rename(columns={'date': 'trade_date'})
+    df['symbol']      = symbol
+    df['update_time'] = datetime.now()
+    df['trade_date']  = pd.to_datetime(df['trade_date']).dt.date
+
+    if last_date is not None:
+        df = df[df['trade_date'] > last_date]
+
+    # 越界行整批剔除，不让一个坏值拖垮整批 executemany
+    df, rejected = daily_schema.coerce(df)
+    if not rejected.empty:
+        print(f"⚠️ {symbol} 剔除 {len(rejected)} 条越界数据，"
+              f"首条: {rejected['reject_reason'].iloc[0]}")
+    return daily_schema.to_params(df)
+
+def main(
+    full: bool = False,
+    refresh_universe: bool = False,
+    run_id: str = None,
+    retry_failed: bool = False,
+    checkpoint_path: str = default_checkpoint_path,
+    initial_load: bool = False
+):
+    checkpoint = CheckpointStore(table_name, run_id=run_id, path=checkpoint_path)
+    # 共享连接池：连接断开时自动重连并重放当前事务
+    pool = get_pool(conn_str)
     try:
-        with pyodbc.connect(conn_str) as conn:
-            cursor = conn.cursor()
-            cursor.fast_executemany = True
-            print("✔️ 数据库连接成功")
-
-            ddl = f"""
-IF OBJECT_ID(N'dbo.{table_name}', 'U') IS NULL
-BEGIN
-    CREATE TABLE dbo.{table_name} (
-        symbol      VARCHAR(10)   NOT NULL,
-        trade_date  DATE          NOT NULL,
-        [open]      DECIMAL(9,4)  NULL,
-        high        DECIMAL(9,4)  NULL,
-        low         DECIMAL(9,4)  NULL,
-        [close]     DECIMAL(9,4)  NULL,
-        volume      DECIMAL(15,2) NULL,
-        amount      DECIMAL(20,2) NULL,
-        turnover    DECIMAL(9,6)  NULL,
-        update_time DATETIME      NOT NULL,
-        CONSTRAINT PK_{table_name} PRIMARY KEY (symbol, trade_date)
-    );
-END
-"""
-            cursor.execute(ddl)
-            conn.commit()
-            print(f"✔️ 表 [{table_name}] 创建/检查成功")
-            
-            try:
-                stock_df = ak.stock_info_a_code_name()
-            except JSONDecodeError:
-                time.sleep(0.5)
-                stock_df = ak.stock_info_a_code_name()
-            codes = stock_df['code'].astype(str).tolist()
-
-            sse_prefixes  = {"600","601","603","605","688","689"}
-            szse_prefixes = {"000","001","002","003","300","301"}
-
-            symbols = []
-            for c in codes:
-                if any(c.startswith(p) for p in sse_prefixes):
-                    symbols.append(f"sh{c}")
-                elif any(c.startswith(p) for p in szse_prefixes):
-                    symbols.append(f"sz{c}")
-
-            print(f"✔️ 共获取 {len(symbols)} 只沪深交易所 A 股代码")
-
-            failed = []
-            for symbol in symbols:
-                try:
-                    df = fetch_daily(symbol)
-                    if df.empty:
-                        print(f"⚠️ {symbol} 无数据，跳过")
-                        continue
-
-                    df.reset_index(inplace=True)                       
-                    df.rename(columns={'date':'trade_date'}, inplace=True)
-                    df['symbol']      = symbol
-                    df['update_time'] = datetime.now()
-                    df['trade_date']  = pd.to_datetime(df['trade_date']).dt.date
-
-                    df = df[[
-                        'symbol','trade_date','open','high','low','close',
-                        'volume','amount','turnover','update_time'
-                    ]]
-
-                    records = [tuple(row) for row in df.values]
-                    insert_sql = f"""
-INSERT INTO dbo.{table_name}
-    (symbol, trade_date, [open], high, low, [close],
-     volume, amount, turnover, update_time)
-VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-"""
-                    cursor.executemany(insert_sql, records)
-                    conn.commit()
-                    print(f"✅ {symbol} 插入 {len(df)} 条")
-                    time.sleep(0.1)  
-
-                except Exception as e:
-                    print(f"❌ {symbol} 处理失败: {e}")
-                    conn.rollback()
-                    failed.append(symbol)
-
-            if failed:
-                print("以下股票多次重试后仍失败，需要后续手动补跑：")
-                print(failed)
+        pool.run(lambda conn: conn.cursor().execute(daily_schema.ddl()))
+        print("✔️ 数据库连接成功")
+        print(f"✔️ 表 [{table_name}] 创建/检查成功")
+        
+        # 共享股票池缓存（带 TTL），多个 loader 连续运行时只请求一次
+        symbols = load_symbols(refresh=refresh_universe)
+        print(f"✔️ 共获取 {len(symbols)} 只沪深交易所 A 股代码")
+
+        # 增量模式：只抓取高水位线之后的缺失尾部
+        high_water = {} if full else pool.run(lambda conn: load_high_water_marks(conn.cursor()))
+        today = datetime.today().date()
+        since_map = {}
+        for symbol in symbols:
+            last_date = high_water.get(symbol)
+            if last_date is None:
+                since_map[symbol] = start_date
+            elif last_date < today:
+                since_map[symbol] = (last_date + timedelta(days=1)).strftime("%Y-%m-%d")
+        if not full:
+            print(f"✔️ 增量模式：{len(high_water)} 只已有数据，{len(since_map)} 只需要更新")
+
+        # 断点续跑：跳过本批次已完成的标的；--retry-failed 只跑失败的
+        # 初始加载续跑时，已写入暂存表的标的也跳过（暂存表保留）
+        todo = checkpoint.pending(since_map, retry_failed=retry_failed, staged_done=initial_load)
+        if retry_failed:
+            print(f"✔️ 批次 {checkpoint.run_id}：重跑失败标的 {len(todo)} 只")
+        else:
+            print(f"✔️ 批次 {checkpoint.run_id}：待处理 {len(todo)} 只，已完成 {len(since_map) - len(todo)} 只")
+
+        # 抓取（线程池 + 令牌桶）→ 清洗（进程池）→ 单一写库线程按行数/时间窗口批量提交
+        failed = []
+
+        # 初始加载时行先进暂存表，finish() 入表后才算完成
+        mark_written = checkpoint.mark_staged if initial_load else checkpoint.mark_done
+
+        def on_committed(key, n_rows):
+            mark_written(key[0], n_rows)
+            print(f"✅ {key[0]} 写入 {n_rows} 条")
+
+        def on_failed(key, err):
+            symbol = key[0] if key else None
+            print(f"❌ {symbol} 处理失败: {err}")
+            if symbol:
+                checkpoint.mark_failed(symbol, err)
+                failed.append(symbol)
+
+        # 全量回填：写无索引暂存堆表，结束后按主键排序入表、一次性建索引
+        initial = InitialLoad(pool, daily_schema) if initial_load else None
+        if initial:
+            initial.start(keep_existing=bool(checkpoint.staged_items()))
+
+        # 临时表暂存 + MERGE：--full 重抓已入库的日期、重放已提交的批次都不会撞主键；
+        # #temp 表随连接存在，每条连接各建一个 upserter
+        def upsert_rows(conn, rows):
+            upserter = conn.session(table_name, lambda: BulkUpserter(
+                conn, table_name, daily_schema.column_names, daily_schema.primary_key))
+            return upserter.upsert(rows, verbose=False)
+
+        def write_rows(rows):
+            result = pool.run(upsert_rows, rows)
+            print(f"✔️ 写库 {len(rows)} 条：新增 {result.inserted} 条，更新 {result.updated} 条")
+            # 含坏行的股票不能记为完成：抛出后逐只重放，只有它记为失败，可用 --retry-failed 补跑
+            if result.bad_rows:
+                raise BadRowsError(result.bad_rows)
+
+        writer = BatchingWriter(
+            # 初始加载每次 write 是 pool.run 内的一个事务；upsert 每 batch_size 行各自提交，这里无从回滚，
+            # 失败后的重放（连接池重连、按 key 逐个重放）依赖 MERGE 幂等：已提交的批次再 MERGE 一次不会重复插入
+            write_fn=initial.write if initial else write_rows,
+            commit_fn=lambda: None,
+            rollback_fn=lambda: None,
+            flush_rows=commit_rows,
+            flush_seconds=commit_seconds,
+            on_committed=on_committed,
+            on_failed=on_failed,
+        )
+        keys = [(s, since_map[s], high_water.get(s)) for s in todo]
+        run_pipeline(
+            keys,
+            fetch_fn=lambda key: fetch_daily(key[0], key[1]),
+            transform_fn=transform_daily,
+            writer=writer,
+            fetch_workers=max_workers,
+            rate=requests_per_second,
+            transform_workers=transform_workers,
+        )
+        print(f"✔️ 共写入 {writer.rows_written} 条，提交 {writer.commits} 次")
+        if initial:
+            initial.finish()
+            checkpoint.promote_staged()
+            initial.report()
+        # 新到的行情可能让此前缺价的除权除息事件可以定价：补算受影响股票的复权因子
+        if writer.rows_written:
+            refresh_adj_factor(pool)
+        fetch_client.report()
+
+        if failed:
+            print("以下股票多次重试后仍失败，可用 --retry-failed 补跑：")
+            print(failed)
+        checkpoint.finish_run()
 
     except pyodbc.Error as err:
         print(f"❌ 数据库操作失败: {err}")
+    finally:
+        checkpoint.close()
+        pool.close()
 
     print("▶️ 脚本执行完毕")
 
 if __name__ == "__main__":
-    main()
+    parser = argparse.ArgumentParser(description="AkShare A 股日线 → SQL Server")
+    parser.add_argument("--full", action="store_true",
+                        help=f"忽略已入库高水位线，从 {start_date} 全量拉取")
+    parser.add_argument("--refresh-universe", action="store_true",
+                        help="忽略本地股票池缓存，重新拉取")
+    add_checkpoint_args(parser)
+    add_cache_args(parser)
+    add_storage_args(parser)
+    add_initial_load_args(parser)
+    args = parser.parse_args()
+    configure_cache(no_cache=args.no_cache, refresh_cache=args.refresh_cache)
+    configure_storage(daily_schema, args)
+    main(full=args.full, refresh_universe=args.refresh_universe, run_id=args.run_id,
+         retry_failed=args.retry_failed, checkpoint_path=args.checkpoint, initial_load=args.initial_load)
 
 
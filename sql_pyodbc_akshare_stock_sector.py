@@ -1,8 +1,39 @@
+import argparse
+import hashlib
+import json
+import os
+from typing import Dict, Optional, Tuple
+
+import numpy as np
 import pandas as pd
 import pyodbc
 from datetime import datetime
 
-CONN = pyodbc.connect("DSN,UID,PWD")
+from sql_pyodbc_pool import get_pool
+from sql_pyodbc_schema import Column, TableSchema
+
+conn_str = "DSN,UID,PWD"
+
+# 申万行业分类文件，按分类版本
+sw_mapping_files = {
+    '2014': r"C:\Users\19874\OneDrive\桌面\九坤投资实习\申万分类\SwClassCode_2014.xls",
+    '2021': r"C:\Users\19874\OneDrive\桌面\九坤投资实习\申万分类\SwClassCode_2021.xls",
+}
+sw_default_vintage = '2021'
+mapping_cache_dir = "sw_mapping_cache"
+
+mapping_schema = TableSchema(
+    name='sw_industry_mapping',
+    columns=[
+        Column('vintage',       'CHAR(4)',       nullable=False),
+        Column('industry_code', 'VARCHAR(20)',   nullable=False),
+        Column('level1',        'NVARCHAR(50)'),
+        Column('level2',        'NVARCHAR(50)'),
+        Column('level3',        'NVARCHAR(50)'),
+        Column('update_time',   'DATETIME',      default='GETDATE()'),
+    ],
+    primary_key=['vintage', 'industry_code'],
+)
 
 def load_stock_sector_table(conn: pyodbc.Connection) -> pd.DataFrame:
     sql = """
@@ -17,32 +48,164 @@ def load_stock_sector_table(conn: pyodbc.Connection) -> pd.DataFrame:
     df['start_date'] = pd.to_datetime(df['start_date'])
     return df
 
+def codes_to_frame(
+    codes: np.ndarray,
+    categories: pd.Index,
+    index: pd.Index,
+    columns: pd.Index
+) -> pd.DataFrame:
+    """(dates x symbols) integer code matrix -> DataFrame of category columns"""
+    dtype = pd.CategoricalDtype(categories)
+    return pd.DataFrame(
+        {col: pd.Categorical.from_codes(codes[:, j], dtype=dtype)
+         for j, col in enumerate(columns)},
+        index=index,
+        columns=columns
+    )
+
+def name_lut(
+    codes: pd.Index,
+    lookup: pd.Series
+) -> (np.ndarray, pd.Index):
+    """
+    code -> name lookup as an integer array: lut[i] is the category id of the
+    name of codes[i]; lut[-1] (the extra last slot) serves code id -1.
+    Unknown / missing codes map to 'UNK'.
+    """
+    lookup = lookup[~lookup.index.duplicated()]
+    names = lookup.reindex(codes).fillna('UNK').to_numpy(dtype=object)
+    categories = pd.Index(pd.unique(np.append(names, 'UNK')))
+    lut = np.append(categories.get_indexer(names), categories.get_loc('UNK')).astype(np.int32)
+    return lut, categories
+
+class SectorMembership:
+    """
+    Long-format industry membership: one (symbol, start_date, industry_code)
+    interval per reclassification, sorted by (symbol, start_date). Each interval
+    runs until the symbol's next start_date. Memory scales with the number of
+    reclassifications, not days x symbols; as-of lookups are a vectorized
+    searchsorted and a dense panel is only built for a requested window.
+    """
+
+    _DAY_OFFSET = 2 ** 31
+
+    def __init__(
+        self,
+        symbols: pd.Index,
+        interval_symbol: np.ndarray,
+        starts: np.ndarray,
+        code_ids: np.ndarray,
+        categories: pd.Index
+    ):
+        self.symbols = symbols
+        self.interval_symbol = interval_symbol
+        self.starts = starts
+        self.code_ids = code_ids
+        self.categories = categories
+        self.unk_id = categories.get_loc('UNK')
+        self.offsets = np.searchsorted(interval_symbol, np.arange(len(symbols) + 1)).astype(np.int64)
+        # (symbol id, 日期) 合成一个有序 int64 键，一次 searchsorted 完成所有股票的 as-of 查找
+        self._keys = (interval_symbol.astype(np.int64) << 32) + (starts.astype(np.int64) + self._DAY_OFFSET)
+
+    @classmethod
+    def from_stock_sector(cls, stock_sector_df: pd.DataFrame) -> 'SectorMembership':
+        """from load_stock_sector_table() rows; NULL codes are ignored like the old ffill"""
+        symbols = pd.Index(np.sort(stock_sector_df['symbol'].dropna().unique()), name='symbol')
+        df = stock_sector_df.dropna(subset=['symbol', 'start_date', 'industry_code'])
+        df = df.sort_values(['symbol', 'start_date'], kind='mergesort')
+        df = df.drop_duplicates(['symbol', 'start_date'], keep='last')
+        # 连续相同的行业代码合并为一个区间
+        same = (df['symbol'] == df['symbol'].shift()) & (df['industry_code'] == df['industry_code'].shift())
+        df = df.loc[~same]
+
+        code_ids, code_values = pd.factorize(df['industry_code'])
+        categories = pd.Index(code_values).append(pd.Index(['UNK'])).unique()
+        return cls(
+            symbols=symbols,
+            interval_symbol=symbols.get_indexer(df['symbol']).astype(np.int32),
+            starts=pd.to_datetime(df['start_date']).to_numpy(dtype='datetime64[D]'),
+            code_ids=code_ids.astype(np.int32),
+            categories=categories
+        )
+
+    def __len__(self) -> int:
+        return len(self.code_ids)
+
+    @property
+    def nbytes(self) -> int:
+        return self.interval_symbol.nbytes + self.starts.nbytes + self.code_ids.nbytes + self._keys.nbytes
+
+    @property
+    def ends(self) -> np.ndarray:
+        """inclusive end date of each interval; NaT for the current one"""
+        ends = np.full(len(self), np.datetime64('NaT'), dtype='datetime64[D]')
+        follows = self.interval_symbol[1:] == self.interval_symbol[:-1]
+        ends[:-1][follows] = self.starts[1:][follows] - np.timedelta64(1, 'D')
+        return ends
+
+    def to_frame(self) -> pd.DataFrame:
+        return pd.DataFrame({
+            'symbol': self.symbols[self.interval_symbol],
+            'start_date': self.starts,
+            'end_date': self.ends,
+            'industry_code': self.categories[self.code_ids],
+        })
+
+    def code_ids_of(self, symbols, dates) -> np.ndarray:
+        """integer industry code id per (symbol, date) pair; unknown -> unk_id"""
+        symbols, dates = np.broadcast_arrays(
+            np.asarray(symbols, dtype=object),
+            pd.to_datetime(np.atleast_1d(dates)).to_numpy(dtype='datetime64[D]')
+        )
+        symbols, dates = symbols.ravel(), dates.ravel()
+        if len(self) == 0:
+            return np.full(len(symbols), self.unk_id, dtype=np.int32)
+        sid = self.symbols.get_indexer(symbols)
+        query = (sid.astype(np.int64) << 32) + (dates.astype(np.int64) + self._DAY_OFFSET)
+        pos = np.searchsorted(self._keys, query, side='right') - 1
+        safe = pos.clip(0)
+        ok = (sid >= 0) & (pos >= 0) & (self.interval_symbol[safe] == sid) & ~np.isnat(dates)
+        return np.where(ok, self.code_ids[safe], self.unk_id).astype(np.int32)
+
+    def sector_of(self, symbols, dates, lookup: pd.Series = None) -> pd.Categorical:
+        """
+        As-of industry code of each (symbol, date) pair (scalars broadcast).
+        With lookup (e.g. mapping_df['level1']) the codes are mapped to names.
+        """
+        ids = self.code_ids_of(symbols, dates)
+        if lookup is None:
+            return pd.Categorical.from_codes(ids, dtype=pd.CategoricalDtype(self.categories))
+        lut, categories = name_lut(self.categories, lookup)
+        return pd.Categorical.from_codes(lut[ids], dtype=pd.CategoricalDtype(categories))
+
+    def panel(self, start_date=None, end_date=None, symbols=None) -> pd.DataFrame:
+        """dense calendar-day x symbol industry code panel for one window"""
+        end_date = pd.to_datetime(end_date) if end_date is not None else pd.to_datetime(datetime.today().date())
+        start_date = pd.to_datetime(start_date) if start_date is not None else \
+            pd.Timestamp(self.starts.min()) if len(self) else end_date
+        columns = self.symbols if symbols is None else pd.Index(symbols, name='symbol')
+
+        full_dates = pd.date_range(start=start_date, end=end_date, freq='D', name='date')
+        days = full_dates.to_numpy(dtype='datetime64[D]')
+        codes = np.full((len(days), len(columns)), self.unk_id, dtype=np.int32)
+        for j, sid in enumerate(self.symbols.get_indexer(columns)):
+            if sid < 0:
+                continue
+            lo, hi = self.offsets[sid], self.offsets[sid + 1]
+            # 只有 NULL 行业代码的股票没有区间，整列保持 UNK
+            if lo == hi:
+                continue
+            pos = np.searchsorted(self.starts[lo:hi], days, side='right') - 1
+            codes[:, j] = np.where(pos >= 0, self.code_ids[lo:hi][pos.clip(0)], self.unk_id)
+        return codes_to_frame(codes, self.categories, full_dates, columns)
+
 def build_industry_code_df(
     stock_sector_df: pd.DataFrame,
     start_date: pd.Timestamp = None,
     end_date: pd.Timestamp = None
 ) -> pd.DataFrame:
-    if start_date is None:
-        start_date = stock_sector_df['start_date'].min()
-    else:
-        start_date = pd.to_datetime(start_date)
-
-    if end_date is None:
-        end_date = pd.to_datetime(datetime.today().date())
-    else:
-        end_date = pd.to_datetime(end_date)
-
-    pivot_df = stock_sector_df.pivot(
-        index='start_date',
-        columns='symbol',
-        values='industry_code'
-    )
-
-    full_dates = pd.date_range(start=start_date, end=end_date, freq='D')
-    reopened = pivot_df.reindex(full_dates).ffill()
-    industry_code_df = reopened.fillna('UNK')
-    industry_code_df.index.name = 'date'
-    return industry_code_df
+    membership = SectorMembership.from_stock_sector(stock_sector_df)
+    return membership.panel(start_date, end_date)
 
 def load_mapping_df(
     mapping_file_path: str,
@@ -65,43 +228,255 @@ def load_mapping_df(
     mapping_trimmed['level3'] = mapping_trimmed['level3'].fillna('UNK')
     return mapping_trimmed
 
+def _file_sha1(path: str) -> str:
+    h = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+def _read_mapping_meta(vintage: str, cache_dir: str) -> dict:
+    meta_path = os.path.join(cache_dir, f"sw_{vintage}.json")
+    if not os.path.exists(meta_path):
+        return {}
+    with open(meta_path, encoding='utf-8') as f:
+        return json.load(f)
+
+def mapping_version(
+    vintage: str = sw_default_vintage,
+    mapping_file_path: str = None,
+    cache_dir: str = mapping_cache_dir
+) -> Optional[str]:
+    """sha1 of the mapping load_mapping(vintage) would return, without parsing it"""
+    mapping_file_path = mapping_file_path or sw_mapping_files[vintage]
+    meta = _read_mapping_meta(vintage, cache_dir)
+    if not os.path.exists(mapping_file_path):
+        return meta.get('sha1')
+    st = os.stat(mapping_file_path)
+    if meta.get('path') == mapping_file_path and meta.get('mtime') == st.st_mtime and meta.get('size') == st.st_size:
+        return meta.get('sha1')
+    return _file_sha1(mapping_file_path)
+
+def load_mapping(
+    vintage: str = sw_default_vintage,
+    mapping_file_path: str = None,
+    cache_dir: str = mapping_cache_dir,
+    refresh: bool = False
+) -> pd.DataFrame:
+    """
+    Shenwan mapping of one classification vintage ('2014' / '2021').
+    The .xls is parsed once and kept as a pickle keyed by the file's sha1;
+    an unchanged mtime and size skips even the hash. If the .xls is not
+    reachable the last cached copy of that vintage is used.
+    """
+    mapping_file_path = mapping_file_path or sw_mapping_files[vintage]
+    meta_path = os.path.join(cache_dir, f"sw_{vintage}.json")
+    meta = _read_mapping_meta(vintage, cache_dir)
+    cached = meta.get('cache_file')
+    has_cache = cached is not None and os.path.exists(cached)
+
+    if not os.path.exists(mapping_file_path):
+        if has_cache:
+            print(f"⚠️ 未找到 {mapping_file_path}，使用缓存的 {vintage} 版申万分类")
+            return pd.read_pickle(cached)
+        raise FileNotFoundError(mapping_file_path)
+
+    st = os.stat(mapping_file_path)
+    if (not refresh and has_cache and meta.get('path') == mapping_file_path
+            and meta.get('mtime') == st.st_mtime and meta.get('size') == st.st_size):
+        return pd.read_pickle(cached)
+
+    digest = _file_sha1(mapping_file_path)
+    cache_file = os.path.join(cache_dir, f"sw_{vintage}_{digest[:16]}.pkl")
+    if not refresh and os.path.exists(cache_file):
+        mapping_df = pd.read_pickle(cache_file)
+    else:
+        mapping_df = load_mapping_df(mapping_file_path)
+        os.makedirs(cache_dir, exist_ok=True)
+        mapping_df.to_pickle(cache_file + '.tmp', compression=None)
+        os.replace(cache_file + '.tmp', cache_file)
+
+    meta = {'path': mapping_file_path, 'mtime': st.st_mtime, 'size': st.st_size,
+            'sha1': digest, 'cache_file': cache_file}
+    os.makedirs(cache_dir, exist_ok=True)
+    with open(meta_path + '.tmp', 'w', encoding='utf-8') as f:
+        json.dump(meta, f, ensure_ascii=False)
+    os.replace(meta_path + '.tmp', meta_path)
+    return mapping_df
+
+def save_mapping_to_sql(conn: pyodbc.Connection, mapping_df: pd.DataFrame, vintage: str) -> int:
+    """replace one vintage in dbo.sw_industry_mapping, so jobs can join it server-side"""
+    df = mapping_df.reset_index()
+    df = df.dropna(subset=['industry_code']).drop_duplicates('industry_code')
+    df['vintage'] = vintage
+    df['update_time'] = datetime.now()
+    good, rejected = mapping_schema.coerce(df)
+    if not rejected.empty:
+        print(f"⚠️ {len(rejected)} 条行业映射未通过校验: {rejected['reject_reason'].iloc[0]}")
+    rows = mapping_schema.to_params(good)
+
+    cursor = conn.cursor()
+    cursor.execute(mapping_schema.ddl())
+    cursor.execute(f"DELETE FROM {mapping_schema.qualified_name} WHERE vintage = ?", vintage)
+    if rows:
+        cursor.fast_executemany = True
+        cursor.executemany(mapping_schema.insert_sql(), rows)
+    conn.commit()
+    cursor.close()
+    return len(rows)
+
+def load_mapping_from_sql(conn: pyodbc.Connection, vintage: str = sw_default_vintage) -> pd.DataFrame:
+    sql = f"""
+        SELECT industry_code, level1, level2, level3
+        FROM {mapping_schema.qualified_name}
+        WHERE vintage = ?
+    """
+    df = pd.read_sql(sql, conn, params=[vintage])
+    return df.set_index('industry_code')
+
+def map_codes_to_category(
+    industry_code_df: pd.DataFrame,
+    lookup: pd.Series
+) -> pd.DataFrame:
+    """
+    Map every industry code cell through `lookup` (code -> name) without a
+    per-cell Python call: the distinct codes are looked up once and the cells
+    are mapped by integer array indexing. A category-dtype panel (as returned
+    by build_industry_code_df) is used via its codes; anything else is
+    factorized once. Unknown / missing codes become 'UNK'.
+    """
+    dtypes = set(industry_code_df.dtypes)
+    first = next(iter(dtypes), None)
+    if len(dtypes) == 1 and isinstance(first, pd.CategoricalDtype):
+        cell_ids = np.column_stack([industry_code_df[col].array.codes for col in industry_code_df.columns])
+        unique_codes = first.categories
+    else:
+        values = industry_code_df.to_numpy()
+        cell_ids, unique_codes = pd.factorize(values.ravel(), use_na_sentinel=True)
+        cell_ids = cell_ids.reshape(values.shape)
+
+    lut, categories = name_lut(unique_codes, lookup)
+    return codes_to_frame(lut[cell_ids], categories, industry_code_df.index, industry_code_df.columns)
+
 def build_sector_and_industry_dfs(
     industry_code_df: pd.DataFrame,
     mapping_df: pd.DataFrame
 ) -> (pd.DataFrame, pd.DataFrame):
-    level1_map = mapping_df['level1']
-    level3_map = mapping_df['level3']
+    sector_df = map_codes_to_category(industry_code_df, mapping_df['level1'])
+    industry_df = map_codes_to_category(industry_code_df, mapping_df['level3'])
+    return sector_df, industry_df
 
-    def map_to_level1(code: str) -> str:
-        if code == 'UNK' or pd.isna(code):
-            return 'UNK'
-        return level1_map.get(code, 'UNK')
+_membership: Optional[SectorMembership] = None
+_panel_cache: Dict[tuple, Tuple[pd.DataFrame, pd.DataFrame]] = {}
+_source_version: Optional[str] = None
 
-    def map_to_level3(code: str) -> str:
-        if code == 'UNK' or pd.isna(code):
-            return 'UNK'
-        return level3_map.get(code, 'UNK')
+def load_membership(conn: pyodbc.Connection = None, refresh: bool = False) -> SectorMembership:
+    """dbo.stock_sector as a SectorMembership, read once per process"""
+    global _membership
+    if _membership is None or refresh:
+        if conn is None:
+            # 连接池在首次使用时才建立连接，import 本模块不会连库
+            stock_sector_df = get_pool(conn_str).run(load_stock_sector_table)
+        else:
+            stock_sector_df = load_stock_sector_table(conn)
+        _membership = SectorMembership.from_stock_sector(stock_sector_df)
+    return _membership
 
-    sector_df = industry_code_df.applymap(map_to_level1)
-    industry_df = industry_code_df.applymap(map_to_level3)
-    return sector_df, industry_df
+def build_sector_panels(
+    start_date=None,
+    end_date=None,
+    vintage: str = sw_default_vintage,
+    conn: pyodbc.Connection = None,
+    refresh: bool = False,
+    source_version: Optional[str] = None
+) -> Tuple[pd.DataFrame, pd.DataFrame]:
+    """
+    (sector_df, industry_df) daily panels for the window, memoized per
+    (start_date, end_date, vintage) so repeated calls reuse the built panel;
+    each call returns copies, so editing them leaves the memo intact.
+    source_version identifies the stock_sector / mapping data (e.g. their
+    update stamps); a value different from the last call's drops the memo.
+    """
+    global _source_version
+    if source_version is not None and source_version != _source_version:
+        clear_cache()
+        _source_version = source_version
+    membership = load_membership(conn, refresh=refresh)
+    start = pd.to_datetime(start_date) if start_date is not None else pd.Timestamp(membership.starts.min())
+    end = pd.to_datetime(end_date) if end_date is not None else pd.to_datetime(datetime.today().date())
+    key = (start, end, vintage)
+    if refresh or key not in _panel_cache:
+        industry_code_df = membership.panel(start, end)
+        mapping_df = load_mapping(vintage)
+        _panel_cache[key] = build_sector_and_industry_dfs(industry_code_df, mapping_df)
+    sector_df, industry_df = _panel_cache[key]
+    return sector_df.copy(), industry_df.copy()
 
+def clear_cache() -> None:
+    global _membership
+    _membership = None
+    _panel_cache.clear()
 
-stock_sector_df = load_stock_sector_table(CONN)
-industry_code_df = build_industry_code_df(
-stock_sector_df,
-start_date=None,
-end_date=None
-)
-mapping_file_path = r"C:\Users\19874\OneDrive\桌面\九坤投资实习\申万分类\SwClassCode_2021.xls"
-mapping_df = load_mapping_df(
-mapping_file_path,
-code_col="行业代码",
-level1_col="一级行业名称",
-level2_col="二级行业名称",
-level3_col="三级行业名称"
-)
-sector_df, industry_df = build_sector_and_industry_dfs(industry_code_df, mapping_df)
-print(sector_df)
-print(industry_df)
+def _self_check() -> None:
+    """
+    SectorMembership.panel against the original pivot / ffill on synthetic
+    rows, including a symbol whose rows all have NULL industry codes (an
+    all-'UNK' column) and windows starting after a reclassification.
+    """
+    rng = np.random.default_rng(0)
+    codes = [f"{c:06d}" for c in rng.choice(999999, 40, replace=False)]
+    rows = []
+    for s in range(200):
+        days = np.sort(rng.choice(4000, rng.integers(1, 6), replace=False))
+        for d in days:
+            code = None if rng.random() < 0.1 else codes[rng.integers(len(codes))]
+            rows.append((f"sz{s:06d}", pd.Timestamp('2010-01-01') + pd.Timedelta(days=int(d)), code))
+    rows += [('sh600000', pd.Timestamp('2012-03-01'), None), ('sh600000', pd.Timestamp('2015-07-01'), None)]
+    stock_sector_df = pd.DataFrame(rows, columns=['symbol', 'start_date', 'industry_code'])
+
+    def reference(start, end):
+        pivot_df = stock_sector_df.pivot(index='start_date', columns='symbol', values='industry_code')
+        full_dates = pd.date_range(start=min(start, stock_sector_df['start_date'].min()), end=end, freq='D')
+        return pivot_df.reindex(full_dates).ffill().fillna('UNK').loc[start:]
+
+    membership = SectorMembership.from_stock_sector(stock_sector_df)
+    for start, end in (('2010-01-01', '2021-12-31'), ('2016-05-01', '2018-01-31')):
+        expected = reference(pd.Timestamp(start), pd.Timestamp(end))
+        got = membership.panel(start, end)
+        assert list(got.columns) == list(expected.columns)
+        assert (got.astype(str).to_numpy() == expected.to_numpy()).all(), (start, end)
+        assert (got['sh600000'] == 'UNK').all()
+
+    ids = membership.code_ids_of(['sh600000', 'sz000001', 'xx'], '2016-01-01')
+    assert ids[0] == membership.unk_id and ids[2] == membership.unk_id
+
+    empty = SectorMembership.from_stock_sector(stock_sector_df.assign(industry_code=None))
+    assert (empty.panel('2020-01-01', '2020-01-10').astype(str) == 'UNK').all().all()
+    assert (empty.code_ids_of('sh600000', '2020-01-01') == empty.unk_id).all()
+    print(f"✅ sector membership self-check passed ({len(membership)} intervals)")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--start", default=None, help="面板起始日期，默认最早的分类记录")
+    parser.add_argument("--end", default=None, help="面板结束日期，默认今天")
+    parser.add_argument("--vintage", default=sw_default_vintage, choices=sorted(sw_mapping_files))
+    parser.add_argument("--refresh-mapping", action="store_true",
+                        help="忽略缓存，重新解析申万分类 .xls")
+    parser.add_argument("--save-mapping-sql", action="store_true",
+                        help="把该版本的申万分类写入 dbo.sw_industry_mapping")
+    parser.add_argument("--check", action="store_true", help="用合成数据自检区间存储与面板")
+    args = parser.parse_args()
+
+    if args.check:
+        _self_check()
+    else:
+        if args.refresh_mapping or args.save_mapping_sql:
+            mapping_df = load_mapping(args.vintage, refresh=args.refresh_mapping)
+            if args.save_mapping_sql:
+                n = get_pool(conn_str).run(save_mapping_to_sql, mapping_df, args.vintage)
+                print(f"✅ 申万 {args.vintage} 版分类写入 {n} 条")
 
+        sector_df, industry_df = build_sector_panels(args.start, args.end, vintage=args.vintage)
+        print(sector_df)
+        print(industry_df)
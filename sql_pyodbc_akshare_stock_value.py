@@ -1,156 +1,177 @@
 import akshare as ak
-import pyodbc
 import pandas as pd
-import time
+import argparse
 from datetime import datetime
-from tenacity import retry, stop_after_attempt, wait_fixed
+from sql_pyodbc_upsert import BadRowsError, BulkUpserter
+from sql_pyodbc_pipeline import BatchingWriter, run_pipeline
+from sql_pyodbc_akshare_fetch import fetch_client
+from sql_pyodbc_akshare_cache import raw_cache, add_cache_args, configure_cache
+from sql_pyodbc_checkpoint import CheckpointStore, add_checkpoint_args, default_checkpoint_path
+from sql_pyodbc_akshare_universe import add_prefix, load_symbols
+from sql_pyodbc_schema import TableSchema, Column, add_storage_args, configure_storage
+from sql_pyodbc_pool import get_pool
+from sql_pyodbc_bulkload import InitialLoad, add_initial_load_args
 
 conn_str = 'DSN,UID,PWD'
 valuation_table = "stock_valuation"
 batch_size = 1000
-sleep_interval = 0.1
-
-sse_prefixes = {"600", "601", "603", "605", "688", "689"}
-szse_prefixes = {"000", "001", "002", "003", "300", "301"}
-
-def add_prefix(code: str) -> str:
-    for p in sse_prefixes:
-        if code.startswith(p):
-            return "sh" + code
-    for p in szse_prefixes:
-        if code.startswith(p):
-            return "sz" + code
-    return None
-
-@retry(stop=stop_after_attempt(3), wait=wait_fixed(1))
-def fetch_all_codes() -> pd.DataFrame:
-    df = ak.stock_zh_a_spot_em()
-    return df[['代码']].rename(columns={'代码': 'symbol_code'})
-
-@retry(stop=stop_after_attempt(3), wait=wait_fixed(1))
-def fetch_valuation_for_symbol(code: str) -> pd.DataFrame:
-    return ak.stock_a_indicator_lg(symbol=code)
+fetch_workers = 8
+requests_per_second = 10.0
+transform_workers = 4
+commit_rows = 50000
+commit_seconds = 10.0
+
+valuation_schema = TableSchema(valuation_table, [
+    Column('symbol',      'VARCHAR(10)',   nullable=False),
+    Column('trade_date',  'DATE',          nullable=False),
+    Column('pe',          'DECIMAL(18,6)'),
+    Column('pe_ttm',      'DECIMAL(18,6)'),
+    Column('pb',          'DECIMAL(18,6)'),
+    Column('ps',          'DECIMAL(18,6)'),
+    Column('ps_ttm',      'DECIMAL(18,6)'),
+    Column('dv_ratio',    'DECIMAL(18,6)'),
+    Column('dv_ttm',      'DECIMAL(18,6)'),
+    Column('total_mv',    'DECIMAL(20,2)'),
+    Column('update_time', 'DATETIME',      nullable=False),
+], primary_key=['symbol', 'trade_date'])
+
+def fetch_valuation_remote(code: str) -> pd.DataFrame:
+    return fetch_client.call('stock_a_indicator_lg', ak.stock_a_indicator_lg, symbol=code)
 
-def main():
+def fetch_valuation_for_symbol(code: str) -> pd.DataFrame:
+    return raw_cache.fetch('stock_a_indicator_lg', fetch_valuation_remote, code, partition=code)
+
+def transform_valuation(code: str, df_val: pd.DataFrame) -> list:
+    """清洗一只股票的估值数据（在进程池中执行），返回 upsert 参数"""
+    if df_val is None or df_val.empty:
+        print(f"⚠️ [{code}] 拉取到空 DataFrame，跳过。")
+        return []
+
+    prefixed_symbol = add_prefix(code)
+    df_val = df_val[[
+        'trade_date', 'pe', 'pe_ttm', 'pb', 'ps', 'ps_ttm',
+        'dv_ratio', 'dv_ttm', 'total_mv'
+    ]].copy()
+
+    df_val['symbol'] = prefixed_symbol
+
+    df_val['trade_date'] = pd.to_datetime(df_val['trade_date'], errors='coerce')
+
+    df_val.dropna(subset=['trade_date'], inplace=True)
+    df_val.drop_duplicates(subset=['trade_date'], keep='last', inplace=True)
+
+    now_ts = datetime.now()
+    df_val['update_time'] = now_ts
+
+    df_val, rejected = valuation_schema.coerce(df_val)
+    if not rejected.empty:
+        print(f"⚠️ [{prefixed_symbol}] 剔除 {len(rejected)} 条越界数据，首条: {rejected['reject_reason'].iloc[0]}")
+    return valuation_schema.to_params(df_val)
+
+def main(
+    refresh_universe: bool = False,
+    run_id: str = None,
+    retry_failed: bool = False,
+    checkpoint_path: str = default_checkpoint_path,
+    initial_load: bool = False
+):
     try:
-        codes_df = fetch_all_codes()
+        symbols = load_symbols(refresh=refresh_universe)
     except Exception as e:
         print(f"❌ 获取股票列表失败: {e}")
         return
 
-    codes_df['symbol'] = codes_df['symbol_code'].astype(str).map(add_prefix)
-    codes_df = codes_df[codes_df['symbol'].notna()]
-    all_codes = codes_df['symbol_code'].astype(str).unique().tolist()
+    all_codes = [s[2:] for s in symbols]
     print(f"ℹ️ 共获取到 {len(all_codes)} 支A股代码，将逐一拉取估值数据。")
 
-    with pyodbc.connect(conn_str) as conn:
-        cursor = conn.cursor()
-        cursor.fast_executemany = True
-
-        ddl = f"""
-IF OBJECT_ID(N'dbo.{valuation_table}', 'U') IS NULL
-BEGIN
-  CREATE TABLE dbo.{valuation_table} (
-    symbol       VARCHAR(10)    NOT NULL,
-    trade_date   DATE           NOT NULL,
-    pe           DECIMAL(18,6)  NULL,
-    pe_ttm       DECIMAL(18,6)  NULL,
-    pb           DECIMAL(18,6)  NULL,
-    ps           DECIMAL(18,6)  NULL,
-    ps_ttm       DECIMAL(18,6)  NULL,
-    dv_ratio     DECIMAL(18,6)  NULL,
-    dv_ttm       DECIMAL(18,6)  NULL,
-    total_mv     DECIMAL(20,2)  NULL,
-    update_time  DATETIME       NOT NULL,
-    CONSTRAINT PK_{valuation_table} PRIMARY KEY (symbol, trade_date)
-  );
-END
-"""
-        cursor.execute(ddl)
-        conn.commit()
-
-        total_inserted = 0
-
-        for idx, code in enumerate(all_codes, start=1):
-            prefixed_symbol = add_prefix(code)
-            if prefixed_symbol is None:
-                continue
-
-            try:
-                df_val = fetch_valuation_for_symbol(code)
-            except Exception as e:
-                print(f"⚠️ [{code}] 拉取估值数据失败: {e}，跳过该股票。")
-                continue
-
-            if df_val.empty:
-                print(f"⚠️ [{code}] 拉取到空 DataFrame，跳过。")
-                continue
-
-            df_val = df_val[[
-                'trade_date', 'pe', 'pe_ttm', 'pb', 'ps', 'ps_ttm',
-                'dv_ratio', 'dv_ttm', 'total_mv'
-            ]].copy()
-
-            df_val['symbol'] = prefixed_symbol
-
-            df_val['trade_date'] = pd.to_datetime(df_val['trade_date'], errors='coerce').dt.date
-            for col in ['pe', 'pe_ttm', 'pb', 'ps', 'ps_ttm', 'dv_ratio', 'dv_ttm']:
-                df_val[col] = pd.to_numeric(df_val[col], errors='coerce').round(6)
-            df_val['total_mv'] = pd.to_numeric(df_val['total_mv'], errors='coerce').round(2)
-
-            df_val.dropna(subset=['trade_date'], inplace=True)
-
-            now_ts = datetime.now()
-            df_val['update_time'] = now_ts
-
-            df_insert = df_val[[
-                'symbol', 'trade_date', 'pe', 'pe_ttm', 'pb', 'ps', 'ps_ttm',
-                'dv_ratio', 'dv_ttm', 'total_mv', 'update_time'
-            ]]
-
-            inserted_this_stock = 0
-            for i in range(0, len(df_insert), batch_size):
-                batch = df_insert.iloc[i:i + batch_size]
-                records = [
-                    (
-                        row.symbol,
-                        row.trade_date,
-                        row.pe,
-                        row.pe_ttm,
-                        row.pb,
-                        row.ps,
-                        row.ps_ttm,
-                        row.dv_ratio,
-                        row.dv_ttm,
-                        row.total_mv,
-                        row.update_time
-                    )
-                    for row in batch.itertuples(index=False)
-                ]
-
-                insert_sql = f"""
-INSERT INTO dbo.{valuation_table}
-  (symbol, trade_date, pe, pe_ttm, pb, ps, ps_ttm,
-   dv_ratio, dv_ttm, total_mv, update_time)
-VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?);
-"""
-                try:
-                    cursor.executemany(insert_sql, records)
-                    conn.commit()
-                    count_inserted = len(records)
-                    inserted_this_stock += count_inserted
-                except Exception as e:
-                    print(f"❌ [{prefixed_symbol}] 插入批次失败: {e}")
-                    conn.rollback()
-                    break
-
-            if inserted_this_stock > 0:
-                total_inserted += inserted_this_stock
-                print(f"✅ [{idx}/{len(all_codes)}] {prefixed_symbol} 共插入 {inserted_this_stock} 条估值记录。")
-
-            time.sleep(sleep_interval)
-
-        print(f"\n🎉 全部完成，共插入 {total_inserted} 条估值数据到 [{valuation_table}]。")
+    # 断点续跑：跳过本批次已完成的；--retry-failed 只跑失败的
+    # 初始加载续跑时，已写入暂存表的也跳过（暂存表保留）
+    checkpoint = CheckpointStore(valuation_table, run_id=run_id, path=checkpoint_path)
+    all_codes = checkpoint.pending(all_codes, retry_failed=retry_failed, staged_done=initial_load)
+    print(f"ℹ️ 批次 {checkpoint.run_id}：本次处理 {len(all_codes)} 支。")
+
+    # 共享连接池：连接断开时自动重连并重放当前事务
+    pool = get_pool(conn_str)
+    try:
+        pool.run(lambda conn: conn.cursor().execute(valuation_schema.ddl()))
+
+        # #temp 暂存表随连接存在，每条连接各建一个 upserter
+        def upsert_rows(conn, rows):
+            upserter = conn.session(valuation_table, lambda: BulkUpserter(
+                conn, valuation_table, valuation_schema.column_names,
+                valuation_schema.primary_key, batch_size=batch_size))
+            return upserter.upsert(rows, verbose=False)
+
+        totals = {'inserted': 0, 'updated': 0}
+
+        def write_rows(rows):
+            result = pool.run(upsert_rows, rows)
+            totals['inserted'] += result.inserted
+            totals['updated'] += result.updated
+            print(f"✅ 写库 {len(rows)} 条：新增 {result.inserted} 条，更新 {result.updated} 条估值记录。")
+            # 含坏行的股票不能记为完成：抛出后逐只重放，只有它记为失败，可用 --retry-failed 补跑
+            if result.bad_rows:
+                print(f"❌ {len(result.bad_rows)} 条坏行未写入，首条: {result.bad_rows[0][1]}")
+                raise BadRowsError(result.bad_rows)
+
+        def on_failed(code, err):
+            print(f"⚠️ [{code}] 拉取/清洗/写入估值数据失败: {err}，跳过该股票。")
+            if code:
+                checkpoint.mark_failed(code, err)
+
+        # 全量回填：写无索引暂存堆表，结束后按主键排序入表、一次性建索引
+        initial = InitialLoad(pool, valuation_schema) if initial_load else None
+        if initial:
+            initial.start(keep_existing=bool(checkpoint.staged_items()))
+
+        # 抓取（线程池）→ 清洗（进程池）→ 单一写库线程攒批 upsert
+        writer = BatchingWriter(
+            write_fn=initial.write if initial else write_rows,
+            # 初始加载每次 write 是 pool.run 内的一个事务；upsert 每 batch_size 行各自提交，这里无从回滚，
+            # 失败后的重放（连接池重连、按 key 逐个重放）依赖 MERGE 幂等：已提交的批次再 MERGE 一次不会重复插入
+            commit_fn=lambda: None,
+            rollback_fn=lambda: None,
+            flush_rows=commit_rows,
+            flush_seconds=commit_seconds,
+            # 初始加载时行先进暂存表，finish() 入表后才算完成
+            on_committed=checkpoint.mark_staged if initial else checkpoint.mark_done,
+            on_failed=on_failed,
+        )
+        run_pipeline(
+            [c for c in all_codes if add_prefix(c) is not None],
+            fetch_fn=fetch_valuation_for_symbol,
+            transform_fn=transform_valuation,
+            writer=writer,
+            fetch_workers=fetch_workers,
+            rate=requests_per_second,
+            transform_workers=transform_workers,
+        )
+        if initial:
+            totals['inserted'] = initial.finish()
+            checkpoint.promote_staged()
+            initial.report()
+        total_inserted, total_updated = totals['inserted'], totals['updated']
+
+        fetch_client.report()
+        print(f"\n🎉 全部完成，共新增 {total_inserted} 条、更新 {total_updated} 条估值数据到 [{valuation_table}]。")
+        failed = checkpoint.failed_items()
+        if failed:
+            print(f"⚠️ 批次 {checkpoint.run_id} 仍有 {len(failed)} 支失败，可用 --retry-failed 补跑。")
+        checkpoint.finish_run()
+    finally:
+        checkpoint.close()
+        pool.close()
 
 if __name__ == "__main__":
-    main()
+    parser = argparse.ArgumentParser(description="AkShare A 股估值指标 → SQL Server")
+    parser.add_argument("--refresh-universe", action="store_true",
+                        help="忽略本地股票池缓存，重新拉取")
+    add_checkpoint_args(parser)
+    add_cache_args(parser)
+    add_storage_args(parser)
+    add_initial_load_args(parser)
+    args = parser.parse_args()
+    configure_cache(no_cache=args.no_cache, refresh_cache=args.refresh_cache)
+    configure_storage(valuation_schema, args)
+    main(refresh_universe=args.refresh_universe, run_id=args.run_id, retry_failed=args.retry_failed, checkpoint_path=args.checkpoint,
+         initial_load=args.initial_load)
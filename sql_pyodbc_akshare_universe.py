@@ -0,0 +1,59 @@
+import json
+import os
+import time
+from datetime import datetime
+from typing import List, Optional
+
+import akshare as ak
+
+from sql_pyodbc_akshare_fetch import fetch_client
+
+universe_cache_path = "akshare_universe.json"
+universe_ttl_hours  = 12
+
+sse_prefixes  = {"600", "601", "603", "605", "688", "689"}
+szse_prefixes = {"000", "001", "002", "003", "300", "301"}
+
+# 三位前缀 → 交易所，一次字典查找替代逐个 startswith
+_PREFIX_TO_EXCHANGE = {**{p: "sh" for p in sse_prefixes}, **{p: "sz" for p in szse_prefixes}}
+
+
+def add_prefix(code: str) -> Optional[str]:
+    """'600000' -> 'sh600000'; codes outside the SSE/SZSE main boards map to None"""
+    exchange = _PREFIX_TO_EXCHANGE.get(code[:3])
+    return exchange + code if exchange else None
+
+
+def classify_codes(codes: List[str]) -> List[str]:
+    return [s for s in map(add_prefix, codes) if s is not None]
+
+
+def fetch_a_share_codes() -> List[str]:
+    # 偶发的 JSONDecodeError 等由共享抓取客户端退避重试
+    stock_df = fetch_client.call('stock_info_a_code_name', ak.stock_info_a_code_name)
+    return stock_df['code'].astype(str).str.zfill(6).tolist()
+
+
+def load_symbols(
+    cache_path: str = universe_cache_path,
+    ttl_hours: float = universe_ttl_hours,
+    refresh: bool = False
+) -> List[str]:
+    """
+    Prefixed SSE/SZSE A-share symbols ('sh600000', 'sz000001', ...).
+    Served from the on-disk cache while it is younger than ttl_hours,
+    otherwise fetched from AkShare once and written back.
+    """
+    if not refresh and os.path.exists(cache_path):
+        age_hours = (time.time() - os.path.getmtime(cache_path)) / 3600
+        if age_hours < ttl_hours:
+            with open(cache_path, encoding="utf-8") as f:
+                return json.load(f)["symbols"]
+
+    symbols = classify_codes(fetch_a_share_codes())
+    tmp_path = cache_path + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump({"fetched_at": datetime.now().isoformat(timespec="seconds"),
+                   "symbols": symbols}, f)
+    os.replace(tmp_path, cache_path)
+    return symbols
@@ -0,0 +1,178 @@
+import time
+from typing import List, Optional
+
+from sql_pyodbc_pool import ConnectionPool
+from sql_pyodbc_schema import TableSchema
+from sql_pyodbc_upsert import quote_col
+
+
+class InitialLoad:
+    """
+    Backfill path for a TableSchema table. Rows are appended to a heap staging
+    table ({name}_load: no key, no index, INSERT WITH (TABLOCK)); finish()
+    moves them into the target in one transaction:
+      - empty target: drop its indexes, INSERT ... WITH (TABLOCK) sorted by the
+        primary key (minimally logged into the empty heap under SIMPLE /
+        BULK_LOGGED recovery), then build the primary key and the indexes of
+        the schema's set_storage() options once. A date index or columnstore
+        already on the target is adopted into those options so it is rebuilt
+        too; any other index refuses the load (checked by start()).
+      - non-empty target: set-based UPDATE + INSERT from the staging table.
+    Duplicate keys in the staging table keep the row with the latest update_time.
+    """
+
+    def __init__(self, pool: ConnectionPool, schema: TableSchema, stage_suffix: str = "_load"):
+        self.pool = pool
+        self.schema = schema
+        self.stage = f"{schema.schema}.{schema.name}{stage_suffix}"
+        self.col_list = ", ".join(quote_col(c) for c in schema.column_names)
+        self.insert_sql = (
+            f"INSERT INTO {self.stage} WITH (TABLOCK) ({self.col_list}) "
+            f"VALUES ({', '.join('?' for _ in schema.column_names)})"
+        )
+        self.rows_staged = 0
+        self.stage_seconds = 0.0
+        self.finish_seconds = 0.0
+        self._t0: Optional[float] = None
+
+    def _target_has_rows(self, cur) -> int:
+        cur.execute(f"SELECT CASE WHEN EXISTS (SELECT 1 FROM {self.schema.qualified_name}) THEN 1 ELSE 0 END")
+        return cur.fetchone()[0]
+
+    def _existing_indexes(self, cur) -> List[tuple]:
+        """(name, type, is_primary_key, partitioned) of every index on the target"""
+        cur.execute("""
+SELECT i.name, i.type, i.is_primary_key, CASE WHEN ds.type = 'PS' THEN 1 ELSE 0 END
+FROM sys.indexes i
+JOIN sys.data_spaces ds ON ds.data_space_id = i.data_space_id
+WHERE i.object_id = OBJECT_ID(?) AND i.type > 0
+""", self.schema.qualified_name)
+        return [tuple(r) for r in cur.fetchall()]
+
+    def _match_storage(self, indexes: List[tuple]) -> None:
+        """
+        Make the schema's storage options cover the indexes already on the
+        target, so the rebuild after the sorted insert does not silently lose
+        an index built by an earlier run with other flags.
+        """
+        s = self.schema
+        date_ix = f"IX_{s.name}_{s.date_column}"
+        unknown = [name for name, kind, is_pk, _ in indexes if not is_pk and kind != 5 and name != date_ix]
+        if unknown:
+            raise ValueError(f"{s.qualified_name} has indexes the initial load cannot rebuild: {', '.join(unknown)}")
+        if any(partitioned for *_, partitioned in indexes) and not s.partition_years:
+            raise ValueError(f"{s.qualified_name} is partitioned; pass the same --partition-years to --initial-load")
+        date_index = s.date_index or any(name == date_ix for name, *_ in indexes)
+        columnstore = s.columnstore or any(kind == 5 for _, kind, *_ in indexes)
+        adopted = [label for now, before, label in ((date_index, s.date_index, "日期索引"),
+                                                    (columnstore, s.columnstore, "列存储索引")) if now and not before]
+        if adopted:
+            print(f"ℹ️ {s.name} 已有{'、'.join(adopted)}，初始加载后按原样重建")
+            s.set_storage(date_index, columnstore, s.partition_years, s.date_index_include)
+
+    def start(self, keep_existing: bool = False) -> None:
+        """create the staging heap; keep_existing keeps rows staged by an interrupted run of the same batch"""
+        def prepare(conn):
+            cur = conn.cursor()
+            # 索引不匹配要在抓取之前报错，而不是回填几个小时之后
+            if not self._target_has_rows(cur):
+                self._match_storage(self._existing_indexes(cur))
+            drop = "" if keep_existing else f"IF OBJECT_ID(N'{self.stage}', 'U') IS NOT NULL DROP TABLE {self.stage};"
+            cur.execute(f"""
+{drop}
+IF OBJECT_ID(N'{self.stage}', 'U') IS NULL
+    SELECT TOP 0 {self.col_list} INTO {self.stage} FROM {self.schema.qualified_name};
+""")
+
+        self.pool.run(prepare)
+        self._t0 = time.perf_counter()
+
+    def write(self, rows: List[tuple]) -> None:
+        t0 = time.perf_counter()
+        self.pool.run(lambda conn: conn.cursor().executemany(self.insert_sql, rows))
+        self.stage_seconds += time.perf_counter() - t0
+        self.rows_staged += len(rows)
+
+    def _dedupe_sql(self) -> str:
+        keys = ", ".join(quote_col(k) for k in self.schema.primary_key)
+        order = "[update_time] DESC" if "update_time" in self.schema.column_names else "(SELECT NULL)"
+        return f"""
+WITH d AS (
+    SELECT ROW_NUMBER() OVER (PARTITION BY {keys} ORDER BY {order}) AS rn FROM {self.stage}
+)
+DELETE FROM d WHERE rn > 1;
+"""
+
+    def _drop_indexes(self, cur, indexes: List[tuple]) -> None:
+        t = self.schema.qualified_name
+        # 先删非聚集索引，再删聚集 / 列存储，避免重复重建
+        for name, kind, is_pk, _ in sorted(indexes, key=lambda ix: ix[1] in (1, 5)):
+            if is_pk:
+                cur.execute(f"ALTER TABLE {t} DROP CONSTRAINT {quote_col(name)};")
+            else:
+                cur.execute(f"DROP INDEX {quote_col(name)} ON {t};")
+
+    def _bulk_insert(self, conn) -> int:
+        keys = ", ".join(quote_col(k) for k in self.schema.primary_key)
+        cur = conn.cursor()
+        indexes = self._existing_indexes(cur)
+        self._match_storage(indexes)
+        self._drop_indexes(cur, indexes)
+        cur.execute(f"""
+INSERT INTO {self.schema.qualified_name} WITH (TABLOCK) ({self.col_list})
+SELECT {self.col_list} FROM {self.stage} ORDER BY {keys};
+""")
+        n = cur.rowcount
+        if not self.schema.columnstore:
+            cur.execute(self.schema.primary_key_sql())
+        # 列存储时由 index_ddl 先建列存储索引，再补非聚集主键
+        cur.execute(self.schema.index_ddl())
+        return n
+
+    def _upsert(self, conn) -> int:
+        t = self.schema.qualified_name
+        on_clause = " AND ".join(f"t.{quote_col(k)} = s.{quote_col(k)}" for k in self.schema.primary_key)
+        set_clause = ", ".join(f"{quote_col(c)} = s.{quote_col(c)}"
+                               for c in self.schema.column_names if c not in self.schema.primary_key)
+        first_key = quote_col(self.schema.primary_key[0])
+        cur = conn.cursor()
+        cur.execute(f"UPDATE t SET {set_clause} FROM {t} AS t JOIN {self.stage} AS s ON {on_clause};")
+        cur.execute(f"""
+INSERT INTO {t} WITH (TABLOCK) ({self.col_list})
+SELECT {', '.join(f's.{quote_col(c)}' for c in self.schema.column_names)}
+FROM {self.stage} AS s
+LEFT JOIN {t} AS t ON {on_clause}
+WHERE t.{first_key} IS NULL;
+""")
+        return cur.rowcount
+
+    def finish(self) -> int:
+        """move the staged rows into the target; returns the number of rows inserted"""
+        t0 = time.perf_counter()
+
+        def move(conn):
+            cur = conn.cursor()
+            cur.execute(self._dedupe_sql())
+            target_has_rows = self._target_has_rows(cur)
+            n = self._upsert(conn) if target_has_rows else self._bulk_insert(conn)
+            cur.execute(f"DROP TABLE {self.stage};")
+            return n, target_has_rows
+
+        inserted, target_had_rows = self.pool.run(move)
+        self.finish_seconds = time.perf_counter() - t0
+        mode = "目标表非空，已合并" if target_had_rows else "已排序写入空表并重建索引"
+        print(f"✔️ 初始加载：{mode}，新增 {inserted} 条")
+        return inserted
+
+    def report(self) -> None:
+        total = time.perf_counter() - self._t0 if self._t0 is not None else 0.0
+        stage_rate = self.rows_staged / self.stage_seconds if self.stage_seconds else 0.0
+        total_rate = self.rows_staged / total if total else 0.0
+        print(f"📈 暂存 {self.rows_staged} 行，写库 {self.stage_seconds:.1f} s（{stage_rate:,.0f} 行/秒）；"
+              f"入表 + 建索引 {self.finish_seconds:.1f} s；总计 {total:.1f} s（{total_rate:,.0f} 行/秒）")
+
+
+def add_initial_load_args(parser) -> None:
+    """shared --initial-load flag for loader CLIs"""
+    parser.add_argument("--initial-load", action="store_true",
+                        help="全量回填：先写无索引暂存堆表，最后排序入表并一次性建索引")
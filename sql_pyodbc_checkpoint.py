@@ -0,0 +1,160 @@
+import sqlite3
+from datetime import datetime
+from typing import Iterable, List, Optional
+
+default_checkpoint_path = "loader_checkpoint.sqlite3"
+
+
+class CheckpointStore:
+    """
+    Local SQLite checkpoint for loader runs.
+    One row per (job, run_id, item) with status, row count and last error,
+    so an interrupted backfill resumes where it stopped and failed items
+    can be re-run on their own.
+
+    Without an explicit run_id the latest run of the job that was never
+    finished (finish_run()) is resumed; a new run_id (start timestamp) is
+    only opened once the previous run completed.
+    """
+
+    def __init__(self, job: str, run_id: Optional[str] = None, path: str = default_checkpoint_path):
+        self.job = job
+        self.conn = sqlite3.connect(path)
+        self.conn.execute("""
+CREATE TABLE IF NOT EXISTS checkpoint_run (
+    job         TEXT    NOT NULL,
+    run_id      TEXT    NOT NULL,
+    start_time  TEXT    NOT NULL,
+    finish_time TEXT    NULL,
+    PRIMARY KEY (job, run_id)
+)
+""")
+        self.conn.execute("""
+CREATE TABLE IF NOT EXISTS checkpoint (
+    job         TEXT    NOT NULL,
+    run_id      TEXT    NOT NULL,
+    item        TEXT    NOT NULL,
+    status      TEXT    NOT NULL,
+    row_count   INTEGER NULL,
+    attempts    INTEGER NOT NULL DEFAULT 0,
+    last_error  TEXT    NULL,
+    update_time TEXT    NOT NULL,
+    PRIMARY KEY (job, run_id, item)
+)
+""")
+        self.resumed = False
+        if run_id is None:
+            row = self.conn.execute(
+                "SELECT run_id FROM checkpoint_run WHERE job = ? AND finish_time IS NULL "
+                "ORDER BY start_time DESC, run_id DESC LIMIT 1",
+                (job,),
+            ).fetchone()
+            self.resumed = row is not None
+            run_id = row[0] if row else datetime.now().strftime("%Y-%m-%d-%H%M%S")
+            if self.resumed:
+                print(f"ℹ️ {job}：续跑未完成的批次 {run_id}（新开批次请指定 --run-id）")
+        self.run_id = run_id
+        # 显式指定的已完成批次重新打开，直到再次 finish_run()
+        self.conn.execute("""
+INSERT INTO checkpoint_run (job, run_id, start_time, finish_time) VALUES (?, ?, ?, NULL)
+ON CONFLICT (job, run_id) DO UPDATE SET finish_time = NULL
+""", (self.job, self.run_id, datetime.now().isoformat(timespec="seconds")))
+        self.conn.commit()
+
+    def _record(self, item: str, status: str, row_count: Optional[int], error: Optional[str]) -> None:
+        self.conn.execute("""
+INSERT INTO checkpoint (job, run_id, item, status, row_count, attempts, last_error, update_time)
+VALUES (?, ?, ?, ?, ?, 1, ?, ?)
+ON CONFLICT (job, run_id, item) DO UPDATE SET
+    status      = excluded.status,
+    row_count   = excluded.row_count,
+    attempts    = checkpoint.attempts + 1,
+    last_error  = excluded.last_error,
+    update_time = excluded.update_time
+""", (self.job, self.run_id, item, status, row_count, error, datetime.now().isoformat(timespec="seconds")))
+        self.conn.commit()
+
+    def mark_done(self, item: str, row_count: int = 0) -> None:
+        self._record(item, "done", row_count, None)
+
+    def mark_failed(self, item: str, error: object) -> None:
+        self._record(item, "failed", None, str(error)[:1000])
+
+    def mark_staged(self, item: str, row_count: int = 0) -> None:
+        """rows written to an initial-load staging table, not yet moved into the target"""
+        self._record(item, "staged", row_count, None)
+
+    def promote_staged(self) -> int:
+        """staged -> done once the staging table has been moved into the target"""
+        cur = self.conn.execute(
+            "UPDATE checkpoint SET status = 'done', update_time = ? WHERE job = ? AND run_id = ? AND status = 'staged'",
+            (datetime.now().isoformat(timespec="seconds"), self.job, self.run_id),
+        )
+        self.conn.commit()
+        return cur.rowcount
+
+    def _items(self, status: str) -> List[str]:
+        rows = self.conn.execute(
+            "SELECT item FROM checkpoint WHERE job = ? AND run_id = ? AND status = ?",
+            (self.job, self.run_id, status),
+        ).fetchall()
+        return [r[0] for r in rows]
+
+    def done_items(self) -> List[str]:
+        return self._items("done")
+
+    def failed_items(self) -> List[str]:
+        return self._items("failed")
+
+    def staged_items(self) -> List[str]:
+        return self._items("staged")
+
+    def pending(self, items: Iterable[str], retry_failed: bool = False, staged_done: bool = False) -> List[str]:
+        """
+        items still to run: failed ones only with retry_failed, otherwise
+        everything not done. staged_done (resuming an initial load whose
+        staging table is kept) also skips staged items.
+        """
+        items = list(items)
+        if retry_failed:
+            failed = set(self.failed_items())
+            return [i for i in items if i in failed]
+        done = set(self.done_items())
+        if staged_done:
+            done.update(self.staged_items())
+        return [i for i in items if i not in done]
+
+    def finish_run(self) -> bool:
+        """
+        close the run unless items are still failed or staged; the next store
+        opened without a run_id then starts a new run. Returns whether it closed.
+        """
+        if self.failed_items() or self.staged_items():
+            return False
+        self.conn.execute(
+            "UPDATE checkpoint_run SET finish_time = ? WHERE job = ? AND run_id = ?",
+            (datetime.now().isoformat(timespec="seconds"), self.job, self.run_id),
+        )
+        self.conn.commit()
+        return True
+
+    def summary(self) -> dict:
+        rows = self.conn.execute(
+            "SELECT status, COUNT(*), COALESCE(SUM(row_count), 0) FROM checkpoint "
+            "WHERE job = ? AND run_id = ? GROUP BY status",
+            (self.job, self.run_id),
+        ).fetchall()
+        return {status: (count, row_count) for status, count, row_count in rows}
+
+    def close(self) -> None:
+        self.conn.close()
+
+
+def add_checkpoint_args(parser) -> None:
+    """shared --run-id / --retry-failed / --checkpoint flags for loader CLIs"""
+    parser.add_argument("--run-id", default=None,
+                        help="断点续跑批次号，默认续跑最近一个未完成的批次，上一批次已完成时新开批次（启动时间）")
+    parser.add_argument("--retry-failed", action="store_true",
+                        help="只重跑该批次中失败的标的")
+    parser.add_argument("--checkpoint", default=default_checkpoint_path,
+                        help="断点文件路径 (SQLite)")
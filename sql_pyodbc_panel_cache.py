@@ -0,0 +1,335 @@
+"""
+Local cache of named research panels (close x symbol, pb x symbol, sector
+panels ...) as memory-mapped .npy files.
+
+An entry is keyed by (panel name, parameters) and stamped with
+MAX(update_time) of its source table over the panel's date range (or another
+aggregate where the table has no maintained update_time, plus the version of
+any local input, e.g. the Shenwan mapping file of the sector
+panels); get() re-checks that stamp with one aggregate query and only
+rebuilds when it has changed, otherwise the arrays are np.load(mmap_mode='r')
+views of the files.
+
+    python sql_pyodbc_panel_cache.py close --start 2015-01-01 --end 2025-01-01
+    python sql_pyodbc_panel_cache.py --check
+"""
+import argparse
+import hashlib
+import json
+import os
+import shutil
+import time
+from datetime import date, datetime
+from typing import Callable, Dict, Optional
+
+import numpy as np
+
+from sql_pyodbc_pool import ConnectionPool
+from sql_pyodbc_reader import TableReader
+
+panel_cache_dir = "panel_cache"
+
+Arrays = Dict[str, np.ndarray]
+
+
+class PanelQuery:
+    """
+    A named panel: build(pool, start, end, **params) returns the arrays to
+    store; table / date_column say which rows' update_time invalidate it
+    (date_column None: the whole table). stamp_expr replaces
+    MAX([stamp_column]) for tables no loader stamps. version(**params), if
+    given, adds the version of an input outside the database (e.g. a local
+    file's hash).
+    """
+
+    def __init__(
+        self,
+        name: str,
+        table: str,
+        build: Callable[..., Arrays],
+        date_column: Optional[str] = None,
+        stamp_column: str = "update_time",
+        version: Optional[Callable[..., Optional[str]]] = None,
+        stamp_expr: Optional[str] = None
+    ):
+        self.name = name
+        self.table = table
+        self.build = build
+        self.date_column = date_column
+        self.stamp_column = stamp_column
+        self.version = version
+        self.stamp_expr = stamp_expr or f"MAX([{stamp_column}])"
+
+    def stamp_sql(self) -> str:
+        sql = f"SELECT {self.stamp_expr} FROM dbo.{self.table}"
+        if self.date_column:
+            sql += f" WHERE [{self.date_column}] >= ? AND [{self.date_column}] < ?"
+        return sql
+
+
+def dense_panel(reader: TableReader, column: str, start: str, end: str) -> Arrays:
+    """stream (symbol, date, column) by date range into a (dates x symbols) float64 panel, NaN where missing"""
+    sym_ids: Dict[str, int] = {}
+    parts = []
+    for chunk in reader.by_dates(start, end):
+        uniq, inv = np.unique(chunk[reader.symbol_column], return_inverse=True)
+        ids = np.array([sym_ids.setdefault(s, len(sym_ids)) for s in uniq], dtype=np.int32)
+        parts.append((ids[inv], chunk[reader.date_column].astype("datetime64[D]"), chunk[column]))
+
+    if not parts:
+        return {"dates": np.array([], dtype="datetime64[D]"), "symbols": np.array([], dtype="U10"),
+                "values": np.empty((0, 0))}
+    sid = np.concatenate([p[0] for p in parts])
+    day = np.concatenate([p[1] for p in parts])
+    val = np.concatenate([p[2] for p in parts])
+    del parts
+
+    symbols = np.array(list(sym_ids), dtype=str)
+    order = np.argsort(symbols)
+    rank = np.empty_like(order)
+    rank[order] = np.arange(len(order))
+    dates, di = np.unique(day, return_inverse=True)
+    values = np.full((len(dates), len(symbols)), np.nan)
+    values[di, rank[sid]] = val
+    return {"dates": dates, "symbols": symbols[order], "values": values}
+
+
+def value_panel(schema_name: str, column: str) -> Callable[..., Arrays]:
+    def build(pool: ConnectionPool, start: str, end: str) -> Arrays:
+        # 只在构建时导入 loader 模块（它们依赖 akshare）
+        from sql_pyodbc_akshare_stock_cap import cap_schema
+        from sql_pyodbc_akshare_stock_daily import daily_schema
+        from sql_pyodbc_akshare_stock_value import valuation_schema
+
+        schema = {s.name: s for s in (daily_schema, cap_schema, valuation_schema)}[schema_name]
+        reader = TableReader(pool, schema, columns=[schema.primary_key[0], schema.date_column, column])
+        return dense_panel(reader, column, start, end)
+    return build
+
+
+def sector_version(vintage: Optional[str] = None) -> Optional[str]:
+    """sha1 of the local Shenwan mapping the sector panels are mapped through"""
+    from sql_pyodbc_akshare_stock_sector import mapping_version, sw_default_vintage
+
+    return mapping_version(vintage or sw_default_vintage)
+
+
+# dbo.stock_sector 不由本仓库的脚本写入，update_time 无人维护；改用其被读取的三列的行数 + 校验和
+sector_stamp_expr = "CONCAT(COUNT_BIG(*), ':', CHECKSUM_AGG(CHECKSUM([symbol], [start_date], [industry_code])))"
+
+
+def sector_panels(pool: ConnectionPool, start: str, end: str, vintage: Optional[str] = None) -> Arrays:
+    from sql_pyodbc_akshare_stock_sector import build_sector_panels, sw_default_vintage
+
+    # 分类表或申万映射有变化时才让 build_sector_panels 丢弃进程内缓存的区间存储
+    content = pool.run(lambda conn: conn.cursor().execute(
+        f"SELECT {sector_stamp_expr} FROM dbo.stock_sector").fetchone()[0])
+    # 面板区间为 [start, end)，build_sector_panels 的 end 是闭区间
+    last = str(np.datetime64(end, "D") - np.timedelta64(1, "D"))
+    sector_df, industry_df = build_sector_panels(start, last, vintage=vintage or sw_default_vintage,
+                                                 source_version=f"{content}|{sector_version(vintage)}")
+    out = {"dates": sector_df.index.to_numpy(dtype="datetime64[D]"),
+           "symbols": np.array(sector_df.columns, dtype=str)}
+    for level, df in (("level1", sector_df), ("level3", industry_df)):
+        categories = df.iloc[:, 0].cat.categories if df.shape[1] else []
+        out[f"{level}_codes"] = np.stack([df[c].cat.codes.to_numpy() for c in df.columns], axis=1) \
+            if df.shape[1] else np.empty((len(df), 0), dtype=np.int16)
+        out[f"{level}_categories"] = np.array(list(categories), dtype=str)
+    return out
+
+
+panel_queries: Dict[str, PanelQuery] = {q.name: q for q in (
+    PanelQuery("close",    "stock_a_daily",     value_panel("stock_a_daily", "close"),        "trade_date"),
+    PanelQuery("pb",       "stock_valuation",   value_panel("stock_valuation", "pb"),         "trade_date"),
+    PanelQuery("total_mv", "stock_a_share_cap", value_panel("stock_a_share_cap", "total_mv"), "data_date"),
+    PanelQuery("sector",   "stock_sector",      sector_panels, version=sector_version,
+               stamp_expr=sector_stamp_expr),
+)}
+
+
+def _iso(value) -> Optional[str]:
+    return value.isoformat() if isinstance(value, (date, datetime)) else (None if value is None else str(value))
+
+
+class PanelCache:
+    """
+    {root}/{name}/{sha1(params)}/ holds one .npy per array plus meta.json
+    (params, source stamp, build time). Entries are replaced atomically, so a
+    reader never sees a half-written panel.
+    """
+
+    def __init__(self, pool: ConnectionPool, root: str = panel_cache_dir,
+                 queries: Optional[Dict[str, PanelQuery]] = None):
+        self.pool = pool
+        self.root = root
+        self.queries = queries if queries is not None else panel_queries
+        self.hits = 0
+        self.misses = 0
+
+    def path_for(self, name: str, params: dict) -> str:
+        key = json.dumps(params, sort_keys=True, default=str)
+        return os.path.join(self.root, name, hashlib.sha1(key.encode("utf-8")).hexdigest()[:16])
+
+    def stamp(self, query: PanelQuery, start: str, end: str, **params) -> Optional[str]:
+        args = (start, end) if query.date_column else ()
+        stamp = _iso(self.pool.run(lambda conn: conn.cursor().execute(query.stamp_sql(), args).fetchone()[0]))
+        if query.version is not None:
+            stamp = f"{stamp}|{query.version(**params)}"
+        return stamp
+
+    def _read_meta(self, path: str) -> Optional[dict]:
+        try:
+            with open(os.path.join(path, "meta.json"), encoding="utf-8") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def _write(self, path: str, arrays: Arrays, meta: dict) -> None:
+        tmp = f"{path}.{os.getpid()}.tmp"
+        shutil.rmtree(tmp, ignore_errors=True)
+        os.makedirs(tmp)
+        for key, arr in arrays.items():
+            np.save(os.path.join(tmp, f"{key}.npy"), np.ascontiguousarray(arr), allow_pickle=False)
+        with open(os.path.join(tmp, "meta.json"), "w", encoding="utf-8") as f:
+            json.dump({**meta, "arrays": sorted(arrays)}, f, ensure_ascii=False, indent=1)
+        old = f"{path}.{os.getpid()}.old"
+        if os.path.exists(path):
+            os.replace(path, old)
+        os.replace(tmp, path)
+        # 旧文件可能仍被其他进程映射（Windows 上无法删除），删除失败无妨
+        shutil.rmtree(old, ignore_errors=True)
+
+    def _load(self, path: str, meta: dict) -> Arrays:
+        return {key: np.load(os.path.join(path, f"{key}.npy"), mmap_mode="r", allow_pickle=False)
+                for key in meta["arrays"]}
+
+    def get(self, name: str, start: str, end: str, refresh: bool = False, **params) -> Arrays:
+        """arrays of panel `name` for [start, end); rebuilt only if the source stamp changed"""
+        query = self.queries[name]
+        full_params = {"start": start, "end": end, **params}
+        path = self.path_for(name, full_params)
+        stamp = self.stamp(query, start, end, **params)
+
+        meta = None if refresh else self._read_meta(path)
+        if meta is not None and meta.get("stamp") == stamp:
+            self.hits += 1
+            return self._load(path, meta)
+
+        self.misses += 1
+        t0 = time.perf_counter()
+        arrays = query.build(self.pool, start, end, **params)
+        self._write(path, arrays, {"name": name, "params": full_params, "table": query.table, "stamp": stamp,
+                                   "built_at": datetime.now().isoformat(timespec="seconds"),
+                                   "build_seconds": round(time.perf_counter() - t0, 3)})
+        return self._load(path, self._read_meta(path))
+
+    def frame(self, name: str, start: str, end: str, key: str = "values", **params):
+        """(dates x symbols) DataFrame over the memory-mapped array, without copying it"""
+        import pandas as pd
+
+        arrays = self.get(name, start, end, **params)
+        return pd.DataFrame(arrays[key], index=pd.DatetimeIndex(arrays["dates"], name="date"),
+                            columns=pd.Index(arrays["symbols"], name="symbol"), copy=False)
+
+    def clear(self, name: Optional[str] = None) -> None:
+        shutil.rmtree(os.path.join(self.root, name) if name else self.root, ignore_errors=True)
+
+
+def _self_check() -> None:
+    """
+    A SQLite file attached as `dbo` stands in for SQL Server: the second get()
+    must be a memory-mapped hit equal to the first build, a write with a newer
+    update_time inside the range must rebuild, and one outside it must not;
+    a new version of a local input must rebuild too.
+    """
+    import sqlite3
+    import tempfile
+
+    from sql_pyodbc_schema import Column, TableSchema
+
+    schema = TableSchema('stock_a_daily', [
+        Column('symbol',      'VARCHAR(10)',  nullable=False),
+        Column('trade_date',  'DATE',         nullable=False),
+        Column('close',       'DECIMAL(9,4)'),
+        Column('update_time', 'DATETIME',     nullable=False),
+    ], primary_key=['symbol', 'trade_date'])
+
+    tmp = tempfile.mkdtemp()
+    db_path = os.path.join(tmp, "panel_check.sqlite3")
+    rng = np.random.default_rng(0)
+    days = np.datetime64('2020-01-01') + np.arange(400)
+    with sqlite3.connect(db_path) as c:
+        c.execute("CREATE TABLE stock_a_daily (symbol TEXT, trade_date TEXT, close REAL, update_time TEXT, "
+                  "PRIMARY KEY (symbol, trade_date))")
+        c.executemany("INSERT INTO stock_a_daily VALUES (?, ?, ?, '2024-01-01 00:00:00')",
+                      [(f"sz{s:06d}", str(d), float(p)) for s in range(300)
+                       for d, p in zip(days, rng.uniform(5, 50, len(days))) if rng.random() > 0.05])
+
+    def connect():
+        conn = sqlite3.connect(":memory:", check_same_thread=False)
+        conn.execute(f"ATTACH DATABASE '{db_path}' AS dbo")
+        return conn
+
+    pool = ConnectionPool(db_path, size=1, fast_executemany=False, connect_fn=connect)
+
+    def build(pool, start, end):
+        return dense_panel(TableReader(pool, schema, columns=['symbol', 'trade_date', 'close']), 'close', start, end)
+
+    mapping = {"version": "a"}
+    cache = PanelCache(pool, root=os.path.join(tmp, "panels"), queries={
+        "close": PanelQuery("close", "stock_a_daily", build, "trade_date"),
+        "close_mapped": PanelQuery("close_mapped", "stock_a_daily", build, "trade_date",
+                                   version=lambda: mapping["version"]),
+    })
+
+    t0 = time.perf_counter()
+    first = cache.get("close", "2020-01-01", "2020-12-01")
+    t_build = time.perf_counter() - t0
+    t0 = time.perf_counter()
+    second = cache.get("close", "2020-01-01", "2020-12-01")
+    t_hit = time.perf_counter() - t0
+    assert isinstance(second["values"], np.memmap) and cache.hits == 1 and cache.misses == 1
+    assert np.array_equal(np.asarray(first["values"]), np.asarray(second["values"]), equal_nan=True)
+
+    with sqlite3.connect(db_path) as c:
+        row = c.execute("SELECT symbol, trade_date FROM stock_a_daily WHERE trade_date = '2020-06-01' LIMIT 1").fetchone()
+        c.execute("UPDATE stock_a_daily SET close = 99.5, update_time = '2024-02-01 00:00:00' "
+                  "WHERE symbol = ? AND trade_date = ?", row)
+        c.execute("UPDATE stock_a_daily SET update_time = '2024-03-01 00:00:00' WHERE trade_date = '2021-01-15'")
+    df = cache.frame("close", "2020-01-01", "2020-12-01")
+    assert cache.misses == 2 and df.loc[row[1], row[0]] == 99.5
+    cache.get("close", "2020-01-01", "2020-12-01")
+    assert cache.misses == 2 and cache.hits == 2
+
+    cache.get("close_mapped", "2020-01-01", "2020-03-01")
+    cache.get("close_mapped", "2020-01-01", "2020-03-01")
+    assert cache.misses == 3 and cache.hits == 3
+    mapping["version"] = "b"
+    cache.get("close_mapped", "2020-01-01", "2020-03-01")
+    assert cache.misses == 4
+    pool.close()
+    print(f"panel {df.shape}: build {t_build * 1000:.0f} ms, memory-mapped hit {t_hit * 1000:.1f} ms")
+    print("✅ panel cache self-check passed")
+
+
+if __name__ == "__main__":
+    from sql_pyodbc_pool import get_pool
+
+    parser = argparse.ArgumentParser(description="研究面板本地缓存（update_time 推进时失效）")
+    parser.add_argument("name", nargs="?", choices=sorted(panel_queries))
+    parser.add_argument("--start", default="2010-01-01")
+    parser.add_argument("--end", default=date.today().isoformat())
+    parser.add_argument("--refresh", action="store_true", help="忽略缓存重新构建")
+    parser.add_argument("--check", action="store_true", help="在本地 SQLite 上自检")
+    args = parser.parse_args()
+
+    if args.check or args.name is None:
+        _self_check()
+    else:
+        pool = get_pool('DSN,UID,PWD')
+        cache = PanelCache(pool)
+        t0 = time.perf_counter()
+        arrays = cache.get(args.name, args.start, args.end, refresh=args.refresh)
+        shapes = {k: v.shape for k, v in arrays.items()}
+        print(f"✔️ {args.name} {'命中缓存' if cache.hits else '已重建'}，{time.perf_counter() - t0:.2f} s：{shapes}")
+        pool.close()
@@ -0,0 +1,63 @@
+import numpy as np
+import pandas as pd
+from typing import Dict, Iterable, List, Optional, Sequence
+
+
+def column_to_params(
+    s: pd.Series,
+    scale: Optional[int] = None,
+    as_date: bool = False
+) -> list:
+    """
+    One column -> list of pyodbc-ready Python objects, in a single vectorized pass.
+    as_date:   coerce to datetime.date (unparseable -> None)
+    scale:     coerce to numeric and round to the DECIMAL scale; scale 0 gives ints
+    otherwise: datetimes -> datetime.datetime, numbers/strings kept, NaN/NaT -> None
+    """
+    if as_date or pd.api.types.is_datetime64_any_dtype(s.dtype):
+        ts = pd.to_datetime(s, errors='coerce')
+        if getattr(ts.dt, 'tz', None) is not None:
+            ts = ts.dt.tz_localize(None)
+        arr = ts.to_numpy(dtype='datetime64[us]')
+        mask = np.isnat(arr)
+        out = arr.astype('datetime64[D]' if as_date else 'datetime64[us]').astype(object)
+    elif scale is not None or pd.api.types.is_numeric_dtype(s.dtype) and not pd.api.types.is_bool_dtype(s.dtype):
+        if isinstance(s.dtype, np.dtype) and s.dtype.kind in 'iu' and scale in (None, 0):
+            # numpy 整型列不含缺失值，无需经过 float
+            return s.to_numpy().astype(object).tolist()
+        if scale is None and pd.api.types.is_integer_dtype(s.dtype):
+            scale = 0
+        arr = pd.to_numeric(s, errors='coerce').to_numpy(dtype='float64', na_value=np.nan)
+        if scale is not None:
+            arr = np.round(arr, scale)
+        mask = np.isnan(arr)
+        if scale == 0:
+            out = np.where(mask, 0, arr).astype(np.int64).astype(object)
+        else:
+            out = arr.astype(object)
+    else:
+        out = s.to_numpy(dtype=object, na_value=None).copy()
+        mask = pd.isna(out)
+
+    out[mask] = None
+    return out.tolist()
+
+
+def frame_to_params(
+    df: pd.DataFrame,
+    columns: Sequence[str],
+    scales: Optional[Dict[str, int]] = None,
+    date_cols: Iterable[str] = ()
+) -> List[tuple]:
+    """
+    DataFrame -> list of row tuples for cursor.executemany.
+    Converts column by column (no per-row Python work besides the final zip),
+    avoiding the object-upcast of df.values and per-row pd.notna checks.
+    """
+    scales = scales or {}
+    date_cols = set(date_cols)
+    col_values = [
+        column_to_params(df[c], scale=scales.get(c), as_date=c in date_cols)
+        for c in columns
+    ]
+    return list(zip(*col_values))
@@ -0,0 +1,169 @@
+import queue
+import threading
+import time
+from concurrent.futures import Future, ProcessPoolExecutor
+from typing import Any, Callable, Iterable, List, Optional
+
+from sql_pyodbc_akshare_fetch import fetch_concurrently
+
+_END = object()
+
+
+class BatchingWriter:
+    """
+    Single DB writer that groups rows from many keys into one write + commit,
+    flushing when flush_rows rows are buffered or flush_seconds have passed.
+    If a grouped flush fails it is rolled back and replayed key by key,
+    so one bad symbol does not take the rest of the batch down with it.
+    """
+
+    def __init__(
+        self,
+        write_fn: Callable[[List[tuple]], Any],
+        commit_fn: Callable[[], Any],
+        rollback_fn: Callable[[], Any],
+        flush_rows: int = 50000,
+        flush_seconds: float = 10.0,
+        on_committed: Optional[Callable[[Any, int], Any]] = None,
+        on_failed: Optional[Callable[[Any, BaseException], Any]] = None,
+    ):
+        self.write_fn = write_fn
+        self.commit_fn = commit_fn
+        self.rollback_fn = rollback_fn
+        self.flush_rows = flush_rows
+        self.flush_seconds = flush_seconds
+        self.on_committed = on_committed or (lambda key, n: None)
+        self.on_failed = on_failed or (lambda key, err: None)
+
+        self._pending = []
+        self._n_rows = 0
+        self._last_flush = time.monotonic()
+        self.rows_written = 0
+        self.commits = 0
+
+    def add(self, key: Any, rows: List[tuple]) -> None:
+        self._pending.append((key, rows))
+        self._n_rows += len(rows)
+        if self._n_rows >= self.flush_rows:
+            self.flush()
+
+    def maybe_flush(self) -> None:
+        if self._pending and time.monotonic() - self._last_flush >= self.flush_seconds:
+            self.flush()
+
+    def _write(self, rows: List[tuple]) -> None:
+        if rows:
+            self.write_fn(rows)
+        self.commit_fn()
+        self.commits += 1
+        self.rows_written += len(rows)
+
+    def flush(self) -> None:
+        pending, self._pending = self._pending, []
+        self._n_rows = 0
+        self._last_flush = time.monotonic()
+        if not pending:
+            return
+        try:
+            self._write([r for _, rows in pending for r in rows])
+            for key, rows in pending:
+                self.on_committed(key, len(rows))
+        except Exception:
+            self.rollback_fn()
+            for key, rows in pending:
+                try:
+                    self._write(rows)
+                    self.on_committed(key, len(rows))
+                except Exception as e:
+                    self.rollback_fn()
+                    self.on_failed(key, e)
+
+
+def _run_inline(fn: Callable, *args) -> Future:
+    fut = Future()
+    try:
+        fut.set_result(fn(*args))
+    except Exception as e:
+        fut.set_exception(e)
+    return fut
+
+
+def run_pipeline(
+    keys: Iterable[Any],
+    fetch_fn: Callable[[Any], Any],
+    transform_fn: Callable[[Any, Any], List[tuple]],
+    writer: BatchingWriter,
+    fetch_workers: int = 8,
+    rate: float = 10.0,
+    transform_workers: int = 4,
+    queue_size: int = 64,
+) -> None:
+    """
+    fetch (thread pool, token-bucket limited) -> transform (process pool)
+    -> writer (caller's thread, owns the connection), linked by bounded queues
+    so the DB keeps writing while HTTP calls are in flight and vice versa.
+
+    transform_fn(key, raw) must be a picklable module-level function returning
+    executemany-ready row tuples; transform_workers=0 runs it in-thread instead.
+    Fetch / transform errors are reported through writer.on_failed.
+    """
+    fetched = queue.Queue(maxsize=queue_size)
+    transformed = queue.Queue(maxsize=queue_size)
+    pool = ProcessPoolExecutor(max_workers=transform_workers) if transform_workers else None
+
+    def _fetch_stage():
+        try:
+            for item in fetch_concurrently(keys, fetch_fn, max_workers=fetch_workers, rate=rate):
+                fetched.put(item)
+        except Exception as e:
+            fetched.put((None, None, e))
+        finally:
+            fetched.put(_END)
+
+    def _transform_stage():
+        try:
+            while True:
+                item = fetched.get()
+                if item is _END:
+                    break
+                key, raw, err = item
+                if err is not None:
+                    transformed.put((key, None, err))
+                elif pool is not None:
+                    transformed.put((key, pool.submit(transform_fn, key, raw), None))
+                else:
+                    transformed.put((key, _run_inline(transform_fn, key, raw), None))
+        finally:
+            transformed.put(_END)
+
+    stages = [
+        threading.Thread(target=_fetch_stage, name="pipeline-fetch", daemon=True),
+        threading.Thread(target=_transform_stage, name="pipeline-transform", daemon=True),
+    ]
+    for t in stages:
+        t.start()
+
+    try:
+        while True:
+            try:
+                item = transformed.get(timeout=writer.flush_seconds)
+            except queue.Empty:
+                writer.maybe_flush()
+                continue
+            if item is _END:
+                break
+            key, fut, err = item
+            if err is None:
+                try:
+                    rows = fut.result()
+                except Exception as e:
+                    err = e
+            if err is not None:
+                writer.on_failed(key, err)
+                continue
+            writer.add(key, rows or [])
+            writer.maybe_flush()
+        writer.flush()
+    finally:
+        if pool is not None:
+            pool.shutdown(cancel_futures=True)
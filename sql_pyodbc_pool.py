@@ -0,0 +1,299 @@
+import queue
+import threading
+import time
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, Optional
+
+import pyodbc
+
+# 连接断开 / 通讯链路失败 / 超时 / 死锁牺牲品：换一条连接重试即可
+transient_sqlstates = {
+    "08S01", "08001", "08003", "08004", "08007",
+    "HYT00", "HYT01",
+    "40001",
+}
+
+
+def is_transient(err: BaseException) -> bool:
+    """pyodbc error whose SQLSTATE means the connection (not the data) was the problem"""
+    if not isinstance(err, pyodbc.Error):
+        return False
+    sqlstate = err.args[0] if err.args else ""
+    return sqlstate in transient_sqlstates
+
+
+class PooledConnection:
+    """
+    Connection handed out by ConnectionPool. Cursors get the pool's
+    fast_executemany policy; everything else is delegated to the raw
+    connection. session() keeps per-connection objects (e.g. a BulkUpserter
+    and its #temp stage) that must be rebuilt after a reconnect.
+    """
+
+    def __init__(self, raw: Any, fast_executemany: bool):
+        self.raw = raw
+        self.fast_executemany = fast_executemany
+        self.last_used = time.monotonic()
+        self._session: Dict[str, Any] = {}
+
+    def cursor(self):
+        cur = self.raw.cursor()
+        if self.fast_executemany:
+            cur.fast_executemany = True
+        return cur
+
+    def session(self, key: str, factory: Callable[[], Any]) -> Any:
+        if key not in self._session:
+            self._session[key] = factory()
+        return self._session[key]
+
+    def __getattr__(self, name: str) -> Any:
+        return getattr(self.raw, name)
+
+
+class ConnectionPool:
+    """
+    Small thread-safe pool of up to `size` connections.
+    Idle connections are health-checked before reuse when they have been idle
+    longer than health_check_seconds or a transient error was seen since;
+    run() executes one unit of work as a transaction and replays it on a fresh
+    connection (exponential backoff) when it fails with a transient error.
+    """
+
+    def __init__(
+        self,
+        conn_str: str,
+        size: int = 4,
+        autocommit: bool = False,
+        fast_executemany: bool = True,
+        max_retries: int = 3,
+        retry_wait: float = 1.0,
+        health_check_seconds: float = 30.0,
+        health_check_sql: str = "SELECT 1",
+        acquire_timeout: float = 300.0,
+        connect_fn: Optional[Callable[[], Any]] = None,
+        transient_fn: Callable[[BaseException], bool] = is_transient,
+    ):
+        self.conn_str = conn_str
+        self.size = size
+        self.autocommit = autocommit
+        self.fast_executemany = fast_executemany
+        self.max_retries = max_retries
+        self.retry_wait = retry_wait
+        self.health_check_seconds = health_check_seconds
+        self.health_check_sql = health_check_sql
+        self.acquire_timeout = acquire_timeout
+        self.connect_fn = connect_fn or (lambda: pyodbc.connect(conn_str, autocommit=autocommit))
+        self.transient_fn = transient_fn
+
+        self._idle = queue.LifoQueue()
+        self._slots = threading.BoundedSemaphore(size)
+        self._lock = threading.Lock()
+        self._suspect_before = 0.0
+        self.connects = 0
+        self.retries = 0
+        self.discarded = 0
+
+    def _connect(self) -> PooledConnection:
+        raw = self.connect_fn()
+        with self._lock:
+            self.connects += 1
+        return PooledConnection(raw, self.fast_executemany)
+
+    def _healthy(self, conn: PooledConnection) -> bool:
+        try:
+            cur = conn.raw.cursor()
+            cur.execute(self.health_check_sql)
+            cur.fetchall()
+            cur.close()
+            return True
+        except Exception:
+            return False
+
+    def _close_quietly(self, conn: PooledConnection) -> None:
+        try:
+            conn.raw.close()
+        except Exception:
+            pass
+
+    def acquire(self) -> PooledConnection:
+        if not self._slots.acquire(timeout=self.acquire_timeout):
+            raise TimeoutError(f"no free connection within {self.acquire_timeout}s (pool size {self.size})")
+        try:
+            while True:
+                try:
+                    conn = self._idle.get_nowait()
+                except queue.Empty:
+                    return self._connect()
+                stale = time.monotonic() - conn.last_used > self.health_check_seconds
+                if (not stale and conn.last_used > self._suspect_before) or self._healthy(conn):
+                    return conn
+                self._close_quietly(conn)
+                with self._lock:
+                    self.discarded += 1
+        except BaseException:
+            self._slots.release()
+            raise
+
+    def release(self, conn: PooledConnection, discard: bool = False) -> None:
+        if discard:
+            self._close_quietly(conn)
+            with self._lock:
+                self.discarded += 1
+                # 同一服务器上的其他空闲连接大概率也已失效，复用前先检查
+                self._suspect_before = time.monotonic()
+        else:
+            conn.last_used = time.monotonic()
+            self._idle.put(conn)
+        self._slots.release()
+
+    @contextmanager
+    def connection(self):
+        """borrow a connection; rolled back on error, dropped if the error was transient"""
+        conn = self.acquire()
+        discard = False
+        try:
+            yield conn
+        except BaseException as e:
+            discard = self.transient_fn(e) or not self._rollback(conn)
+            raise
+        finally:
+            self.release(conn, discard=discard)
+
+    def _rollback(self, conn: PooledConnection) -> bool:
+        if self.autocommit:
+            return True
+        try:
+            conn.rollback()
+            return True
+        except Exception:
+            return False
+
+    def run(self, fn: Callable[..., Any], *args: Any, **kwargs: Any) -> Any:
+        """
+        fn(conn, *args, **kwargs) as one transaction: committed on success,
+        rolled back on error. Transient failures (dropped connection, timeout,
+        deadlock) are retried up to max_retries times on a fresh connection,
+        so fn must be safe to replay (plain INSERTs of a failed, rolled-back
+        batch, MERGE upserts, DDL guarded by IF OBJECT_ID ...).
+        """
+        for attempt in range(self.max_retries + 1):
+            try:
+                with self.connection() as conn:
+                    result = fn(conn, *args, **kwargs)
+                    if not self.autocommit:
+                        conn.commit()
+                    return result
+            except Exception as e:
+                if not self.transient_fn(e) or attempt == self.max_retries:
+                    raise
+                wait = self.retry_wait * 2 ** attempt
+                with self._lock:
+                    self.retries += 1
+                print(f"⚠️ 数据库连接异常，{wait:.1f} 秒后重连重试（第 {attempt + 1} 次）: {e}")
+                time.sleep(wait)
+
+    def close(self) -> None:
+        while True:
+            try:
+                self._close_quietly(self._idle.get_nowait())
+            except queue.Empty:
+                break
+
+
+_pools: Dict[str, ConnectionPool] = {}
+_pools_lock = threading.Lock()
+
+
+def get_pool(conn_str: str, **kwargs: Any) -> ConnectionPool:
+    """process-wide pool per connection string; the first caller's options win"""
+    with _pools_lock:
+        if conn_str not in _pools:
+            _pools[conn_str] = ConnectionPool(conn_str, **kwargs)
+        return _pools[conn_str]
+
+
+def _self_check(n_threads: int = 16, n_tx: int = 50, rows_per_tx: int = 10, size: int = 4,
+                fail_rate: float = 0.05) -> None:
+    """
+    Concurrency check against a local SQLite file standing in for SQL Server:
+    many threads share a small pool while commits randomly fail as if the
+    connection dropped; every transaction must land exactly once and the
+    pool must never hold more than `size` connections.
+    """
+    import os
+    import random
+    import sqlite3
+    import tempfile
+
+    db_path = os.path.join(tempfile.mkdtemp(), "pool_check.sqlite3")
+    with sqlite3.connect(db_path) as c:
+        c.execute("CREATE TABLE t (worker INT, tx INT, i INT, PRIMARY KEY (worker, tx, i))")
+
+    open_now = [0]
+    peak = [0]
+    injected = [0]
+    lock = threading.Lock()
+
+    class FlakyConnection:
+        def __init__(self):
+            self.raw = sqlite3.connect(db_path, timeout=30, check_same_thread=False)
+            with lock:
+                open_now[0] += 1
+                peak[0] = max(peak[0], open_now[0])
+
+        def cursor(self):
+            return self.raw.cursor()
+
+        def commit(self):
+            if random.random() < fail_rate:
+                # 模拟提交前连接断开：事务丢失
+                self.raw.rollback()
+                with lock:
+                    injected[0] += 1
+                raise sqlite3.OperationalError("connection dropped (injected)")
+            self.raw.commit()
+
+        def rollback(self):
+            self.raw.rollback()
+
+        def close(self):
+            self.raw.close()
+            with lock:
+                open_now[0] -= 1
+
+    pool = ConnectionPool(
+        db_path, size=size, fast_executemany=False, max_retries=10, retry_wait=0.001,
+        connect_fn=FlakyConnection, transient_fn=lambda e: isinstance(e, sqlite3.OperationalError),
+    )
+
+    def insert(conn, worker, tx):
+        conn.cursor().executemany("INSERT INTO t VALUES (?, ?, ?)",
+                                  [(worker, tx, i) for i in range(rows_per_tx)])
+
+    def worker(w):
+        for tx in range(n_tx):
+            pool.run(insert, w, tx)
+
+    threads = [threading.Thread(target=worker, args=(w,)) for w in range(n_threads)]
+    t0 = time.perf_counter()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    elapsed = time.perf_counter() - t0
+    pool.close()
+
+    with sqlite3.connect(db_path) as c:
+        n_rows = c.execute("SELECT COUNT(*) FROM t").fetchone()[0]
+    expected = n_threads * n_tx * rows_per_tx
+    print(f"rows {n_rows}/{expected}, injected failures {injected[0]}, retries {pool.retries}, "
+          f"connects {pool.connects}, peak open {peak[0]}/{size}, {elapsed:.2f}s")
+    assert n_rows == expected
+    assert peak[0] <= size
+    assert pool.retries >= injected[0]
+    print("✅ pool self-check passed")
+
+
+if __name__ == "__main__":
+    _self_check()
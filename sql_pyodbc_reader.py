@@ -0,0 +1,333 @@
+"""
+Chunked, typed reads out of the loader tables.
+
+SQL Server streams a default (firehose) result set to the client as it is
+fetched, so iterating a cursor with fetchmany keeps only `fetch_size` rows in
+Python at a time. Each chunk is turned into NumPy column buffers (float64 for
+DECIMAL / FLOAT, int64 for integer types, datetime64 for DATE / DATETIME,
+object for strings), or an Arrow RecordBatch, instead of a list of pyodbc Row
+objects. int64 has no NaN, so NULLs in an integer column come back as a
+masked array (np.ma) rather than a lossy float64.
+
+    reader = TableReader(get_pool(conn_str), valuation_schema, columns=['symbol', 'trade_date', 'pb'])
+    for chunk in reader.by_dates('2015-01-01', '2025-01-01', months=12):
+        ...   # {'symbol': object[n], 'trade_date': datetime64[D][n], 'pb': float64[n]}
+"""
+import argparse
+import datetime as dt
+import decimal
+from typing import Dict, Iterator, List, Optional, Sequence
+
+import numpy as np
+
+from sql_pyodbc_pool import ConnectionPool
+from sql_pyodbc_schema import TableSchema
+
+try:
+    import pyarrow as pa
+    _HAS_ARROW = True
+except ImportError:
+    _HAS_ARROW = False
+
+default_fetch_size = 50000
+
+_KIND_DTYPES = {
+    "decimal":  np.dtype("float64"),
+    "float":    np.dtype("float64"),
+    "date":     np.dtype("datetime64[D]"),
+    "datetime": np.dtype("datetime64[us]"),
+    "string":   np.dtype(object),
+}
+
+
+def description_dtypes(description) -> List[np.dtype]:
+    """NumPy dtype per result column from cursor.description (type_code, null_ok)"""
+    dtypes = []
+    for _, type_code, _, _, _, _, null_ok in description:
+        if type_code in (float, decimal.Decimal):
+            dtypes.append(np.dtype("float64"))
+        elif type_code is int:
+            dtypes.append(np.dtype("int64"))
+        elif type_code is dt.datetime:
+            dtypes.append(np.dtype("datetime64[us]"))
+        elif type_code is dt.date:
+            dtypes.append(np.dtype("datetime64[D]"))
+        else:
+            dtypes.append(np.dtype(object))
+    return dtypes
+
+
+def _column_array(values: tuple, dtype: np.dtype) -> np.ndarray:
+    if dtype.kind == "i" and None in values:
+        # 整数列的 NULL 用掩码表示；退回 float64 会让超过 2^53 的 BIGINT 丢精度
+        mask = np.fromiter((v is None for v in values), dtype=bool, count=len(values))
+        return np.ma.MaskedArray(np.array([0 if v is None else v for v in values], dtype=dtype), mask=mask)
+    return np.array(values, dtype=dtype)
+
+
+def rows_to_columns(rows: Sequence[tuple], names: Sequence[str], dtypes: Sequence[np.dtype]) -> Dict[str, np.ndarray]:
+    """one fetchmany() chunk -> {column: array}; None becomes NaN / NaT in typed columns, masked in integer ones"""
+    columns = list(zip(*rows)) if rows else [()] * len(names)
+    return {name: _column_array(col, dtype) for name, col, dtype in zip(names, columns, dtypes)}
+
+
+def to_arrow(chunk: Dict[str, np.ndarray]):
+    """{column: array} -> pyarrow.RecordBatch (NaN / NaT become nulls)"""
+    if not _HAS_ARROW:
+        raise ImportError("pyarrow is required for Arrow output")
+    arrays = []
+    for values in chunk.values():
+        if values.dtype == object:
+            arrays.append(pa.array(values.tolist(), type=pa.string()))
+        elif isinstance(values, np.ma.MaskedArray):
+            arrays.append(pa.array(values.data, mask=np.ma.getmaskarray(values)))
+        else:
+            mask = np.isnat(values) if values.dtype.kind == "M" else (np.isnan(values) if values.dtype.kind == "f" else None)
+            arrays.append(pa.array(values, mask=mask))
+    return pa.RecordBatch.from_arrays(arrays, names=list(chunk))
+
+
+def iter_query(
+    conn,
+    sql: str,
+    params: Sequence = (),
+    fetch_size: int = default_fetch_size,
+    dtypes: Optional[Sequence[np.dtype]] = None
+) -> Iterator[Dict[str, np.ndarray]]:
+    """execute once, then yield typed column chunks of at most fetch_size rows"""
+    cur = conn.cursor()
+    cur.arraysize = fetch_size
+    cur.execute(sql, params)
+    names = [d[0] for d in cur.description]
+    dtypes = list(dtypes) if dtypes is not None else description_dtypes(cur.description)
+    try:
+        while True:
+            rows = cur.fetchmany(fetch_size)
+            if not rows:
+                return
+            yield rows_to_columns(rows, names, dtypes)
+    finally:
+        cur.close()
+
+
+def date_ranges(start: str, end: str, months: int = 12) -> List[tuple]:
+    """[start, end) split into consecutive `months`-long [lo, hi) ranges, as ISO date strings"""
+    lo = np.datetime64(start, "D")
+    stop = np.datetime64(end, "D")
+    out = []
+    while lo < stop:
+        hi = min((lo.astype("datetime64[M]") + months).astype("datetime64[D]"), stop)
+        out.append((str(lo), str(hi)))
+        lo = hi
+    return out
+
+
+class TableReader:
+    """
+    Streams a TableSchema table in bounded chunks, by symbol batch or by date
+    range. DECIMAL columns are cast to FLOAT on the server so the driver
+    returns floats instead of Decimal objects; integer columns are read as
+    ints into int64 buffers. One pooled connection is held per batch query
+    while its chunks are consumed.
+    """
+
+    def __init__(
+        self,
+        pool: ConnectionPool,
+        schema: TableSchema,
+        columns: Optional[Sequence[str]] = None,
+        fetch_size: int = default_fetch_size,
+        as_arrow: bool = False
+    ):
+        if schema.date_column is None:
+            raise ValueError(f"{schema.name} has no date column")
+        self.pool = pool
+        self.schema = schema
+        self.columns = list(columns) if columns else schema.column_names
+        self.fetch_size = fetch_size
+        self.as_arrow = as_arrow
+        self.date_column = schema.date_column
+        self.symbol_column = next(k for k in schema.primary_key if k != schema.date_column)
+
+        select = []
+        self._dtypes = []
+        for name in self.columns:
+            col = schema.column(name)
+            if col.int_range is not None:
+                select.append(f"[{name}]")
+                self._dtypes.append(np.dtype("int64"))
+            else:
+                select.append(f"CAST([{name}] AS FLOAT) AS [{name}]" if col.kind == "decimal" else f"[{name}]")
+                self._dtypes.append(_KIND_DTYPES[col.kind])
+        self._select = f"SELECT {', '.join(select)} FROM {schema.qualified_name}"
+
+    def query(self, where: str = "", params: Sequence = (), order_by: Optional[str] = None):
+        """chunks of `SELECT columns FROM table [WHERE where] ORDER BY order_by`"""
+        sql = self._select
+        if where:
+            sql += f" WHERE {where}"
+        if order_by:
+            sql += f" ORDER BY {order_by}"
+        with self.pool.connection() as conn:
+            for chunk in iter_query(conn, sql, params, self.fetch_size, self._dtypes):
+                yield to_arrow(chunk) if self.as_arrow else chunk
+
+    def _date_filter(self, start: Optional[str], end: Optional[str]) -> tuple:
+        where, params = [], []
+        if start:
+            where.append(f"[{self.date_column}] >= ?")
+            params.append(start)
+        if end:
+            where.append(f"[{self.date_column}] < ?")
+            params.append(end)
+        return where, params
+
+    def symbols(self) -> List[str]:
+        with self.pool.connection() as conn:
+            rows = conn.cursor().execute(
+                f"SELECT DISTINCT [{self.symbol_column}] FROM {self.schema.qualified_name} "
+                f"ORDER BY [{self.symbol_column}]").fetchall()
+        return [r[0] for r in rows]
+
+    def by_symbols(
+        self,
+        symbols: Optional[Sequence[str]] = None,
+        batch_size: int = 200,
+        start: Optional[str] = None,
+        end: Optional[str] = None
+    ):
+        """each batch of symbols in key order (symbol, date): one clustered index range per symbol"""
+        symbols = list(symbols) if symbols is not None else self.symbols()
+        for i in range(0, len(symbols), batch_size):
+            batch = symbols[i:i + batch_size]
+            where, params = self._date_filter(start, end)
+            where.insert(0, f"[{self.symbol_column}] IN ({', '.join('?' for _ in batch)})")
+            yield from self.query(" AND ".join(where), batch + params,
+                                  order_by=f"[{self.symbol_column}], [{self.date_column}]")
+
+    def by_dates(self, start: str, end: str, months: int = 12):
+        """[start, end) in `months`-long date ranges, each ordered by (date, symbol)"""
+        for lo, hi in date_ranges(start, end, months):
+            where, params = self._date_filter(lo, hi)
+            yield from self.query(" AND ".join(where), params,
+                                  order_by=f"[{self.date_column}], [{self.symbol_column}]")
+
+
+def _self_check(n_symbols: int = 400, n_days: int = 500, fetch_size: int = 20000) -> None:
+    """
+    SQLite file attached as schema `dbo` stands in for SQL Server: chunks from
+    both access paths must add up to the full table with the declared dtypes,
+    while peak Python memory stays a fraction of a full fetchall().
+    """
+    import os
+    import sqlite3
+    import tempfile
+    import tracemalloc
+
+    from sql_pyodbc_schema import Column
+
+    schema = TableSchema('stock_a_daily', [
+        Column('symbol',     'VARCHAR(10)',  nullable=False),
+        Column('trade_date', 'DATE',         nullable=False),
+        Column('close',      'DECIMAL(9,4)'),
+        Column('volume',     'DECIMAL(15,2)'),
+        Column('shares',     'BIGINT'),
+    ], primary_key=['symbol', 'trade_date'])
+
+    db_path = os.path.join(tempfile.mkdtemp(), "reader_check.sqlite3")
+    with sqlite3.connect(db_path) as c:
+        c.execute("CREATE TABLE stock_a_daily (symbol TEXT, trade_date TEXT, close REAL, volume REAL, "
+                  "shares INTEGER, PRIMARY KEY (symbol, trade_date))")
+        rng = np.random.default_rng(0)
+        days = np.datetime64('2020-01-01') + np.arange(n_days)
+        # shares 超过 2^53，float64 无法精确表示
+        rows = [(f"sh{600000 + s}", str(d), float(p), None if k % 97 == 0 else float(k),
+                 None if k % 89 == 0 else 2 ** 60 + s * n_days + k)
+                for s in range(n_symbols)
+                for k, (d, p) in enumerate(zip(days, rng.uniform(5, 50, n_days)))]
+        c.executemany("INSERT INTO stock_a_daily VALUES (?, ?, ?, ?, ?)", rows)
+        shares_sum = sum(r[4] for r in rows if r[4] is not None)
+
+    def connect():
+        conn = sqlite3.connect(":memory:", check_same_thread=False)
+        conn.execute(f"ATTACH DATABASE '{db_path}' AS dbo")
+        return conn
+
+    pool = ConnectionPool(db_path, size=1, fast_executemany=False, connect_fn=connect)
+    reader = TableReader(pool, schema, fetch_size=fetch_size)
+    total = n_symbols * n_days
+
+    tracemalloc.start()
+    n, close_sum, n_chunks, chunk_shares = 0, 0.0, 0, 0
+    for chunk in reader.by_symbols(batch_size=50):
+        assert chunk['trade_date'].dtype == np.dtype('datetime64[D]') and chunk['close'].dtype == np.float64
+        assert chunk['shares'].dtype == np.int64
+        chunk_shares += sum(int(v) for v in np.ma.asarray(chunk['shares']).compressed())
+        assert len(chunk['symbol']) <= fetch_size
+        n += len(chunk['symbol'])
+        close_sum += chunk['close'].sum()
+        n_chunks += 1
+    chunked_peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.reset_peak()
+    with pool.connection() as conn:
+        full = conn.cursor().execute("SELECT * FROM dbo.stock_a_daily").fetchall()
+    full_peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    del full
+
+    by_date = list(reader.by_dates('2020-01-01', '2022-01-01', months=6))
+    n_by_date = sum(len(c['symbol']) for c in by_date)
+    nan_volume = sum(int(np.isnan(c['volume']).sum()) for c in by_date)
+    print(f"by_symbols: {n} rows in {n_chunks} chunks, peak {chunked_peak / 2**20:.1f} MB "
+          f"vs fetchall {full_peak / 2**20:.1f} MB; by_dates: {n_by_date} rows in {len(by_date)} chunks")
+    assert n == n_by_date == total
+    assert nan_volume == n_symbols * len(range(0, n_days, 97))
+    assert abs(close_sum - sum(c['close'].sum() for c in by_date)) < 1e-6 * close_sum
+    assert chunked_peak < full_peak / 2
+    assert chunk_shares == shares_sum
+    if _HAS_ARROW:
+        batch = to_arrow(by_date[0])
+        assert batch.num_rows == len(by_date[0]['symbol']) and batch.column(3).null_count > 0
+        assert batch.column(4).type == pa.int64() and batch.column(4).null_count > 0
+    pool.close()
+    print("✅ reader self-check passed")
+
+
+if __name__ == "__main__":
+    import time
+
+    from sql_pyodbc_pool import get_pool
+
+    parser = argparse.ArgumentParser(description="分块流式读取行情 / 估值表")
+    parser.add_argument("--table", default="stock_a_daily")
+    parser.add_argument("--start", default="2010-01-01")
+    parser.add_argument("--end", default=dt.date.today().isoformat())
+    parser.add_argument("--months", type=int, default=12, help="按日期分段读取时每段的月数")
+    parser.add_argument("--by-symbol", type=int, metavar="N", help="改为每 N 只股票一批读取")
+    parser.add_argument("--fetch-size", type=int, default=default_fetch_size)
+    parser.add_argument("--check", action="store_true", help="在本地 SQLite 上自检")
+    args = parser.parse_args()
+
+    if args.check:
+        _self_check()
+    else:
+        # 只在需要时导入 loader 模块（它们依赖 akshare）
+        from sql_pyodbc_akshare_stock_cap import cap_schema
+        from sql_pyodbc_akshare_stock_daily import conn_str, daily_schema
+        from sql_pyodbc_akshare_stock_value import valuation_schema
+
+        schema = {s.name: s for s in (daily_schema, cap_schema, valuation_schema)}[args.table]
+        pool = get_pool(conn_str)
+        reader = TableReader(pool, schema, fetch_size=args.fetch_size)
+        chunks = (reader.by_symbols(batch_size=args.by_symbol, start=args.start, end=args.end)
+                  if args.by_symbol else reader.by_dates(args.start, args.end, args.months))
+        t0 = time.perf_counter()
+        n_rows = n_chunks = peak = 0
+        for chunk in chunks:
+            n_rows += len(chunk[reader.symbol_column])
+            n_chunks += 1
+            peak = max(peak, sum(a.nbytes for a in chunk.values()))
+        elapsed = time.perf_counter() - t0
+        pool.close()
+        print(f"✔️ {args.table}: {n_rows} 行，{n_chunks} 块，{elapsed:.1f} s（{n_rows / max(elapsed, 1e-9):,.0f} 行/秒），"
+              f"单块最大 {peak / 2**20:.1f} MB")
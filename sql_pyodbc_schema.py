@@ -0,0 +1,287 @@
+import re
+from typing import List, Optional, Sequence, Tuple
+
+import numpy as np
+import pandas as pd
+
+from sql_pyodbc_params import frame_to_params
+
+# 整数类型的 (最小值, 最大值)，含端点
+_INT_RANGES = {
+    "TINYINT":  (0, 255),
+    "SMALLINT": (-2 ** 15, 2 ** 15 - 1),
+    "INT":      (-2 ** 31, 2 ** 31 - 1),
+    "BIGINT":   (-2 ** 63, 2 ** 63 - 1),
+}
+
+
+class Column:
+    """one table column, described by its T-SQL type string, e.g. Column('pb', 'DECIMAL(15,4)')"""
+
+    def __init__(self, name: str, sql_type: str, nullable: bool = True, default: Optional[str] = None):
+        self.name = name
+        self.sql_type = sql_type.upper()
+        self.nullable = nullable
+        self.default = default
+
+        self.scale: Optional[int] = None
+        self.limit: Optional[float] = None    # DECIMAL：|value| 必须严格小于该上限
+        self.int_range: Optional[Tuple[int, int]] = None
+        self.length: Optional[int] = None
+
+        m = re.fullmatch(r"(?:DECIMAL|NUMERIC)\((\d+),\s*(\d+)\)", self.sql_type)
+        if m:
+            precision, scale = int(m.group(1)), int(m.group(2))
+            self.kind = "decimal"
+            self.scale = scale
+            self.limit = 10.0 ** (precision - scale)
+        elif self.sql_type in _INT_RANGES:
+            self.kind = "decimal"
+            self.scale = 0
+            self.int_range = _INT_RANGES[self.sql_type]
+        elif self.sql_type in ("FLOAT", "REAL"):
+            self.kind = "float"
+        elif self.sql_type == "DATE":
+            self.kind = "date"
+        elif self.sql_type in ("DATETIME", "DATETIME2", "SMALLDATETIME"):
+            self.kind = "datetime"
+        else:
+            m = re.fullmatch(r"N?(?:VAR)?CHAR\((\d+|MAX)\)", self.sql_type)
+            if not m:
+                raise ValueError(f"unsupported column type for {name}: {sql_type}")
+            self.kind = "string"
+            self.length = None if m.group(1) == "MAX" else int(m.group(1))
+
+    def definition(self) -> str:
+        sql = f"[{self.name}] {self.sql_type} {'NULL' if self.nullable else 'NOT NULL'}"
+        if self.default is not None:
+            sql += f" DEFAULT {self.default}"
+        return sql
+
+
+class TableSchema:
+    """
+    Single declaration of a loader table. Generates the CREATE TABLE DDL,
+    the vectorized coercion / rounding to each DECIMAL scale, and bulk range
+    checks, so out-of-range rows are rejected before executemany sees them.
+
+    Storage is a rowstore clustered on the primary key unless set_storage()
+    asks for a date-leading covering index, a clustered columnstore index
+    and / or yearly partitions on the date column.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        columns: Sequence[Column],
+        primary_key: Sequence[str],
+        schema: str = "dbo",
+        pk_name: Optional[str] = None,
+        date_column: Optional[str] = None
+    ):
+        self.name = name
+        self.columns = list(columns)
+        self.primary_key = list(primary_key)
+        self.schema = schema
+        self.pk_name = pk_name or f"PK_{name}"
+        self._by_name = {c.name: c for c in self.columns}
+        # 时间序列表的日期列：默认取主键中第一个 DATE 列
+        self.date_column = date_column or next(
+            (k for k in self.primary_key if self._by_name[k].kind in ("date", "datetime")), None)
+
+        self.date_index = False
+        self.date_index_include: Optional[List[str]] = None
+        self.columnstore = False
+        self.partition_years: Optional[Tuple[int, int]] = None
+
+    def set_storage(
+        self,
+        date_index: bool = False,
+        columnstore: bool = False,
+        partition_years: Optional[Sequence[int]] = None,
+        date_index_include: Optional[Sequence[str]] = None
+    ) -> "TableSchema":
+        """
+        date_index: nonclustered (date, other key columns) index covering
+        date_index_include (default: every other column), for "all symbols on
+        date X" reads. columnstore: clustered columnstore index with the
+        primary key kept as a nonclustered constraint (SQL Server 2016+; 2014
+        allows no other index next to a clustered columnstore). partition_years:
+        (first, last) yearly RANGE RIGHT partitions on the date column, applied
+        when the table or its columnstore index is created.
+        """
+        if (date_index or partition_years) and self.date_column is None:
+            raise ValueError(f"{self.name} has no date column to index / partition on")
+        if partition_years and self.date_column not in self.primary_key:
+            raise ValueError(f"partition column {self.date_column} must be part of the primary key of {self.name}")
+        self.date_index = date_index
+        self.columnstore = columnstore
+        self.partition_years = tuple(partition_years) if partition_years else None
+        self.date_index_include = list(date_index_include) if date_index_include is not None else None
+        return self
+
+    def copy(self, name: str) -> "TableSchema":
+        """same columns, key and storage options under another table name"""
+        other = TableSchema(name, self.columns, self.primary_key, self.schema, date_column=self.date_column)
+        return other.set_storage(self.date_index, self.columnstore, self.partition_years, self.date_index_include)
+
+    @property
+    def qualified_name(self) -> str:
+        return f"{self.schema}.{self.name}"
+
+    @property
+    def column_names(self) -> List[str]:
+        return [c.name for c in self.columns]
+
+    @property
+    def scales(self) -> dict:
+        return {c.name: c.scale for c in self.columns if c.scale is not None}
+
+    @property
+    def date_columns(self) -> List[str]:
+        return [c.name for c in self.columns if c.kind == "date"]
+
+    def column(self, name: str) -> Column:
+        return self._by_name[name]
+
+    @property
+    def _partition_scheme(self) -> str:
+        return f"PS_{self.name}_year"
+
+    @property
+    def _on_storage(self) -> str:
+        return f" ON {self._partition_scheme}([{self.date_column}])" if self.partition_years else ""
+
+    def partition_ddl(self) -> str:
+        if not self.partition_years:
+            return ""
+        first, last = self.partition_years
+        bounds = ", ".join(f"'{y}-01-01'" for y in range(first, last + 1))
+        fn = f"PF_{self.name}_year"
+        return f"""
+IF NOT EXISTS (SELECT 1 FROM sys.partition_functions WHERE name = N'{fn}')
+    CREATE PARTITION FUNCTION {fn} ({self.column(self.date_column).sql_type})
+        AS RANGE RIGHT FOR VALUES ({bounds});
+IF NOT EXISTS (SELECT 1 FROM sys.partition_schemes WHERE name = N'{self._partition_scheme}')
+    CREATE PARTITION SCHEME {self._partition_scheme} AS PARTITION {fn} ALL TO ([PRIMARY]);
+"""
+
+    def primary_key_sql(self) -> str:
+        """ALTER TABLE ... ADD the primary key (clustered unless the table is a columnstore)"""
+        clustering = " NONCLUSTERED" if self.columnstore else " CLUSTERED"
+        return (f"ALTER TABLE {self.qualified_name} ADD CONSTRAINT {self.pk_name}\n"
+                f"            PRIMARY KEY{clustering} ({', '.join(self.primary_key)}){self._on_storage};")
+
+    def index_ddl(self) -> str:
+        """idempotent; also converts an existing rowstore table to the requested storage"""
+        obj = f"OBJECT_ID(N'{self.qualified_name}')"
+        sql = ""
+        if self.columnstore:
+            # 聚集主键须先删除，列存储建好后再以非聚集主键加回
+            sql += f"""
+IF NOT EXISTS (SELECT 1 FROM sys.indexes WHERE object_id = {obj} AND type = 5)
+BEGIN
+    IF EXISTS (SELECT 1 FROM sys.indexes WHERE object_id = {obj} AND name = N'{self.pk_name}' AND type = 1)
+        ALTER TABLE {self.qualified_name} DROP CONSTRAINT {self.pk_name};
+    CREATE CLUSTERED COLUMNSTORE INDEX CCI_{self.name} ON {self.qualified_name}{self._on_storage};
+    IF NOT EXISTS (SELECT 1 FROM sys.indexes WHERE object_id = {obj} AND name = N'{self.pk_name}')
+        {self.primary_key_sql()}
+END
+"""
+        if self.date_index:
+            keys = [self.date_column] + [k for k in self.primary_key if k != self.date_column]
+            include = self.date_index_include
+            if include is None:
+                include = [c for c in self.column_names if c not in keys]
+            include_sql = f" INCLUDE ({', '.join(f'[{c}]' for c in include)})" if include else ""
+            ix = f"IX_{self.name}_{self.date_column}"
+            sql += f"""
+IF NOT EXISTS (SELECT 1 FROM sys.indexes WHERE object_id = {obj} AND name = N'{ix}')
+    CREATE NONCLUSTERED INDEX {ix} ON {self.qualified_name} ({', '.join(f'[{k}]' for k in keys)}){include_sql}{self._on_storage};
+"""
+        return sql
+
+    def ddl(self) -> str:
+        body = ",\n        ".join(c.definition() for c in self.columns)
+        pk_cols = ", ".join(self.primary_key)
+        clustering = " NONCLUSTERED" if self.columnstore else ""
+        return f"""{self.partition_ddl()}
+IF OBJECT_ID(N'{self.qualified_name}', 'U') IS NULL
+BEGIN
+    CREATE TABLE {self.qualified_name} (
+        {body},
+        CONSTRAINT {self.pk_name} PRIMARY KEY{clustering} ({pk_cols})
+    ){self._on_storage};
+END
+{self.index_ddl()}"""
+
+    def insert_sql(self) -> str:
+        col_list = ", ".join(f"[{c}]" for c in self.column_names)
+        placeholders = ", ".join("?" for _ in self.columns)
+        return f"INSERT INTO {self.qualified_name} ({col_list}) VALUES ({placeholders})"
+
+    def drop_sql(self) -> str:
+        return f"IF OBJECT_ID(N'{self.qualified_name}', 'U') IS NOT NULL DROP TABLE {self.qualified_name};"
+
+    def coerce(self, df: pd.DataFrame) -> Tuple[pd.DataFrame, pd.DataFrame]:
+        """
+        Column-wise coercion to the declared types. Returns (good, rejected);
+        rejected carries a `reject_reason` column naming the first violated rule
+        (NULL in a NOT NULL column, DECIMAL/INT overflow, string too long).
+        """
+        out = pd.DataFrame(index=df.index)
+        reason = pd.Series(None, index=df.index, dtype=object)
+
+        for col in self.columns:
+            s = df[col.name]
+            if col.kind == "decimal":
+                v = pd.to_numeric(s, errors="coerce").astype("float64").round(col.scale)
+                if col.int_range is not None:
+                    lo, hi = col.int_range
+                    # 值已取整；与 hi + 1 比较，BIGINT 的 2^63 在 float64 中仍是精确值
+                    bad = ((v < lo) | (v >= hi + 1)).to_numpy()
+                else:
+                    bad = (v.abs() >= col.limit).to_numpy()
+                why = f"{col.name} 超出 {col.sql_type} 范围"
+            elif col.kind == "float":
+                v = pd.to_numeric(s, errors="coerce").astype("float64")
+                bad = np.isinf(v.to_numpy())
+                why = f"{col.name} 为无穷值"
+            elif col.kind in ("date", "datetime"):
+                v = pd.to_datetime(s, errors="coerce")
+                bad = np.zeros(len(v), dtype=bool)
+                why = ""
+            else:
+                v = s.astype(object).where(s.notna(), None)
+                bad = np.zeros(len(v), dtype=bool)
+                if col.length is not None:
+                    bad = (s.astype("string").str.len() > col.length).fillna(False).to_numpy(dtype=bool)
+                why = f"{col.name} 超过 {col.sql_type} 长度"
+
+            reason = reason.mask(reason.isna() & bad, why)
+            if not col.nullable:
+                reason = reason.mask(reason.isna() & v.isna().to_numpy(), f"{col.name} 不能为空")
+            out[col.name] = v
+
+        rejected_mask = reason.notna()
+        rejected = df.loc[rejected_mask].copy()
+        rejected["reject_reason"] = reason[rejected_mask]
+        return out.loc[~rejected_mask], rejected
+
+    def to_params(self, df: pd.DataFrame) -> List[tuple]:
+        return frame_to_params(df, self.column_names, scales=self.scales, date_cols=self.date_columns)
+
+
+def add_storage_args(parser) -> None:
+    """shared --date-index / --columnstore / --partition-years flags for loader CLIs"""
+    parser.add_argument("--date-index", action="store_true",
+                        help="建立以日期开头的非聚集覆盖索引，加速横截面查询")
+    parser.add_argument("--columnstore", action="store_true",
+                        help="建立聚集列存储索引，主键改为非聚集（需 SQL Server 2016+）")
+    parser.add_argument("--partition-years", type=int, nargs=2, metavar=("FIRST", "LAST"),
+                        help="按年分区（新建表或新建列存储索引时生效）")
+
+
+def configure_storage(schema: TableSchema, args) -> None:
+    schema.set_storage(date_index=args.date_index, columnstore=args.columnstore,
+                       partition_years=args.partition_years)
@@ -0,0 +1,168 @@
+import pyodbc
+from typing import List, Sequence, Tuple
+
+from sql_pyodbc_pool import is_transient
+
+
+def quote_col(col: str) -> str:
+    return f"[{col}]"
+
+
+class UpsertResult:
+    """inserted / updated counts plus the rows isolated as bad by bisection"""
+
+    def __init__(self):
+        self.inserted = 0
+        self.updated = 0
+        self.bad_rows: List[Tuple[tuple, Exception]] = []
+
+    def add(self, other: "UpsertResult") -> None:
+        self.inserted += other.inserted
+        self.updated += other.updated
+        self.bad_rows.extend(other.bad_rows)
+
+
+class BadRowsError(Exception):
+    """rows a MERGE rejected even one at a time; the rest of the batch was merged"""
+
+    def __init__(self, bad_rows: List[Tuple[tuple, Exception]]):
+        self.bad_rows = bad_rows
+        row, err = bad_rows[0]
+        super().__init__(f"{len(bad_rows)} bad rows, first {row[:2]}: {err}")
+
+
+class BulkUpserter:
+    """
+    Set-based upsert into a keyed table:
+    rows are staged into a session #temp table with fast_executemany,
+    then merged into the target with a single MERGE per batch.
+    Matched rows are only rewritten when a non-key column other than
+    `ignore_in_compare` actually changed, so re-runs touch only changed rows.
+    A failing batch is bisected until the offending rows are isolated.
+
+    Each batch (and each bisected half) is committed on its own, so one
+    upsert() call is several commits and cannot be rolled back as a whole.
+    Callers replay a failed or interrupted upsert() instead: re-merging rows
+    that were already committed matches them unchanged and writes nothing.
+    """
+
+    def __init__(
+        self,
+        conn: pyodbc.Connection,
+        table: str,
+        columns: Sequence[str],
+        key_columns: Sequence[str],
+        schema: str = "dbo",
+        batch_size: int = 10000,
+        ignore_in_compare: Sequence[str] = ("update_time",),
+    ):
+        self.conn = conn
+        self.table = table
+        self.columns = list(columns)
+        self.key_columns = list(key_columns)
+        self.target = f"{schema}.{table}"
+        self.stage = f"#stage_{table}"
+        self.batch_size = batch_size
+        self.ignore_in_compare = set(ignore_in_compare)
+
+        self.cursor = conn.cursor()
+        self.cursor.fast_executemany = True
+
+        col_list = ", ".join(quote_col(c) for c in self.columns)
+        self.insert_sql = (
+            f"INSERT INTO {self.stage} ({col_list}) "
+            f"VALUES ({', '.join('?' for _ in self.columns)})"
+        )
+        self.merge_sql = self._build_merge_sql()
+        self._create_stage()
+
+    def _create_stage(self) -> None:
+        col_list = ", ".join(quote_col(c) for c in self.columns)
+        # 在事务外提交建表，失败批次回滚时临时表仍然保留
+        self.cursor.execute(f"""
+IF OBJECT_ID('tempdb..{self.stage}') IS NOT NULL DROP TABLE {self.stage};
+SELECT TOP 0 {col_list} INTO {self.stage} FROM {self.target};
+""")
+        self.conn.commit()
+
+    def _build_merge_sql(self) -> str:
+        on_clause = " AND ".join(
+            f"t.{quote_col(c)} = s.{quote_col(c)}" for c in self.key_columns
+        )
+        update_cols = [c for c in self.columns if c not in self.key_columns]
+        set_clause = ",\n        ".join(
+            f"{quote_col(c)} = s.{quote_col(c)}" for c in update_cols
+        )
+        compare_cols = [c for c in update_cols if c not in self.ignore_in_compare]
+        # EXCEPT 比较对 NULL 安全：任一比较列变化才更新
+        matched_clause = "WHEN MATCHED THEN"
+        if compare_cols:
+            matched_clause = (
+                "WHEN MATCHED AND EXISTS (\n"
+                f"    SELECT {', '.join(f's.{quote_col(c)}' for c in compare_cols)}\n"
+                f"    EXCEPT SELECT {', '.join(f't.{quote_col(c)}' for c in compare_cols)}\n"
+                ") THEN"
+            )
+        insert_cols = ", ".join(quote_col(c) for c in self.columns)
+        insert_vals = ", ".join(f"s.{quote_col(c)}" for c in self.columns)
+        return f"""
+SET NOCOUNT ON;
+DECLARE @actions TABLE (merge_action NVARCHAR(10));
+MERGE {self.target} WITH (HOLDLOCK) AS t
+USING {self.stage} AS s
+    ON {on_clause}
+{matched_clause}
+    UPDATE SET
+        {set_clause}
+WHEN NOT MATCHED BY TARGET THEN
+    INSERT ({insert_cols})
+    VALUES ({insert_vals})
+OUTPUT $action INTO @actions;
+SELECT
+    SUM(CASE WHEN merge_action = 'INSERT' THEN 1 ELSE 0 END),
+    SUM(CASE WHEN merge_action = 'UPDATE' THEN 1 ELSE 0 END)
+FROM @actions;
+"""
+
+    def _merge_rows(self, rows: Sequence[tuple]) -> UpsertResult:
+        self.cursor.execute(f"TRUNCATE TABLE {self.stage}")
+        self.cursor.executemany(self.insert_sql, rows)
+        self.cursor.execute(self.merge_sql)
+        inserted, updated = self.cursor.fetchone()
+        self.conn.commit()
+
+        result = UpsertResult()
+        result.inserted = inserted or 0
+        result.updated = updated or 0
+        return result
+
+    def _merge_bisect(self, rows: Sequence[tuple]) -> UpsertResult:
+        try:
+            return self._merge_rows(rows)
+        except Exception as e:
+            # 连接层面的错误二分也无济于事，交给连接池重连后整体重放
+            if is_transient(e):
+                raise
+            self.conn.rollback()
+            if len(rows) == 1:
+                result = UpsertResult()
+                result.bad_rows.append((tuple(rows[0]), e))
+                return result
+            mid = len(rows) // 2
+            result = self._merge_bisect(rows[:mid])
+            result.add(self._merge_bisect(rows[mid:]))
+            return result
+
+    def upsert(self, rows: Sequence[tuple], label: str = "", verbose: bool = True) -> UpsertResult:
+        """merge rows in batches of batch_size, printing per-batch counts"""
+        total = UpsertResult()
+        n_batches = (len(rows) + self.batch_size - 1) // self.batch_size
+        for b, i in enumerate(range(0, len(rows), self.batch_size), start=1):
+            result = self._merge_bisect(rows[i:i + self.batch_size])
+            if verbose:
+                print(f"  {label}批次 {b}/{n_batches}：新增 {result.inserted} 行，"
+                      f"更新 {result.updated} 行，坏行 {len(result.bad_rows)} 行")
+            for row, err in result.bad_rows:
+                print(f"    坏行 {row[:len(self.key_columns)]}: {err}")
+            total.add(result)
+        return total